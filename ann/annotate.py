@@ -10,8 +10,16 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import threading
+import time
+from array import array
+import pymysql
 import file_utils as fu
 import utils as u
+import reference
+from bloom import BloomFilter, dbsnp_key
+from intervals import CoverageMask, IntervalIndex, chrom_key, overlap_percents
+from records import CHUNK_SIZE, read_chunks, variants_in, write_chunk
 
 indicesKnownGenes = [12, 1, 3]  # 12 for gene
 
@@ -50,33 +58,36 @@ def collapseGeneNames(row, indices, region, cnt):
 """
 
 
-def collapseRefSeq(line):
-    names = [
-        "chr",
-        "start",
-        "end",
-        "haplotypeReference",
-        "haplotypeAlternate",
-        "name",
-        "name2",
-        "transcriptStrand",
-        "positionType",
-        "frame",
-        "mrnaCoord",
-        "codonCoord",
-        "spliceDist",
-        "referenceCodon",
-        "referenceAA",
-        "variantCodon",
-        "variantAA",
-        "changesAA",
-        "functionalClass",
-        "codingCoordStr",
-        "proteinCoordStr",
-        "inCodingRegion",
-        "spliceInfo",
-        "uorfChange",
-    ]
+REFSEQ_NAMES = [
+    "chr",
+    "start",
+    "end",
+    "haplotypeReference",
+    "haplotypeAlternate",
+    "name",
+    "name2",
+    "transcriptStrand",
+    "positionType",
+    "frame",
+    "mrnaCoord",
+    "codonCoord",
+    "spliceDist",
+    "referenceCodon",
+    "referenceAA",
+    "variantCodon",
+    "variantAA",
+    "changesAA",
+    "functionalClass",
+    "codingCoordStr",
+    "proteinCoordStr",
+    "inCodingRegion",
+    "spliceInfo",
+    "uorfChange",
+]
+
+
+def refSeqFields(line):
+    names = REFSEQ_NAMES
     fields = line.strip().split("\t")
     fcount = 0
     collapsed = []
@@ -84,10 +95,33 @@ def collapseRefSeq(line):
     for f in fields:
         if fcount > 4:
             if len(str(f)) > 0 and str(f) != "0":
-                collapsed.append(str(names[fcount]).strip() + "=" + str(f).strip())
+                collapsed.append((str(names[fcount]).strip(), str(f).strip()))
         fcount = fcount + 1
 
-    return ";".join(collapsed)
+    return tuple(collapsed)
+
+
+"""INFO string of a bigRefGene row and its (key, value) fields
+"""
+
+
+def collapseRefSeq(line):
+    fields = refSeqFields(line)
+    return ";".join([key + "=" + value for key, value in fields]), fields
+
+
+"""Joins collapseRefSeq results, each distinct string once, with their
+fields in the same order
+"""
+
+
+def joinRefSeqs(refseqs):
+    fields = dict(refseqs)
+    rendered = set([text for text, _ in refseqs])
+    return (
+        ";".join(rendered),
+        tuple([field for text in rendered for field in fields[text]]),
+    )
 
 
 def binarySearchUniqueAndSorted(arg0, key):
@@ -110,16 +144,6 @@ def binarySearchUniqueAndSorted(arg0, key):
     return -1  # NOT_FOUND
 
 
-"""Cleans characters not accepted by MySQL
-"""
-
-
-def clean_mysql_chars(entry):
-    entry = entry.replace('"', "")
-    entry = entry.replace("'", "")
-    return str(entry)
-
-
 def getFormatSpecificIndices(format="vcf"):
     chr_ind = 0
     pos_ind = 1
@@ -147,101 +171,439 @@ def getComplementary(nuc):
         return compNuc
 
 
-""""Format must be pileup or vcf
-    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+"""Base class for annotation stages
+
+A stage is created once per job and keeps what it needs across chunks
+(database cursor, reference indexes, counts). annotate() is called with
+each chunk of parsed Variants in file order and adds to their INFO;
+finish() writes the stage's counts to the job's .count.log and releases
+its resources. Stages that query MySQL share conn when one is given.
+
+Stages implement annotate() as two steps: lookup() fetches what the
+track has for a variant's locus (CHROM, POS, end, REF, ALT) and must depend
+on nothing else, apply() adds that result to the record and counts it.
+With a LocusMemo (records.py) results are reused for every record of a
+locus, so repeated loci are only looked up once per job while counts
+and INFO come out exactly as without it.
+
+Stages over an IntervalTrack inherit lookup() and answer lookup_many()
+according to plan (see planner.py): one query per variant (POINT), one
+range query per window of nearby variants (WINDOW) or from the whole
+table loaded into memory (PRELOAD). Time spent in lookups is kept in
+lookup_seconds. With an engine (lookups.py) the queries of a chunk run
+concurrently over its connection pool.
+
+Since lookups only depend on the locus, lookup_chunk() of different
+stages may run at the same time (on their own connections); the
+apply_chunk() calls must then be made in pipeline order.
+
+Overlap tracks can look variants up by their whole span, POS to end
+(interval mode, set_spans()), so that deletions and structural variants
+match every reference interval they touch. Stages that classify a
+single position keep looking up POS only.
 """
 
+POINT = "point"
+WINDOW = "window"
+PRELOAD = "preload"
+
+# Largest span of positions looked up with one WINDOW query
+WINDOW_SIZE = 100000
+
+
+class Stage(object):
+    conn = None
+    owns_conn = False
+    track = None
+    plan = POINT
+    window_size = WINDOW_SIZE
+    lookup_seconds = 0.0
+    engine = None
+    spans_supported = False
+    spans = False
+
+    def set_spans(self, spans=True):
+        self.spans = spans and self.spans_supported
+        if self.track is not None:
+            self.track.spans = self.spans
+
+    def end_of(self, v):
+        return v.end if self.spans else v.pos
+
+    def connect(self, conn=None):
+        if conn is None:
+            conn = u.db_connect()
+            self.owns_conn = True
+        self.conn = conn
+        self.cursor = conn.cursor()
+
+    def lookup(self, v):
+        if self.track is None:
+            raise NotImplementedError
+        return self.track.point(self.cursor, v)
+
+    def lookup_many(self, variants):
+        if self.track is not None and self.plan == WINDOW:
+            return self.track.windowed(
+                self.cursor, variants, self.window_size, engine=self.engine
+            )
+        if self.track is not None and self.plan == PRELOAD:
+            return self.track.preloaded(variants)
+        if self.track is not None and self.engine is not None:
+            return self.engine.map(self.track.point, variants)
+        return [self.lookup(v) for v in variants]
+
+    def apply(self, v, result):
+        raise NotImplementedError
+
+    def lookup_chunk(self, variants, memo=None):
+        started = time.perf_counter()
+        if memo is None:
+            results = self.lookup_many(variants)
+        else:
+            results = memo.lookup_many(self, variants)
+        self.lookup_seconds = self.lookup_seconds + time.perf_counter() - started
+        return results
 
-def getSnpsFromDbSnp(
-    vcf, format="vcf", tmpextin="", tmpextout=".1", varclass="SNV", sep="\t"
-):
+    def apply_chunk(self, variants, results):
+        for v, result in zip(variants, results):
+            self.apply(v, result)
+
+    def annotate(self, variants, memo=None):
+        self.apply_chunk(variants, self.lookup_chunk(variants, memo=memo))
+
+    """Undoes what apply() did to v outside INFO, before v is annotated by
+    the stage again (see reannotate.py)
+    """
+
+    def clear(self, v):
+        pass
 
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + ".count.log"
-    fh_log = open(logcountfile, "w")
-    var_count = 0
+    def finish(self, fh_log):
+        self.close()
 
+    def close(self):
+        if self.owns_conn:
+            self.conn.close()
+
+
+"""Runs one stage on vcf + tmpextin, writing vcf + tmpextout
+
+Keeps the file-to-file interface of the functions below for running a
+single stage; driver.run passes the records through every stage in
+memory instead.
+"""
+
+
+def runStage(
+    stage,
+    vcf,
+    format="vcf",
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
+    log_mode="a",
+    chunk_size=CHUNK_SIZE,
+):
     inds = getFormatSpecificIndices(format=format)
+    with open(vcf + tmpextin) as fh, open(vcf + tmpextout, "w") as fh_out:
+        for chunk in read_chunks(fh, inds, sep=sep, chunk_size=chunk_size):
+            stage.annotate(variants_in(chunk))
+            write_chunk(fh_out, chunk)
 
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
+    with open(vcf + ".count.log", log_mode) as fh_log:
+        stage.finish(fh_log)
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
+""""Format must be pileup or vcf
+    Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
+
+    With dbsnp_filter (path to a filter built by bloom.py), variants the
+    Bloom filter rules out are not queried at all. The rest of a chunk is
+    looked up DBSNP_BATCH_SIZE variants per statement.
+"""
+
+DBSNP_BATCH_SIZE = 500
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
 
+class DbSnpStage(Stage):
+    def __init__(self, varclass="SNV", dbsnp_filter=None, conn=None):
+        self.varclass = varclass
+        self.var_count = 0
+        self.linenum = 1
+
+        self.bloom = None
+        if dbsnp_filter:
+            try:
+                self.bloom = BloomFilter.open(dbsnp_filter)
+            except (OSError, ValueError) as e:
+                print(f"Not using dbSNP filter {dbsnp_filter}: {e}")
+        self.lookups = 0
+        self.skipped = 0
+        self.no_match = 0
+        self.statements = {}
+
+        self.connect(conn)
+
+    """dbSNP statement looking up count variants at once, each matching
+    CHR, POS and REF or its complement; built once per arity
+    """
+
+    def statement(self, count):
+        sql = self.statements.get(count)
+        if sql is None:
             sql = (
-                'select * from dbSNP where CHR="'
-                + str(chr)
-                + '" AND POS='
-                + str(pos)
-                + ' AND ( REF="'
-                + str(ref)
-                + '" OR REF ="'
-                + str(compRef)
-                + '" )  AND INFO = "'
-                + varclass
-                + '" ;'
+                "select * from dbSNP where INFO = %s AND ("
+                + " OR ".join(["(CHR = %s AND POS = %s AND REF IN (%s, %s))"] * count)
+                + ");"
             )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
+            self.statements[count] = sql
+        return sql
+
+    def query_batch(self, cursor, batch):
+        params = [self.varclass]
+        for _, chr, pos, ref, compRef in batch:
+            params.extend([chr, pos, ref, compRef])
+        cursor.execute(self.statement(len(batch)), params)
+        return cursor.fetchall()
+
+    """Whether dbSNP may have v; always True without a filter
+    """
+
+    def maybe_known(self, chr, pos, ref, compRef):
+        if self.bloom is None:
+            return True
+        return self.bloom.might_contain(
+            dbsnp_key(chr, pos, ref)
+        ) or self.bloom.might_contain(dbsnp_key(chr, pos, compRef))
+
+    def lookup_many(self, variants):
+        results = [()] * len(variants)
+        pending = []
+        for n, v in enumerate(variants):
+            chr = v.bare_chrom
+            pos = v.pos
+            ref = v.ref
+            compRef = getComplementary(ref)
+
+            if self.maybe_known(chr, pos, ref, compRef):
+                pending.append((n, chr, pos, ref, compRef))
+
+        if len(pending) == 0:
+            return results
+        columns = tableColumns(self.cursor, "dbSNP")
+        chr_ind = columns.index("CHR")
+        pos_ind = columns.index("POS")
+        ref_ind = columns.index("REF")
+
+        batches = [
+            pending[i : i + DBSNP_BATCH_SIZE]
+            for i in range(0, len(pending), DBSNP_BATCH_SIZE)
+        ]
+        if self.engine is None:
+            fetched = [self.query_batch(self.cursor, batch) for batch in batches]
+        else:
+            fetched = self.engine.map(self.query_batch, batches)
+
+        # rows are matched back to variants the way MySQL compares them
+        for batch, batch_rows in zip(batches, fetched):
+            by_locus = {}
+            for row in batch_rows:
+                key = (chrom_key(row[chr_ind]), int(row[pos_ind]))
+                by_locus.setdefault(key, []).append(row)
+
+            for n, chr, pos, ref, compRef in batch:
+                alleles = (chrom_key(ref), chrom_key(compRef))
+                rows = tuple(
+                    [
+                        row
+                        for row in by_locus.get((chrom_key(chr), pos), ())
+                        if chrom_key(row[ref_ind]) in alleles
+                    ]
+                )
+                results[n] = rows
+        return results
+
+    def apply(self, v, rows):
+        # filter counts are kept here, per variant, so that they do not
+        # depend on how many variants lookup_many was given (see LocusMemo)
+        if self.bloom is not None:
+            self.lookups = self.lookups + 1
+            if len(rows) == 0:
+                compRef = getComplementary(v.ref)
+                if self.maybe_known(v.bare_chrom, v.pos, v.ref, compRef):
+                    self.no_match = self.no_match + 1
+                else:
+                    self.skipped = self.skipped + 1
 
-            fields[2] = "."
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        v.fields[2] = "."
+        if len(rows) > 0:
             rsids = []
             mafs = []
-            if len(rows) > 0:
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if str(row[7]) != ".":
-                        mafs.append("GMAF=" + str(row[7]))
-
-                maf_str = ""
-                if len(mafs) > 0:
-                    maf_str = ";" + ";".join([str(x) for x in mafs])
-
-                var_count = var_count + 1
-                if str(fields[7]) == ".":
-                    fields[7] = "DB" + maf_str
-                else:
-                    fields[7] = fields[7] + ";DB;VC=" + varclass + maf_str
+            for row in rows:
+                rsids.append(str(row[3]))
+                if str(row[7]) != ".":
+                    mafs.append("GMAF=" + str(row[7]))
+
+            maf_str = ""
+            if len(mafs) > 0:
+                maf_str = ";" + ";".join([str(x) for x in mafs])
+
+            self.var_count = self.var_count + 1
+            if str(v.info) == ".":
+                v.info.reset("DB" + maf_str)
+            else:
+                v.info.append("DB;VC=" + self.varclass + maf_str)
+
+            v.fields[2] = str(";".join(rsids))
+
+        self.linenum = self.linenum + 1
+
+    def finish(self, fh_log):
+        linenum = self.linenum
+        ratioInDbSnp = (self.var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n")
+        if self.bloom is not None:
+            # Queries that found nothing were filter false positives or hit
+            # rows of another variant class, so this is an upper bound. Each
+            # variant probes two keys (REF and its complement)
+            misses = self.skipped + self.no_match
+            fpRate = (self.no_match / float(misses)) * 100 if misses else 0.0
+            fh_log.write(
+                f"dbSNP filter: skipped {str(self.skipped)} of {str(self.lookups)} "
+                f"lookups, {str(self.no_match)} queried with no match "
+                f"(false positive rate {fpRate:.3f}%, "
+                f"expected {self.bloom.expected_fp_rate() * 100:.3f}% per key)\n"
+            )
+            self.bloom.close()
+        self.close()
 
-                fields[2] = str(";".join(rsids))
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write("\t".join([str(x) for x in fields]) + "\n")
+def getSnpsFromDbSnp(
+    vcf,
+    format="vcf",
+    tmpextin="",
+    tmpextout=".1",
+    varclass="SNV",
+    sep="\t",
+    dbsnp_filter=None,
+):
+    runStage(
+        DbSnpStage(varclass=varclass, dbsnp_filter=dbsnp_filter),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        log_mode="w",
+    )
 
-            linenum = linenum + 1
 
-        else:
-            fh_out.write(line + "\n")
+"""Precompiled functional annotation index for getBigRefGene
+
+exact maps (chrom, pos) to (base, nobase): base maps (REF, ALT) to the
+chrom_pos_equal_base rows for that allele and nobase holds the
+chrom_pos_equal_nobase rows, so both exact tables are answered by one
+hash probe. chrom_pos_unequal goes into an IntervalIndex. Every row is
+stored with its collapseRefSeq string and fields already rendered, as
+(table order, rendered) pairs plus the INFO the rows of one key produce.
+"""
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def loadBigRefGeneIndex():
+    def rendered_rows(cursor):
+        names = [str(d[0]) for d in cursor.description]
+        cols = [
+            names.index(n)
+            for n in [
+                "CHR",
+                "start",
+                "end",
+                "haplotypeReference",
+                "haplotypeAlternate",
+            ]
+        ]
+        for order, row in enumerate(cursor):
+            yield order, [row[c] for c in cols], collapseRefSeq(
+                "\t".join([str(x) for x in row[1 : len(row)]])
+            )
+
+    def entry(rows):
+        rows = tuple(rows)
+        return (rows, joinRefSeqs([rendered for _, rendered in rows]))
+
+    def build():
+        conn = u.db_connect()
+        cursor = conn.cursor(pymysql.cursors.SSCursor)
+
+        exact = {}
+        cursor.execute("select * from chrom_pos_equal_base;")
+        for order, (chr, start, _, ref, alt), rendered in rendered_rows(cursor):
+            base = exact.setdefault((chrom_key(chr), int(start)), ({}, None))[0]
+            allele = (str(ref).rstrip().upper(), str(alt).rstrip().upper())
+            base.setdefault(allele, []).append((order, rendered))
+
+        nobase = {}
+        cursor.execute("select * from chrom_pos_equal_nobase;")
+        for order, (chr, start, _, _, _), rendered in rendered_rows(cursor):
+            key = (chrom_key(chr), int(start))
+            nobase.setdefault(key, []).append((order, rendered))
+
+        for key, (base, _) in exact.items():
+            for allele, rows in base.items():
+                base[allele] = entry(rows)
+        for key, rows in nobase.items():
+            base = exact.get(key, ({}, None))[0]
+            exact[key] = (base, entry(rows))
+
+        cursor.execute("select * from chrom_pos_unequal;")
+        unequal = IntervalIndex.build(
+            [
+                (chr, start, end, rendered)
+                for _, (chr, start, end, _, _), rendered in rendered_rows(cursor)
+            ]
+        )
+        cursor.close()
+        conn.close()
+        return exact, unequal
+
+    return reference.cached("bigRefGeneFields", build)
+
+
+"""INFO string and fields for a variant from the BigRefGene index, or
+None
+
+Follows the original query order: exact allele match (REF/ALT or their
+complements), then any allele at the position, then overlapping
+chrom_pos_unequal rows.
+"""
+
+
+def lookupBigRefGene(index, chr, pos, ref, alt, compRef, compAlt):
+    exact, unequal = index
+    entry = exact.get((chrom_key(chr), int(pos)))
+    if entry is not None:
+        base, nobase = entry
+        alleles = [(ref.upper(), alt.upper()), (compRef.upper(), compAlt.upper())]
+        if alleles[0] == alleles[1]:
+            alleles = alleles[:1]
+        hits = [base[a] for a in alleles if a in base]
+        if len(hits) == 1:
+            return hits[0][1]
+        if len(hits) == 2:
+            rows = sorted(hits[0][0] + hits[1][0])
+            return joinRefSeqs([rendered for _, rendered in rows])
+        if nobase is not None:
+            return nobase[1]
+
+    rendered = unequal.overlapping(chr, int(pos))
+    if len(rendered) > 0:
+        return joinRefSeqs(rendered)
+    return None
 
 
 """NOTE: all isoforms are collapsed in one record
@@ -251,388 +613,452 @@ def getSnpsFromDbSnp(
 """
 
 
-def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
+class BigRefGeneStage(Stage):
+    def __init__(self):
+        self.index = loadBigRefGeneIndex()
 
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
+    def lookup(self, v):
+        ref = v.ref
+        alt = v.alt
+        return lookupBigRefGene(
+            self.index,
+            v.bare_chrom,
+            v.pos,
+            ref,
+            alt,
+            getComplementary(ref),
+            getComplementary(alt),
+        )
 
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace("chr", "")
+    def apply(self, v, refseq):
+        if refseq is not None:
+            rendered, fields = refseq
+            v.info.append(rendered, fields)
+            if v.info.startswith(".;"):
+                v.info.reset(str(v.info).replace(".;", "", 1))
 
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
 
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = (
-                'select * from chrom_pos_equal_base where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ' AND ((haplotypeReference="'
-                + str(ref)
-                + '" AND haplotypeAlternate ="'
-                + str(alt)
-                + '") OR (haplotypeReference="'
-                + str(compRef)
-                + '" AND haplotypeAlternate ="'
-                + str(compAlt)
-                + '"));'
-            )
+def getBigRefGene(vcf, format="vcf", tmpextin=".1", tmpextout=".2", sep="\t"):
+    runStage(
+        BigRefGeneStage(),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-            sql2 = (
-                'select * from chrom_pos_equal_nobase where CHR="'
-                + str(chr)
-                + '" AND start = '
-                + str(pos)
-                + ";"
-            )
 
-            sql3 = (
-                'select * from chrom_pos_unequal where CHR="'
-                + str(chr)
-                + '" AND start <= '
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= end ;"
-            )
+"""Loads cpgIslandExt into an IntervalIndex of island names with
+whitespace removed, as they are written to INFO
+"""
 
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
 
-            if len(rows) > 0:
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(
-                        collapseRefSeq("\t".join([str(x) for x in row[1 : len(row)]]))
-                    )
+def loadCpgIslandIndex(table="cpgIslandExt"):
+    def build():
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        cursor.execute("select chrom, chromStart, chromEnd, name from " + table + ";")
+        rows = [
+            (chrom, start, end, "".join(str(name).split()))
+            for chrom, start, end, name in cursor.fetchall()
+        ]
+        conn.close()
+        return IntervalIndex.build(rows)
 
-                fields[7] = fields[7] + ";" + ";".join(m)
-                if str(fields[7]).startswith(".;"):
-                    fields[7] = str(fields[7]).replace(".;", "", 1)
+    return reference.cached(f"cpgislands.{table}", build)
 
-                l = "\t".join([str(x) for x in fields])
-                fh_out.write(l + "\n")
 
-            if keep_going:
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
+"""First CpG island (in table order) containing pos, or None
+"""
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
+def cpgIslandAt(index, chr, pos):
+    islands = index.overlapping(chr, int(pos))
+    if len(islands) > 0:
+        return islands[0]
+    return None
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
 
-            if keep_going:
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
+"""Counts shared by the gene structure stages, which write them to
+.count.log in the same layout
+"""
 
-                if len(rows) > 0:
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(
-                            collapseRefSeq(
-                                "\t".join([str(x) for x in row[1 : len(row)]])
-                            )
-                        )
 
-                    fields[7] = fields[7] + ";" + ";".join(m)
-                    if str(fields[7]).startswith(".;"):
-                        fields[7] = str(fields[7]).replace(".;", "", 1)
+class GeneStructureStage(Stage):
+    def __init__(self, table="refGene", promoter_offset=500):
+        self.table = table
+        self.promoter_offset = promoter_offset
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
 
-                    l = "\t".join([str(x) for x in fields])
-                    fh_out.write(l + "\n")
+    def finish(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
 
-            if keep_going:
-                fh_out.write(line + "\n")
+        print(f"In interGenic {str(self.interGenic_count)}")
+        fh_log.write(f"In interGenic {str(self.interGenic_count)}\n")
 
-            vcf_linenum = vcf_linenum + 1
+        print(f"In CDS {str(self.cds_count)}")
+        fh_log.write(f"In CDS {str(self.cds_count)}\n")
 
-        else:
-            fh_out.write(line + "\n")
+        print(f"In '3 UTR {str(self.utr3_count)}")
+        fh_log.write(f"In '3 UTR {str(self.utr3_count)}\n")
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+        print(f"In '5 UTR {str(self.utr5_count)}")
+        fh_log.write(f"In '5 UTR {str(self.utr5_count)}\n")
 
+        print(f"In Intronic {str(self.intronic_count)}")
+        fh_log.write(f"In Intronic {str(self.intronic_count)}\n")
 
-"""Get information about location in gene structures
-"""
+        print(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}")
+        fh_log.write(f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n")
 
+        print(f"In Exonic {str(self.exonic_count)}")
+        fh_log.write(f"In Exonic {str(self.exonic_count)}\n")
 
-def getGenes(
-    vcf,
-    format="vcf",
-    table="refGene",
-    promoter_offset=500,
-    tmpextin=".2",
-    tmpextout=".3",
-    sep="\t",
-):
+        print(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}")
+        fh_log.write(f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n")
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
+        print(f"In Putative Promoter Region {str(self.promoter_count)}")
+        fh_log.write(f"In Putative Promoter Region {str(self.promoter_count)}\n")
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
+        self.close()
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
+"""Get information about location in gene structures
+"""
 
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '" AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
 
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
+class GeneStage(GeneStructureStage):
+    def __init__(self, table="refGene", promoter_offset=500, conn=None):
+        GeneStructureStage.__init__(self, table=table, promoter_offset=promoter_offset)
+        # transcripts whose promoter-extended span contains the variant
+        self.track = IntervalTrack(
+            table, start="txStart", end="txEnd", pad=promoter_offset
+        )
+        self.connect(conn)
+        self.cpg_index = loadCpgIslandIndex()
+
+    def apply(self, v, rows):
+        promoter_offset = self.promoter_offset
+        chr = v.chrom
+        pos = v.pos
+        islands = {}
+        info = []
+
+        if len(rows) > 0:
+            # location as classified by BigRefGene
+            positionType = v.info.get("positionType")
+            cnt = 1
+            for row in rows:
+                # count location
+                if positionType == "intron":
+                    self.intronic_count = self.intronic_count + 1
+                elif positionType == "non_coding_intron":
+                    self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+                elif positionType == "CDS":
+                    self.cds_count = self.cds_count + 1
+                elif positionType == "non_coding_exon":
+                    self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+                elif positionType == "utr5":
+                    self.utr5_count = self.utr5_count + 1
+                elif positionType == "utr3":
+                    self.utr3_count = self.utr3_count + 1
+
+                txtStart = int(row[4])
+                txtEnd = int(row[5])
+                cdsStart = int(row[6])
+                cdsEnd = int(row[7])
+                exonCount = int(row[8])
+                exonStarts = str(row[9].decode("utf-8"))
+                exonEnds = str(row[10].decode("utf-8"))
+                geneSymbol = str(row[12])
+                strand = str(row[3])
+
+                promoter_plus = txtStart - int(promoter_offset)
+                promoter_minus = txtEnd + int(promoter_offset)
+                region = ""
+                exons = []
+                exonsSt = exonStarts.split(",")
+                exonsEn = exonEnds.split(",")
+
+                if cdsStart == cdsEnd:
+                    for e in range(0, exonCount):
+                        if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                            exnum = e + 1
+                            if strand == "-":
+                                exnum = exonCount - e
+                            exons.append(
+                                "non_coding_exon="
+                                + "ex"
+                                + str(exnum)
+                                + "/"
+                                + str(exonCount)
+                            )
+                    if len(exons) > 0:
+                        region = ";".join(exons)
+                elif u.isBetween(pos, cdsStart, cdsEnd):
+                    for e in range(0, exonCount):
+                        if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
+                            exnum = e + 1
+                            if strand == "-":
+                                exnum = exonCount - e
+                            exons.append(
+                                "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
+                            )
+                            self.exonic_count = self.exonic_count + 1
+                    if len(exons) > 0:
+                        region = ";".join(exons)
 
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    # count location
-                    positionType = str(
-                        u.parse_field(info_field, "positionType", ";", "=")
-                    )
+                elif (
+                    u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")
+                ) or (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
+                    if (chr, pos) not in islands:
+                        islands[(chr, pos)] = cpgIslandAt(self.cpg_index, chr, pos)
+                    island = islands[(chr, pos)]
 
-                    if positionType == "intron":
-                        intronic_count = intronic_count + 1
-                    elif positionType == "non_coding_intron":
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif positionType == "CDS":
-                        cds_count = cds_count + 1
-                    elif positionType == "non_coding_exon":
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif positionType == "utr5":
-                        utr5_count = utr5_count + 1
-                    elif positionType == "utr3":
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
+                    if island is not None:
+                        region = "putativePromoterRegion=" + island
+                        self.promoter_count = self.promoter_count + 1
+
+                else:
                     region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-                    elif u.isBetween(pos, cdsStart, cdsEnd):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = ";".join(exons)
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name from "
-                            + 'cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=row,
+                            indices=indicesKnownGenes,
+                            region=region,
+                            cnt=cnt,
                         )
-                        cursor.execute(sql)
+                    )
 
-                        rows = cursor.fetchone()
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
+                cnt = cnt + 1
 
-                    cnt = cnt + 1
+            str_info = ";".join(info)
+            v.info.append(str_info)
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+        else:
+            v.info.append("positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
 
-            linenum = linenum + 1
+def getGenes(
+    vcf,
+    format="vcf",
+    table="refGene",
+    promoter_offset=500,
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+):
+    runStage(
+        GeneStage(table=table, promoter_offset=promoter_offset),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-        else:
-            fh_out.write(line + "\n")
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+"""A transcript of a gene table with its coordinates and exons parsed
+once, for classifying variants without going back to the table
+"""
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+class Transcript(object):
+    __slots__ = (
+        "row",
+        "strand",
+        "tx_start",
+        "tx_end",
+        "cds_start",
+        "cds_end",
+        "exon_starts",
+        "exon_ends",
+    )
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
+    def __init__(self, row):
+        self.row = row
+        self.strand = str(row[3])
+        self.tx_start = int(row[4])
+        self.tx_end = int(row[5])
+        self.cds_start = int(row[6])
+        self.cds_end = int(row[7])
+        exonCount = int(row[8])
+        exonStarts = str(row[9].decode("utf-8")).split(",")
+        exonEnds = str(row[10].decode("utf-8")).split(",")
+        self.exon_starts = array("q", [int(x) for x in exonStarts[:exonCount]])
+        self.exon_ends = array("q", [int(x) for x in exonEnds[:exonCount]])
+
+    """Exons overlapping [start, end] as "<label>=exN/M" in exon order
+    (numbered along the strand), and whether any base of [start, end]
+    falls between exons
+    """
+
+    def exons(self, start, end, label):
+        exonCount = len(self.exon_starts)
+        exons = []
+        covered = 0
+        for e in range(0, exonCount):
+            overlap = u.getOverlap(start, end, self.exon_starts[e], self.exon_ends[e])
+            if overlap > 0:
+                exnum = e + 1
+                if self.strand == "-":
+                    exnum = exonCount - e
+                exons.append(label + "=" + "ex" + str(exnum) + "/" + str(exonCount))
+                covered = covered + overlap
+        return exons, covered < end - start + 1
+
+
+"""Loads a gene table into an IntervalIndex of Transcripts over their
+promoter-extended spans, cached per process (and on disk) by the
+reference module
+"""
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+def loadTranscriptIndex(table="refGene", promoter_offset=500):
+    def build():
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        cursor.execute("select * from " + table + ";")
+        rows = [
+            (
+                row[2],
+                int(row[4]) - promoter_offset,
+                int(row[5]) + promoter_offset,
+                Transcript(row),
+            )
+            for row in cursor.fetchall()
+        ]
+        conn.close()
+        return IntervalIndex.build(rows)
+
+    return reference.cached(f"transcripts.{table}.{promoter_offset}", build)
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+"""Gene structure of indels, where bigRefGeneTable is not applicable
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+Each transcript whose promoter-extended span meets the variant is
+classified over the variant's whole span, POS to end, from the parsed
+transcript index and the CpG island index (no queries per variant).
+The span is split into the parts of the transcript it touches: UTRs
+and CDS (positionType, comma-separated when there are several), the
+exons it overlaps and whether it reaches an intron, in the UTRs as in
+the CDS, and a putative promoter when it meets a CpG island upstream of
+the transcript. A single-base variant gets one positionType and either
+an exon or the intron, as getExonsEtAl always meant to give it.
+"""
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+class ExonsStage(GeneStructureStage):
+    def __init__(self, table="refGene", promoter_offset=500):
+        GeneStructureStage.__init__(self, table=table, promoter_offset=promoter_offset)
+        self.index = loadTranscriptIndex(table, promoter_offset)
+        self.cpg_index = loadCpgIslandIndex()
+
+    def lookup_many(self, variants):
+        return self.index.overlapping_spans([(v.chrom, v.pos, v.end) for v in variants])
+
+    def lookup(self, v):
+        return self.index.overlapping(v.chrom, v.pos, v.end)
+
+    """Parts of t that [start, end] falls in, as an INFO region (empty if
+    none), counting them
+    """
+
+    def classify(self, t, chr, start, end):
+        parts = []
+        types = []
+
+        # clipped to the transcript; the promoter is handled below
+        lo = max(start, t.tx_start)
+        hi = min(end, t.tx_end)
+        if lo <= hi and t.cds_start == t.cds_end:
+            exons, intron = t.exons(lo, hi, "non_coding_exon")
+            if len(exons) > 0:
+                types.append("non_coding_exon")
+                parts.extend(exons)
+                self.non_coding_exonic_count = self.non_coding_exonic_count + len(exons)
+            if intron:
+                types.append("non_coding_intron")
+                self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+
+        elif lo <= hi:
+            # UTR before cdsStart, CDS, UTR after cdsEnd; boundaries are CDS
+            left = "utr5" if t.strand == "+" else "utr3"
+            right = "utr3" if t.strand == "+" else "utr5"
+            if lo < t.cds_start:
+                types.append(left)
+            if u.isOverlap(lo, hi, t.cds_start, t.cds_end):
+                types.append("CDS")
+                self.cds_count = self.cds_count + 1
+            if hi > t.cds_end:
+                types.append(right)
+            for positionType in types:
+                if positionType == "utr5":
+                    self.utr5_count = self.utr5_count + 1
+                elif positionType == "utr3":
+                    self.utr3_count = self.utr3_count + 1
+
+            # exons and introns over the whole span, UTRs included
+            exons, intron = t.exons(lo, hi, "exon")
+            parts.extend(exons)
+            self.exonic_count = self.exonic_count + len(exons)
+            if intron:
+                parts.append("intron")
+                self.intronic_count = self.intronic_count + 1
+
+        if t.strand == "+":
+            promoter = (t.tx_start - self.promoter_offset, t.tx_start - 1)
+        else:
+            promoter = (t.tx_end + 1, t.tx_end + self.promoter_offset)
+        lo = max(start, promoter[0])
+        hi = min(end, promoter[1])
+        if lo <= hi:
+            islands = self.cpg_index.overlapping(chr, lo, hi)
+            if len(islands) > 0:
+                parts.append("putativePromoterRegion=" + islands[0])
+                self.promoter_count = self.promoter_count + 1
+
+        if len(types) > 0:
+            parts.insert(0, "positionType=" + ",".join(types))
+        return ";".join(parts)
+
+    def apply(self, v, transcripts):
+        info = []
+        if len(transcripts) > 0:
+            cnt = 1
+            for t in transcripts:
+                region = self.classify(t, v.chrom, v.pos, v.end)
+                if region != "":
+                    info.append(
+                        collapseGeneNames(
+                            row=t.row,
+                            indices=indicesKnownGenes,
+                            region=region,
+                            cnt=cnt,
+                        )
+                    )
 
+                cnt = cnt + 1
 
-"""Method used in INDELS, where bigRefGeneTable is not applicable
-"""
+            str_info = ";".join(info)
+            v.info.append(str_info)
+
+        else:
+            v.info.append("positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
 
 
 def getExonsEtAl(
@@ -644,950 +1070,693 @@ def getExonsEtAl(
     tmpextout=".3",
     sep="\t",
 ):
+    runStage(
+        ExonsStage(table=table, promoter_offset=promoter_offset),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
+"""Stages that count matches per table and log them as
+"In <table>: <matches> in <variants> variants"
+"""
 
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, "name", ";", "="))
+class OverlapStage(Stage):
+    spans_supported = True
 
-            sql = (
-                "select * from "
-                + table
-                + ' where chrom="'
-                + str(chr)
-                + '"   AND (txStart - '
-                + str(promoter_offset)
-                + ") <= "
-                + str(pos)
-                + " AND "
-                + str(pos)
-                + " <= (txEnd + "
-                + str(promoter_offset)
-                + ");"
-            )
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if len(rows) > 0:
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts = str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(",")
-                    exonsEn = exonEnds.split(",")
-
-                    if cdsStart == cdsEnd:
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "non_coding_exon="
-                                    + "ex"
-                                    + str(exnum)
-                                    + "/"
-                                    + str(exonCount)
-                                )
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=non_coding_exon;" + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = "positionType=non_coding_intron"
-
-                    elif u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if strand == "-":
-                                    exnum = exonCount - e
-                                exons.append(
-                                    "exon=" + "ex" + str(exnum) + "/" + str(exonCount)
-                                )
-                                exonic_count = exonic_count + 1
-                        if len(exons) > 0:
-                            region = "positionType=CDS;" + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = "positionType=CDS;" + "intron"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "+")
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "+"
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, cdsEnd, txtEnd) and (cdsStart < cdsEnd)(
-                        strand == "-"
-                    ):
-                        utr5_count = utr5_count + 1
-                        region = "positionType=utr5"
-
-                    elif (
-                        u.isBetween(pos, txtStart, cdsStart)
-                        and (cdsStart < cdsEnd)
-                        and (strand == "-")
-                    ):
-                        utr3_count = utr3_count + 1
-                        region = "positionType=utr3"
-
-                    elif u.isBetween(pos, promoter_plus, txtStart) and (strand == "+"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+    def __init__(self, table, label=None, connect=True, conn=None):
+        self.table = table
+        self.label = table if label is None else label
+        self.var_count = 0
+        self.line_count = 0
+        if connect:
+            self.connect(conn)
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    elif u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"):
-                        sql = (
-                            "select chrom, chromStart, chromEnd, name "
-                            + 'from cpgIslandExt where chrom="'
-                            + str(chr)
-                            + '" AND (chromStart <= '
-                            + str(pos)
-                            + " AND "
-                            + str(pos)
-                            + " <= chromEnd);"
-                        )
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
+    def finish(self, fh_log):
+        fh_log.write(
+            f"In {str(self.label)}: {str(self.var_count)} in "
+            + f"{str(self.line_count)} variants\n"
+        )
+        self.close()
 
-                        if rows is not None:
-                            region = "putativePromoterRegion=" + "".join(
-                                str(rows[3]).split()
-                            )
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ""
-
-                    if region != "":
-                        info.append(
-                            collapseGeneNames(
-                                row=row,
-                                indices=indicesKnownGenes,
-                                region=region,
-                                cnt=cnt,
-                            )
-                        )
 
-                    cnt = cnt + 1
+"""Chromosomes with a tfbsConsSites<chrom> table
+"""
 
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ";" + str_info
-                fh_out.write("\t".join(fields) + "\n")
+TFBS_CHROMS = frozenset([str(c) for c in range(1, 23)] + ["X", "Y"])
 
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write("\t".join(fields) + "\n")
-                interGenic_count = interGenic_count + 1
 
-            linenum = linenum + 1
+"""One TFBS index over all per-chromosome tfbsConsSites tables
 
-        else:
-            fh_out.write(line + "\n")
+Intervals are keyed by the chromosome in the table name (each table is
+only ever queried for its own chromosome) and stored with their INFO
+entry already rendered.
+"""
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+def loadTfbsIndex(table="tfbsConsSites"):
+    def build():
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        rows = []
+        for chrIndex in sorted(TFBS_CHROMS):
+            cursor.execute(
+                "select chrom, chromStart, chromEnd, name from "
+                + table
+                + chrIndex
+                + ";"
+            )
+            for row in cursor.fetchall():
+                t = (
+                    str(row[3])
+                    + "."
+                    + str(row[0])
+                    + "."
+                    + str(row[1])
+                    + "."
+                    + str(row[2])
+                )
+                rows.append((chrIndex, row[1], row[2], "tfbsRegion" + "=" + t.strip()))
+        conn.close()
+        return IntervalIndex.build(rows)
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+    return reference.cached(f"tfbs.{table}", build)
 
-    print(f"In '3 UTR {str(utr3_count)}")
-    fh_log.write(f"In '3 UTR {str(utr3_count)}\n")
 
-    print(f"In '5 UTR {str(utr5_count)}")
-    fh_log.write(f"In '5 UTR {str(utr5_count)}\n")
+"""Overlap with tfbsConsSites
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic " + str(intronic_count) + "\n")
+Each chunk of variants is looked up against the TFBS index as one batch
+rather than one query per variant.
+"""
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+class TfbsStage(OverlapStage):
+    def __init__(self, table="tfbsConsSites"):
+        OverlapStage.__init__(self, table, connect=False)
+        self.index = loadTfbsIndex(table)
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+    def lookup_many(self, variants):
+        # chromosomes not on the list have no table to look in
+        batch = [n for n, v in enumerate(variants) if v.bare_chrom in TFBS_CHROMS]
+        queries = [
+            (variants[n].bare_chrom, variants[n].pos, self.end_of(variants[n]))
+            for n in batch
+        ]
+        results = [[] for _ in variants]
+        for n, records in zip(batch, self.index.overlapping_spans(queries)):
+            results[n] = records
+        return results
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    def apply(self, v, records):
+        if len(records) > 0:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(records)
+            v.info.add(";".join(records))
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+
+def addOverlapWithTfbsConsSites(
+    vcf,
+    format="vcf",
+    table="tfbsConsSites",
+    tmpextin=".2",
+    tmpextout=".3",
+    sep="\t",
+    batch_size=CHUNK_SIZE,
+):
+    runStage(
+        TfbsStage(table=table),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+        chunk_size=batch_size,
+    )
 
 
-"""Overlap with tfbsConsSites
+"""Overlap with GadAll table
 """
 
 
-def addOverlapWithTfbsConsSites(
-    vcf, format="vcf", table="tfbsConsSites", tmpextin=".2", tmpextout=".3", sep="\t"
-):
+class GadAllStage(OverlapStage):
+    def __init__(self, table="gadAll", conn=None):
+        OverlapStage.__init__(self, table, conn=conn)
+        # For some reason this table has no "chr" preceeding number
+        self.track = IntervalTrack(table, chrom="chromosome", bare=True)
 
-    allowed_chrom = [
-        "1",
-        "2",
-        "3",
-        "4",
-        "5",
-        "6",
-        "7",
-        "8",
-        "9",
-        "10",
-        "11",
-        "12",
-        "13",
-        "14",
-        "15",
-        "16",
-        "17",
-        "18",
-        "19",
-        "20",
-        "21",
-        "22",
-        "X",
-        "Y",
-    ]
+    def apply(self, v, rows):
+        table = self.table
+        records = []
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]))
+                    records.append(str(table) + "=" + str(row[3]))
+            v.info.add(";".join(records))
+            # annotated lines have always been written this way
+            v.sep = "\t "
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def clear(self, v):
+        v.sep = "\t"
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
+def addOverlapWithGadAll(
+    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
+):
+    runStage(
+        GadAllStage(table=table),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if line.startswith("##"):
-            fh_out.write(line + "\n")
 
-        # header line
-        elif line.startswith("#CHROM") or line.startswith("CHROM"):
-            fh_out.write(line + "\n")
+""" Overlap with gwasCatalog table """
 
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex = chr.replace("chr", "")
-
-            if chrIndex in allowed_chrom:
-                isOverlap = False
-                sql = (
-                    "select chrom, chromStart, chromEnd, name "
-                    + "from tfbsConsSites"
-                    + chrIndex
-                    + " where  chromStart <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd;"
+
+class GwasCatalogStage(OverlapStage):
+    def __init__(self, table="gwasCatalog", conn=None):
+        OverlapStage.__init__(self, table, conn=conn)
+        self.track = IntervalTrack(table, start="chromEnd", end="chromEnd")
+
+    def apply(self, v, rows):
+        table = self.table
+        records = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                records.append(
+                    str(table)
+                    + "="
+                    + str("pubMedID")
+                    + "="
+                    + str(row[5])
+                    + ",trait="
+                    + str(row[10])
                 )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = (
-                            str(row[3])
-                            + "."
-                            + str(row[0])
-                            + "."
-                            + str(row[1])
-                            + "."
-                            + str(row[2])
-                        )
-                        t = t.strip()
-                        records.append("tfbsRegion" + "=" + t)
-                        records_count = records_count + 1
+            v.info.add(";".join(records))
 
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
 
-                    fh_out.write("\t".join(fields) + "\n")
+def addOverlapWithGwasCatalog(
+    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
+):
+    runStage(
+        GwasCatalogStage(table=table),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-                else:  # chrom is not on the list
-                    fh_out.write(line + "\n")
 
-            else:  # chrom is not on the list
-                fh_out.write(line + "\n")
+"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""
 
-        linenum = linenum + 1
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+class HugoStage(OverlapStage):
+    def __init__(self, table="hugo", conn=None):
+        OverlapStage.__init__(self, table, conn=conn)
+        self.track = IntervalTrack(table)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def apply(self, v, rows):
+        records = []
 
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            r_tmp = []
+            for row in rows:
+                self.var_count = self.var_count + 1
+                t = str(str(row[5]) + "," + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append("HGNC_GeneAnnotation" + "=" + t)
 
-"""Overlap with GadAll table
-"""
+            records_str = ",".join(records).replace(";", ",")
+            v.info.add(records_str)
 
 
-def addOverlapWithGadAll(
-    vcf, format="vcf", table="gadAll", tmpextin="", tmpextout=".1", sep="\t"
+def addOverlapWitHUGOGeneNomenclature(
+    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
 ):
+    runStage(
+        HugoStage(table=table),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""Overlap with segdup regions genomicSuperDups
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+In interval mode a variant gets every segdup its span overlaps, with
+otherChrom, otherStart and otherEnd listed in row order, and variants
+longer than one base also get the percent of their span inside each of
+them, as genomicSuperDupsOverlap. The percents are computed for the
+whole chunk in lookup_many.
+"""
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
+
+class GenomicSuperDupsStage(OverlapStage):
+    def __init__(self, table="genomicSuperDups", conn=None):
+        OverlapStage.__init__(self, table, conn=conn)
+        self.track = IntervalTrack(table, first=True)
+
+    def set_spans(self, spans=True):
+        OverlapStage.set_spans(self, spans)
+        self.track.first = not self.spans
+
+    def lookup_many(self, variants):
+        results = OverlapStage.lookup_many(self, variants)
+        if not self.spans:
+            return results
+
+        pairs = []
+        for v, rows in zip(variants, results):
+            if v.end > v.pos:
+                pairs.extend([(v.pos, v.end, int(r[2]), int(r[3])) for r in rows])
+        percents = iter(overlap_percents(pairs))
+
+        spans = []
+        for v, rows in zip(variants, results):
+            if len(rows) == 0:
+                spans.append(None)
+            elif v.end > v.pos:
+                spans.append((rows, [next(percents) for _ in rows]))
+            else:
+                spans.append((rows, None))
+        return spans
+
+    def apply(self, v, rows):
+        table = self.table
+
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            isOverlap = True
+            if self.spans:
+                rows, percents = rows
             else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chromosome="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
+                rows, percents = [rows], None
+            otherChrom = ",".join([str(r[7]) for r in rows])
+            otherStart = ",".join([str(r[8]) for r in rows])
+            otherEnd = ",".join([str(r[9]) for r in rows])
+            v.info.append(
+                str(table)
+                + "="
+                + str(isOverlap)
+                + ";"
+                + "otherChrom="
+                + otherChrom
+                + ";otherStart="
+                + otherStart
+                + ";otherEnd="
+                + otherEnd
+            )
+            if percents is not None:
+                v.info.append(
+                    str(table) + "Overlap=" + ",".join([str(p) for p in percents])
                 )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]))
-                            records.append(str(table) + "=" + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t ".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
+def addOverlapWithGenomicSuperDups(
+    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
+):
+    runStage(
+        GenomicSuperDupsStage(table=table),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
     )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
 
+"""Searches Genes Databases and returns Genes/Cytobands 
+   with which SNP or INDEL overlaps
+"""
 
-""" Overlap with gwasCatalog table """
 
+class RefGeneOverlapStage(OverlapStage):
+    def __init__(self, table="refGene", conn=None):
+        OverlapStage.__init__(self, table, conn=conn)
+        self.track = IntervalTrack(table, start="txStart", end="txEnd")
+
+    def apply(self, v, rows):
+        colindex = 1
+        colindex2 = 12
+        name = "name"
+        name2 = "name2"
+        overlapsWith = []
+
+        if len(rows) > 0:
+            self.line_count = self.line_count + 1
+            for row in rows:
+                self.var_count = self.var_count + 1
+                overlapsWith.append(
+                    name2
+                    + "="
+                    + str(row[colindex2])
+                    + ";"
+                    + name
+                    + "="
+                    + str(row[colindex])
+                )
 
-def addOverlapWithGwasCatalog(
-    vcf, format="vcf", table="gwasCatalog", tmpextin="", tmpextout=".1", sep="\t"
-):
+            genes = ";".join([str(x) for x in overlapsWith])
+            v.info.add(str(genes))
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+def addOverlapWithRefGene(
+    vcf, format="vcf", table="refGene", tmpextin="", tmpextout=".1", sep="\t"
+):
+    runStage(
+        RefGeneOverlapStage(table=table),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND chromEnd = '
-                    + str(pos)
-                    + ";"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(
-                            str(table)
-                            + "="
-                            + str("pubMedID")
-                            + "="
-                            + str(row[5])
-                            + ",trait="
-                            + str(row[10])
-                        )
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + ";".join(records)
-                    else:
-                        fields[7] = fields[7] + ";" + ";".join(records)
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+"""Column names of a reference table, cached per reference version
+"""
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+def tableColumns(cursor, table):
+    def build():
+        cursor.execute("select * from " + table + " limit 0;")
+        cursor.fetchall()
+        return [str(d[0]) for d in cursor.description]
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    return reference.cached(f"columns.{table}", build)
 
 
-"""Overlap with HUGO Gene Nomenclature Committee (HGNC) table
+"""UCSC bins a range query on table can be restricted to
+
+For tables with a bin column, returns the bins of rows that can satisfy
+start <= chromEnd and chromStart <= end (closed, as the queries
+compare), so MySQL can use the (chrom, bin) index instead of a range
+scan. Returns None for tables without a bin column.
 """
 
 
-def addOverlapWitHUGOGeneNomenclature(
-    vcf, format="vcf", table="hugo", tmpextin="", tmpextout=".1", sep="\t"
-):
+def tableBins(cursor, table, start, end):
+    if "bin" not in tableColumns(cursor, table):
+        return None
+    return u.binsOverlappingRange(start - 1, end + 1)
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""' AND bin IN (%s, ...)' with one placeholder per bin, or an empty
+string when bins is None
+"""
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + "," + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append("HGNC_GeneAnnotation" + "=" + t)
-                        records_count = records_count + 1
-
-                    records_str = ",".join(records).replace(";", ",")
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + records_str
-                    else:
-                        fields[7] = fields[7] + ";" + records_str
-                    fh_out.write("\t".join(fields) + "\n")
-                else:
-                    fh_out.write(line + "\n")
+def binClause(bins):
+    if bins is None:
+        return ""
+    return " AND bin IN (" + ", ".join(["%s"] * len(bins)) + ")"
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+"""A reference table whose rows cover intervals of the genome
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+A variant matches the rows whose [start - pad, end + pad] (columns,
+closed, as the queries compare) contains its position on chrom, which
+holds bare chromosome names for tables without the "chr" prefix. With
+first only the first matching row is used, otherwise all of them in
+table order. With spans, rows match when they overlap any base from
+the variant's POS to its end instead. queries counts the statements
+run for lookups.
+"""
 
 
-"""Overlap with segdup regions genomicSuperDups
+class IntervalTrack(object):
+    def __init__(
+        self,
+        table,
+        chrom="chrom",
+        start="chromStart",
+        end="chromEnd",
+        bare=False,
+        pad=0,
+        first=False,
+    ):
+        self.table = table
+        self.chrom = chrom
+        self.start = start
+        self.end = end
+        self.bare = bare
+        self.pad = pad
+        self.first = first
+        self.spans = False
+        self.queries = 0
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def chrom_of(self, v):
+        return v.bare_chrom if self.bare else v.chrom
+
+    def end_of(self, v):
+        return v.end if self.spans else v.pos
+
+    """Parameterized query text for a bin list of nbins (None: no bin
+    column), built once per track and reused for every lookup
+    """
+
+    def statement(self, nbins):
+        sql = self.statements.get(nbins)
+        if sql is None:
+            lo = self.start
+            hi = self.end
+            if self.pad:
+                lo = "(" + self.start + " - " + str(self.pad) + ")"
+                hi = "(" + self.end + " + " + str(self.pad) + ")"
+            sql = (
+                "select * from "
+                + self.table
+                + " where "
+                + self.chrom
+                + " = %s AND "
+                + lo
+                + " <= %s AND %s <= "
+                + hi
+                + binClause(None if nbins is None else [None] * nbins)
+                + ";"
+            )
+            self.statements[nbins] = sql
+        return sql
+
+    """Runs the query for rows overlapping [start, end] on chrom
+    """
+
+    def query(self, cursor, chrom, start, end):
+        bins = tableBins(cursor, self.table, start - self.pad, end + self.pad)
+        params = [chrom, end, start]
+        if bins is not None:
+            params.extend(bins)
+        cursor.execute(self.statement(None if bins is None else len(bins)), params)
+        with self.lock:
+            self.queries = self.queries + 1
+
+    def result(self, rows):
+        if self.first:
+            return rows[0] if len(rows) > 0 else None
+        return tuple(rows)
+
+    def intervals(self, columns, rows):
+        c = columns.index(self.chrom)
+        s = columns.index(self.start)
+        e = columns.index(self.end)
+        return [
+            (row[c], int(row[s]) - self.pad, int(row[e]) + self.pad, row)
+            for row in rows
+        ]
+
+    def point(self, cursor, v):
+        self.query(cursor, self.chrom_of(v), v.pos, self.end_of(v))
+        if self.first:
+            return cursor.fetchone()
+        return cursor.fetchall()
+
+    """Answers variants with one query per window: positions on a
+    chromosome are sorted and grouped into runs starting at most size
+    bases apart, and each run's rows are matched to its variants in
+    memory
+    """
+
+    def windowed(self, cursor, variants, size, engine=None):
+        results = [self.result(())] * len(variants)
+        by_chrom = {}
+        for n, v in enumerate(variants):
+            by_chrom.setdefault(self.chrom_of(v), []).append((v.pos, self.end_of(v), n))
+
+        windows = []
+        for chrom, positions in by_chrom.items():
+            positions.sort()
+            i = 0
+            while i < len(positions):
+                j = i + 1
+                while j < len(positions) and positions[j][0] - positions[i][0] <= size:
+                    j = j + 1
+                windows.append((chrom, positions[i:j]))
+                i = j
+
+        if engine is None:
+            indexes = [self.window_index(cursor, window) for window in windows]
+        else:
+            indexes = engine.map(self.window_index, windows)
+        for (chrom, positions), index in zip(windows, indexes):
+            rows = index.overlapping_spans([(chrom, p, e) for p, e, _ in positions])
+            for (_, _, n), matches in zip(positions, rows):
+                results[n] = self.result(matches)
+        return results
+
+    def window_index(self, cursor, window):
+        chrom, positions = window
+        self.query(cursor, chrom, positions[0][0], max([e for _, e, _ in positions]))
+        rows = cursor.fetchall()
+        columns = tableColumns(cursor, self.table)
+        return IntervalIndex.build(self.intervals(columns, rows))
+
+    def preloaded(self, variants):
+        index = loadTrackIndex(self)
+        queries = [(self.chrom_of(v), v.pos, self.end_of(v)) for v in variants]
+        return [self.result(rows) for rows in index.overlapping_spans(queries)]
+
+
+"""Loads a whole IntervalTrack into an IntervalIndex of its rows, cached
+per process (and on disk) by the reference module
 """
 
 
-def addOverlapWithGenomicSuperDups(
-    vcf, format="vcf", table="genomicSuperDups", tmpextin="", tmpextout=".1", sep="\t"
-):
+def loadTrackIndex(track):
+    def build():
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        cursor.execute("select * from " + track.table + ";")
+        columns = [str(d[0]) for d in cursor.description]
+        index = IntervalIndex.build(track.intervals(columns, cursor.fetchall()))
+        conn.close()
+        track.queries = track.queries + 1
+        return index
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    return reference.cached(trackIndexName(track), build)
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+def trackIndexName(track):
+    return f"track.{track.table}.{track.chrom}.{track.start}.{track.end}.{track.pad}"
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ""
-                otherStart = ""
-                otherEnd = ""
-                l = str(isOverlap)
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = (
-                        fields[7]
-                        + ";"
-                        + str(table)
-                        + "="
-                        + str(isOverlap)
-                        + ";"
-                        + "otherChrom="
-                        + str(otherChrom)
-                        + ";otherStart="
-                        + str(otherStart)
-                        + ";otherEnd="
-                        + str(otherEnd)
-                    )
 
-                fh_out.write("\t".join(fields) + "\n")
+"""Loads a whole interval table into an IntervalIndex
 
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+Values are str(row[colindex]) in table order. The index is cached per
+process (and on disk) by the reference module, keyed on the arguments.
+"""
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def loadIntervalIndex(table, startName, endName, colindex):
+    def build():
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        cursor.execute("select * from " + table + ";")
+        names = [str(d[0]) for d in cursor.description]
+        chrom_ind = names.index("chrom")
+        start_ind = names.index(startName)
+        end_ind = names.index(endName)
+        rows = [
+            (row[chrom_ind], row[start_ind], row[end_ind], str(row[colindex]))
+            for row in cursor.fetchall()
+        ]
+        conn.close()
+        return IntervalIndex.build(rows)
+
+    return reference.cached(
+        f"intervals.{table}.{startName}.{endName}.{colindex}", build
+    )
 
 
-"""Searches Genes Databases and returns Genes/Cytobands 
-   with which SNP or INDEL overlaps
+"""Method to find overlap with Cytoband table
 """
 
 
-def addOverlapWithRefGene(
-    vcf, format="vcf", table="refGene", tmpextin="", tmpextout=".1", sep="\t"
-):
+class CytobandStage(OverlapStage):
+    def __init__(self, table="cytoBand"):
+        OverlapStage.__init__(self, table, connect=False)
+        colindex = 12
+        startName = "txStart"
+        endName = "txEnd"
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 1
-    colindex2 = 12
-    name = "name"
-    name2 = "name2"
-    startName = "txStart"
-    endName = "txEnd"
+        if table == "cytoBand":
+            colindex = 3
+            startName = "chromStart"
+            endName = "chromEnd"
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(
-                            name2
-                            + "="
-                            + str(row[colindex2])
-                            + ";"
-                            + name
-                            + "="
-                            + str(row[colindex])
-                        )
-
-                    genes = ";".join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ";" + str(genes)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+        self.index = loadIntervalIndex(table, startName, endName, colindex)
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+    def lookup(self, v):
+        return self.index.overlapping(v.chrom, v.pos)
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+    def lookup_many(self, variants):
+        return self.index.overlapping_spans(
+            [(v.chrom, v.pos, self.end_of(v)) for v in variants]
+        )
 
-
-"""Method to find overlap with Cytoband table
-"""
+    def apply(self, v, overlapsWith):
+        if len(overlapsWith) > 0:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(overlapsWith)
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ";".join([str(x) for x in overlapsWith])
+            v.info.add(str(self.table) + "=" + str(cytoband))
 
 
 def addOverlapWithCytoband(
     vcf, format="vcf", table="cytoBand", tmpextin="", tmpextout=".1", sep="\t"
 ):
+    runStage(
+        CytobandStage(table=table),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = "txStart"
-    endName = "txEnd"
-
-    if table == "cytoBand":
-        colindex = 3
-        startName = "chromStart"
-        endName = "chromEnd"
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND ('
-                    + startName
-                    + " <= "
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= "
-                    + endName
-                    + ");"
-                )
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if len(rows) > 0:
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ";".join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(cytoband)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+"""Loads a CNV-style table (chrom, chromStart, chromEnd) into a
+CoverageMask, cached per process by the reference module
+"""
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def loadCoverageMask(table):
+    def build():
+        conn = u.db_connect()
+        cursor = conn.cursor()
+        cursor.execute("select chrom, chromStart, chromEnd from " + table + ";")
+        mask = CoverageMask.build(cursor.fetchall())
+        conn.close()
+        print(
+            f"{table}: {mask.source_rows} intervals merged into {mask.size} runs "
+            f"({mask.nbytes() // 1024} KB)"
+        )
+        return mask
+
+    return reference.cached(f"coverage.{table}", build)
 
 
 """Method to find overlap with CNV tables
@@ -1597,161 +1766,134 @@ def addOverlapWithCytoband(
 def addOverlapWithCnvDatabase(
     vcf, format="vcf", table="dgv_Cnv", tmpextin="", tmpextout=".1", sep="\t"
 ):
+    addOverlapWithCnvDatabases(
+        vcf,
+        format=format,
+        tables=[table],
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""CNV tables looked up by default, in INFO order
+"""
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
+CNV_TABLES = ("dgv_Cnv", "abParts_IG_T_CelReceptors", "mcCarroll_Cnv", "conrad_Cnv")
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + "=" + str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ";" + str(table) + "=" + str(isOverlap)
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
 
-    fh_log.write(
-        f"In {str(table)}: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
+"""Method to find overlap with several CNV tables in one pass
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+Each table only needs to know whether any interval covers the variant,
+so all of them are answered from coverage masks while the file is read
+once. INFO flags and log lines are added in the order of tables, exactly
+as running addOverlapWithCnvDatabase once per table would.
 
-
-"""Method to find overlap with targetScanS tables
+In interval mode a variant is flagged when any part of its span is
+covered, and variants longer than one base also get the percent of the
+span each table covers, as <table>Overlap.
 """
 
 
-def addOverlapWithMiRNA(
-    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
+class CnvStage(Stage):
+    spans_supported = True
+
+    def __init__(self, tables=CNV_TABLES):
+        self.tables = tables
+        self.var_counts = [0] * len(tables)
+        self.masks = [loadCoverageMask(table) for table in tables]
+        isOverlap = True
+        self.flags = [str(table) + "=" + str(isOverlap) for table in tables]
+
+    def lookup(self, v):
+        return tuple([mask.covers(v.chrom, v.pos) for mask in self.masks])
+
+    def lookup_many(self, variants):
+        if not self.spans:
+            return [self.lookup(v) for v in variants]
+        queries = [(v.chrom, v.pos, v.end) for v in variants]
+        return list(zip(*[mask.coverage_many(queries) for mask in self.masks]))
+
+    def apply(self, v, covered):
+        for i, isCovered in enumerate(covered):
+            if self.spans:
+                isCovered, percent = isCovered
+            if isCovered:
+                self.var_counts[i] = self.var_counts[i] + 1
+                if v.end > v.pos and self.spans:
+                    v.info.add(
+                        self.flags[i]
+                        + ";"
+                        + str(self.tables[i])
+                        + "Overlap="
+                        + str(percent)
+                    )
+                else:
+                    v.info.add(self.flags[i])
+
+    def finish(self, fh_log):
+        for i, table in enumerate(self.tables):
+            fh_log.write(
+                f"In {str(table)}: {str(self.var_counts[i])} in "
+                + f"{str(self.var_counts[i])} variants\n"
+            )
+
+
+def addOverlapWithCnvDatabases(
+    vcf,
+    format="vcf",
+    tables=CNV_TABLES,
+    tmpextin="",
+    tmpextout=".1",
+    sep="\t",
 ):
+    runStage(
+        CnvStage(tables=tables),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+"""Method to find overlap with targetScanS tables
+"""
 
-    logcountfile = basefile + ".count.log"
-    fh_log = open(logcountfile, "a")
-    var_count = 0
-    line_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            # header line
-            if line.startswith("CHROM") or line.startswith("#CHROM"):
-                fh_out.write(line + "\n")
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = (
-                    "select * from "
-                    + table
-                    + ' where chrom="'
-                    + str(chr)
-                    + '" AND (chromStart <= '
-                    + str(pos)
-                    + " AND "
-                    + str(pos)
-                    + " <= chromEnd);"
-                )
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = (
-                        str(rows[4])
-                        + ","
-                        + str(rows[1])
-                        + "_"
-                        + str(rows[2])
-                        + "_"
-                        + str(rows[3])
-                    )
-                    t = "miRNAsites=" + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ";" + t
-                fh_out.write("\t".join(fields) + "\n")
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + "\n")
+class MiRNAStage(OverlapStage):
+    def __init__(self, table="targetScanS", conn=None):
+        OverlapStage.__init__(self, table, label="miRNAsites", conn=conn)
+        self.track = IntervalTrack(table, first=True)
+
+    def apply(self, v, rows):
+        if rows is not None:
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + 1
+            t = (
+                str(rows[4])
+                + ","
+                + str(rows[1])
+                + "_"
+                + str(rows[2])
+                + "_"
+                + str(rows[3])
+            )
+            t = "miRNAsites=" + t.strip()
+            v.info.add(t)
 
-    fh_log.write(
-        f"In miRNAsites: {str(var_count)} in " + f"{str(line_count)} variants\n"
-    )
-    fh_log.close()
 
-    conn.close()
-    fh.close()
-    fh_out.close()
+def addOverlapWithMiRNA(
+    vcf, format="vcf", table="targetScanS", tmpextin="", tmpextout=".1", sep="\t"
+):
+    runStage(
+        MiRNAStage(table=table),
+        vcf,
+        format=format,
+        tmpextin=tmpextin,
+        tmpextout=tmpextout,
+        sep=sep,
+    )
 
 
 ### EOF
@@ -15,6 +15,14 @@ import time
 from subprocess import Popen, PIPE
 from botocore.exceptions import ClientError
 
+# Add the parent directory to sys.path
+current_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.dirname(current_dir)
+sys.path.append(parent_dir)
+
+# Import job tracing helpers from util
+from util import job_trace
+
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
 
@@ -31,20 +39,32 @@ s3 = boto3.client('s3', region_name=config.get('aws', 'AwsRegionName'))
 dynamodb = boto3.resource('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
 table = dynamodb.Table(config.get('gas', 'AnnotationsTable'))
 
-def update_dynamodb(job_id):
+def update_dynamodb(job_id, trace_hops=None):
+        update_expression = 'SET job_status = :newStatus'
+        attribute_values = {
+            ':newStatus': 'RUNNING',
+            ':expectedStatus': 'PENDING'
+        }
+        extra_args = {}
+
+        # Record the dequeue and download hops in the same update
+        if trace_hops:
+            clauses, attribute_names, trace_values = job_trace.hop_updates(trace_hops)
+            update_expression = update_expression + ', ' + ', '.join(clauses)
+            attribute_values.update(trace_values)
+            extra_args['ExpressionAttributeNames'] = attribute_names
+
     # To catch error while updating the table
         try:
             # Update job status to "RUNNING" only when the current status is "PENDING" in DynamoDB
             # https://stackoverflow.com/questions/34447304/example-of-update-item-in-dynamodb-boto3
             response = table.update_item(
                 Key={'job_id': job_id},
-                UpdateExpression='SET job_status = :newStatus',
+                UpdateExpression=update_expression,
                 ConditionExpression='job_status = :expectedStatus',
-                ExpressionAttributeValues={
-                    ':newStatus': 'RUNNING',
-                    ':expectedStatus': 'PENDING'
-                },
-                ReturnValues='ALL_NEW'
+                ExpressionAttributeValues=attribute_values,
+                ReturnValues='ALL_NEW',
+                **extra_args
             )
         except ClientError as e:
             error_code = e.response['Error']['Code']
@@ -83,10 +103,12 @@ def handle_requests_queue(sqs=None):
         for message in messages['Messages']:
 
             successful_download = False  # Flag to track download success
+            dequeued = job_trace.now_ms()
 
             # Extracting job parameters from each message
             body = json.loads(message['Body'])
             job_details = json.loads(body['Message'])
+            trace = job_details.get('trace')
 
             job_id = job_details['job_id']
             s3_key_input_file = job_details['s3_key_input_file']
@@ -105,6 +127,7 @@ def handle_requests_queue(sqs=None):
             try:
                 s3.download_file(config.get('s3', 'InputsBucketName'), s3_key_input_file, file_path)
                 successful_download = True
+                download_done = job_trace.now_ms()
 
             except ClientError as e:
                 print(f"Client error: {e}")
@@ -117,13 +140,41 @@ def handle_requests_queue(sqs=None):
                 # General exception for any other unforeseen errors
                 print(f"Error message: {str(e)}")
 
+            # Job options passed on to run.py
+            options = {}
+            job_targets = job_details.get('targets')
+            if successful_download and job_targets:
+                options['targets'] = dict(job_targets)
+                # An attached BED of target regions sits next to the input
+                if job_targets.get('s3_key_bed'):
+                    bed_path = file_path + '.targets.bed'
+                    try:
+                        s3.download_file(config.get('s3', 'InputsBucketName'), job_targets['s3_key_bed'], bed_path)
+                        options['targets']['bed'] = bed_path
+                    except Exception as e:
+                        print(f"Error downloading target regions: {str(e)}")
+                        successful_download = False
+
+            # Named pipeline and the subset of its tracks to run
+            for key in ('pipeline', 'tracks'):
+                if job_details.get(key):
+                    options[key] = job_details[key]
+
             # Only start subprocess if download is successful
             if successful_download:
                 # To Catch errors in subprocess or when deleting message
                 try:
-                    Popen(['python', config.get('ann', 'ann_dir'), file_path, job_id, user_id])
-
-                    update_dynamodb(job_id)
+                    args = ['python', config.get('ann', 'ann_dir'), file_path, job_id, user_id]
+                    if trace or options:
+                        args.append(trace['trace_id'] if trace else '')
+                    if options:
+                        args.append(json.dumps(options))
+                    Popen(args)
+
+                    trace_hops = None
+                    if trace:
+                        trace_hops = {'dequeued': dequeued, 'download_done': download_done}
+                    update_dynamodb(job_id, trace_hops)
 
                     # Delete message from queue after successful processing
                     # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/sqs.html#SQS.Client.delete_message
@@ -0,0 +1,494 @@
+# benchmark.py
+#
+# Benchmark baselines and regression gate for the AnnTools pipeline
+#
+# Runs driver.run repeatedly on a fixed input, with the options jobs run
+# with, and collects wall time and peak memory for the whole run and for
+# each annotate.py stage. Results
+# can be saved as a versioned baseline (JSON) and later runs compared
+# against it; a stage regresses when its median moves past the configured
+# threshold and a one-sided Mann-Whitney U test says the shift is real.
+# Exits with status 1 when any stage regresses, so it can gate a merge.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import contextlib
+import hashlib
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pymysql
+
+import driver
+import utils as u
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read("annotator_config.ini")
+
+# Bump when the layout of baseline files changes
+BASELINE_FORMAT = 2
+
+TOTAL = "driver.run"
+TIME_METRICS = ["seconds"]
+MEMORY_METRICS = ["peak_rss_kb", "peak_traced_kb"]
+# Memory held per parsed variant while its chunk is in the pipeline
+RECORD_METRICS = ["bytes_per_variant"]
+# Work done by the database server during a run
+SERVER_METRICS = ["server_statements", "server_seconds", "server_cpu_seconds"]
+
+STATEMENT_TOTALS = (
+    "select sum(COUNT_STAR), sum(SUM_TIMER_WAIT){cpu} "
+    "from performance_schema.events_statements_summary_global_by_event_name;"
+)
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+"""Statements the database server has run so far, with their total
+latency and CPU seconds, from performance_schema
+
+Returns None when performance_schema is not available. CPU time needs
+MySQL 8.0.28 or later and is None before that. The totals cover every
+client of the server, so benchmark against a database nothing else uses.
+"""
+
+
+def server_counters():
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    try:
+        try:
+            cursor.execute(STATEMENT_TOTALS.format(cpu=", sum(SUM_CPU_TIME)"))
+        except pymysql.MySQLError:
+            cursor.execute(STATEMENT_TOTALS.format(cpu=", null"))
+        count, wait, cpu = cursor.fetchone()
+    except pymysql.MySQLError as e:
+        print(f"Server statement totals unavailable: {e}")
+        return None
+    finally:
+        conn.close()
+
+    # performance_schema timers are in picoseconds
+    return {
+        "server_statements": int(count or 0),
+        "server_seconds": float(wait or 0) / 1e12,
+        "server_cpu_seconds": None if cpu is None else float(cpu) / 1e12,
+    }
+
+
+"""driver.run options from annotator_config.ini, as run.py sets them for
+jobs, so the gate measures the code path jobs take
+"""
+
+
+def run_options():
+    path = config.get("dbsnp_filter", "Path", fallback=None)
+    if not config.getboolean("dbsnp_filter", "Enabled", fallback=False):
+        path = None
+    return {
+        "dbsnp_filter": path if path and os.path.exists(path) else None,
+        "dedup": config.getboolean("ann", "Dedup", fallback=False),
+        "dedup_max_loci": config.getint("ann", "DedupMaxLoci", fallback=100000),
+        "spans": config.getboolean("ann", "Spans", fallback=False),
+        "plan": config.getboolean("planner", "Enabled", fallback=False),
+        "lookup_connections": config.getint("lookups", "Connections", fallback=0),
+        "lookup_in_flight": config.getint("lookups", "InFlight", fallback=8),
+        "track_workers": config.getint("lookups", "TrackWorkers", fallback=0),
+    }
+
+
+"""Run the pipeline once on a scratch copy of infile
+
+Returns the metrics dict written by driver.run plus the wall time of the
+whole call and, when the server reports them, the statements, latency
+and CPU time it spent on the run. Pipeline output is discarded.
+"""
+
+
+def run_once(infile, track_memory):
+    workdir = tempfile.mkdtemp(prefix="ann_bench_")
+    try:
+        vcf = os.path.join(workdir, os.path.basename(infile))
+        shutil.copy(infile, vcf)
+        before = server_counters()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            driver.run(vcf, "vcf", track_memory=track_memory, **run_options())
+            seconds = time.perf_counter() - start
+        after = server_counters()
+        with open(vcf + ".metrics.json") as fh:
+            metrics = json.load(fh)
+        metrics["wall_seconds"] = seconds
+        if before is not None and after is not None:
+            for metric in SERVER_METRICS:
+                if before[metric] is not None and after[metric] is not None:
+                    metrics[metric] = round(after[metric] - before[metric], 4)
+        return metrics
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+"""Collect samples for every stage
+
+Timing runs are made with memory tracking off, since tracemalloc inflates
+stage times; memory samples come from separate tracked runs.
+"""
+
+
+def collect(infile, runs, memory_runs, warmup):
+    samples = {}
+
+    def add(stage, metric, value):
+        samples.setdefault(stage, {}).setdefault(metric, []).append(value)
+
+    for _ in range(warmup):
+        run_once(infile, track_memory=False)
+
+    for i in range(runs):
+        metrics = run_once(infile, track_memory=False)
+        add(TOTAL, "seconds", round(metrics["wall_seconds"], 4))
+        for stage in metrics["stages"]:
+            add(stage["stage"], "seconds", stage["seconds"])
+        for metric in SERVER_METRICS:
+            if metric in metrics:
+                add(TOTAL, metric, metrics[metric])
+        print(
+            f"Timing run {i + 1}/{runs}: {metrics['wall_seconds']:.2f}s, "
+            f"{metrics.get('server_statements', '-')} statements taking "
+            f"{metrics.get('server_seconds', '-')}s on the server"
+        )
+
+    for i in range(memory_runs):
+        metrics = run_once(infile, track_memory=True)
+        add(TOTAL, "peak_rss_kb", metrics["peak_rss_kb"])
+        add(
+            TOTAL,
+            "peak_traced_kb",
+            max([s["peak_traced_kb"] for s in metrics["stages"]]),
+        )
+        if "bytes_per_variant" in metrics:
+            add(TOTAL, "bytes_per_variant", metrics["bytes_per_variant"])
+        for stage in metrics["stages"]:
+            for metric in MEMORY_METRICS:
+                add(stage["stage"], metric, stage[metric])
+        print(
+            f"Memory run {i + 1}/{memory_runs}: {metrics['peak_rss_kb']} KB peak RSS, "
+            f"{metrics.get('bytes_per_variant', '-')} bytes per in-flight variant"
+        )
+
+    return samples
+
+
+def median(values):
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[mid]
+    return (ordered[mid - 1] + ordered[mid]) / 2.0
+
+
+"""One-sided Mann-Whitney U test
+
+Returns the p-value for the hypothesis that current values tend to be
+larger than baseline values, using the normal approximation with tie
+and continuity corrections. It makes no assumption about the shape of
+the timing distribution, which is usually skewed by the odd slow run.
+"""
+
+
+def mann_whitney_greater(baseline, current):
+    n1 = len(current)
+    n2 = len(baseline)
+    if n1 == 0 or n2 == 0:
+        return 1.0
+
+    # Rank the pooled samples, averaging ranks over ties
+    pooled = sorted([(v, 0) for v in current] + [(v, 1) for v in baseline])
+    ranks = [0.0] * len(pooled)
+    ties = 0.0
+    i = 0
+    while i < len(pooled):
+        j = i
+        while j + 1 < len(pooled) and pooled[j + 1][0] == pooled[i][0]:
+            j = j + 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2.0 + 1
+        t = j - i + 1
+        ties = ties + (t**3 - t)
+        i = j + 1
+
+    rank_sum = sum([r for r, (_, group) in zip(ranks, pooled) if group == 0])
+    u = rank_sum - n1 * (n1 + 1) / 2.0
+    n = n1 + n2
+    variance = n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2.0 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+"""Compare current samples against a baseline
+
+A metric regresses when its median grew by more than the threshold (and
+by more than the absolute floor, so millisecond-sized stages cannot trip
+the gate on noise) and the increase is significant at alpha. Stages or
+metrics missing from either side are reported but never fail the gate.
+"""
+
+
+def compare(
+    baseline,
+    current,
+    time_threshold,
+    memory_threshold,
+    alpha,
+    time_floor=0.0,
+    memory_floor_kb=0,
+):
+    results = []
+    for stage in current:
+        for metric, values in current[stage].items():
+            base_values = baseline.get(stage, {}).get(metric)
+            if not base_values:
+                results.append({"stage": stage, "metric": metric, "verdict": "new"})
+                continue
+            if metric in TIME_METRICS:
+                threshold, floor = time_threshold, time_floor
+            elif metric in SERVER_METRICS:
+                threshold, floor = time_threshold, 0
+            elif metric in RECORD_METRICS:
+                threshold, floor = memory_threshold, 0
+            else:
+                threshold, floor = memory_threshold, memory_floor_kb
+            base_median = median(base_values)
+            cur_median = median(values)
+            change = (cur_median - base_median) / base_median if base_median else 0.0
+            p = mann_whitney_greater(base_values, values)
+            material = abs(cur_median - base_median) > floor
+            if change > threshold and material and p < alpha:
+                verdict = "REGRESSION"
+            elif (
+                change < -threshold
+                and material
+                and mann_whitney_greater(values, base_values) < alpha
+            ):
+                verdict = "improved"
+            else:
+                verdict = "ok"
+            results.append(
+                {
+                    "stage": stage,
+                    "metric": metric,
+                    "baseline": base_median,
+                    "current": cur_median,
+                    "change": change,
+                    "p": p,
+                    "verdict": verdict,
+                }
+            )
+    return results
+
+
+def print_report(results):
+    print(
+        f"\n{'stage':<28} {'metric':<15} {'baseline':>12} {'current':>12} "
+        f"{'change':>8} {'p':>7}  verdict"
+    )
+    for r in results:
+        if r["verdict"] == "new":
+            print(
+                f"{r['stage']:<28} {r['metric']:<15} {'-':>12} {'-':>12} "
+                f"{'-':>8} {'-':>7}  new"
+            )
+            continue
+        print(
+            f"{r['stage']:<28} {r['metric']:<15} {r['baseline']:>12.4f} "
+            f"{r['current']:>12.4f} {r['change'] * 100:>7.1f}% {r['p']:>7.4f}  {r['verdict']}"
+        )
+
+
+"""Baselines live in BaselineDir as <label>.json, one per version
+"""
+
+
+def baseline_path(label):
+    return os.path.join(config.get("benchmark", "BaselineDir"), label + ".json")
+
+
+def latest_baseline():
+    directory = config.get("benchmark", "BaselineDir")
+    if not os.path.isdir(directory):
+        return None
+    baselines = []
+    for name in os.listdir(directory):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as fh:
+                baselines.append((json.load(fh).get("created_at", 0), name[:-5]))
+    return max(baselines)[1] if baselines else None
+
+
+def save_baseline(label, infile, samples, runs, memory_runs):
+    baseline = {
+        "format": BASELINE_FORMAT,
+        "label": label,
+        "created_at": int(time.time()),
+        "commit": git_commit(),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "input": os.path.basename(infile),
+        "input_sha1": file_sha1(infile),
+        "runs": runs,
+        "memory_runs": memory_runs,
+        "options": run_options(),
+        "samples": samples,
+    }
+    os.makedirs(config.get("benchmark", "BaselineDir"), exist_ok=True)
+    with open(baseline_path(label), "w") as fh:
+        json.dump(baseline, fh, indent=2)
+    print(f"Saved baseline {label} to {baseline_path(label)}")
+
+
+def load_baseline(label, infile):
+    with open(baseline_path(label)) as fh:
+        baseline = json.load(fh)
+    if baseline.get("format") != BASELINE_FORMAT:
+        raise ValueError(
+            f"Baseline {label} has format {baseline.get('format')}, expected {BASELINE_FORMAT}"
+        )
+    if baseline["input_sha1"] != file_sha1(infile):
+        raise ValueError(f"Baseline {label} was recorded on a different input file")
+    if baseline["options"] != run_options():
+        raise ValueError(f"Baseline {label} was recorded with other pipeline options")
+    return baseline
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="AnnTools benchmark regression gate")
+    parser.add_argument("--input", default=config.get("benchmark", "Input"))
+    parser.add_argument("--runs", type=int, default=config.getint("benchmark", "Runs"))
+    parser.add_argument(
+        "--memory-runs", type=int, default=config.getint("benchmark", "MemoryRuns")
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=config.getint("benchmark", "Warmup")
+    )
+    parser.add_argument(
+        "--save",
+        metavar="LABEL",
+        nargs="?",
+        const="",
+        help="Save results as a baseline (default label: git commit)",
+    )
+    parser.add_argument(
+        "--baseline",
+        metavar="LABEL",
+        help="Baseline to compare against (default: most recent)",
+    )
+    parser.add_argument(
+        "--time-threshold",
+        type=float,
+        default=config.getfloat("benchmark", "TimeThreshold"),
+    )
+    parser.add_argument(
+        "--memory-threshold",
+        type=float,
+        default=config.getfloat("benchmark", "MemoryThreshold"),
+    )
+    parser.add_argument(
+        "--time-floor", type=float, default=config.getfloat("benchmark", "TimeFloor")
+    )
+    parser.add_argument(
+        "--memory-floor-kb",
+        type=int,
+        default=config.getint("benchmark", "MemoryFloorKb"),
+    )
+    parser.add_argument(
+        "--alpha", type=float, default=config.getfloat("benchmark", "Alpha")
+    )
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+
+    label = args.baseline if args.baseline else latest_baseline()
+    baseline = None
+    if label and args.save is None:
+        try:
+            baseline = load_baseline(label, args.input)
+        except (OSError, ValueError) as e:
+            print(f"Cannot compare against baseline {label}: {e}")
+            sys.exit(2)
+
+    samples = collect(args.input, args.runs, args.memory_runs, args.warmup)
+
+    if args.save is not None:
+        save_baseline(
+            args.save or git_commit() or time.strftime("%Y%m%d%H%M%S"),
+            args.input,
+            samples,
+            args.runs,
+            args.memory_runs,
+        )
+        return
+
+    if baseline is None:
+        print("No baseline to compare against; run with --save first")
+        sys.exit(2)
+
+    print(f"Comparing against baseline {label} (commit {baseline.get('commit')})")
+    results = compare(
+        baseline["samples"],
+        samples,
+        args.time_threshold,
+        args.memory_threshold,
+        args.alpha,
+        time_floor=args.time_floor,
+        memory_floor_kb=args.memory_floor_kb,
+    )
+    print_report(results)
+
+    regressions = [r for r in results if r["verdict"] == "REGRESSION"]
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over threshold")
+        sys.exit(1)
+    print("\nNo regressions")
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
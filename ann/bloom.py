@@ -0,0 +1,204 @@
+# bloom.py
+#
+# Memory-mapped Bloom filter used to skip dbSNP lookups for novel variants
+#
+# The filter is a plain file: a fixed header followed by the bit array.
+# Jobs open it read-only with mmap, so every annotation process on an
+# instance shares the same pages from the OS page cache. Run this module
+# directly to (re)build the filter after dbSNP is reloaded.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b"GASBLOOM"
+VERSION = 1
+
+# magic, version, num_hashes, num_bits, num_items, built_at
+HEADER = struct.Struct("<8sIIQQQ")
+
+
+"""Filter size for a given capacity and false-positive rate
+"""
+
+
+def optimal_size(capacity, fp_rate):
+    capacity = max(1, capacity)
+    num_bits = int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+    num_bits = max(8, (num_bits + 7) // 8 * 8)
+    num_hashes = max(1, int(round(num_bits / float(capacity) * math.log(2))))
+    return num_bits, num_hashes
+
+
+class BloomFilter(object):
+    def __init__(
+        self, fh, mm, num_hashes, num_bits, num_items, built_at, writable=False
+    ):
+        self.fh = fh
+        self.mm = mm
+        self.num_hashes = num_hashes
+        self.num_bits = num_bits
+        self.num_items = num_items
+        self.built_at = built_at
+        self.writable = writable
+
+    @classmethod
+    def create(cls, path, capacity, fp_rate=0.01):
+        num_bits, num_hashes = optimal_size(capacity, fp_rate)
+        fh = open(path, "w+b")
+        fh.truncate(HEADER.size + num_bits // 8)
+        mm = mmap.mmap(fh.fileno(), 0)
+        return cls(fh, mm, num_hashes, num_bits, 0, 0, writable=True)
+
+    @classmethod
+    def open(cls, path):
+        fh = open(path, "rb")
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_hashes, num_bits, num_items, built_at = HEADER.unpack_from(
+            mm, 0
+        )
+        if magic != MAGIC or version != VERSION:
+            mm.close()
+            fh.close()
+            raise ValueError(f"{path} is not a version {VERSION} Bloom filter")
+        return cls(fh, mm, num_hashes, num_bits, num_items, built_at)
+
+    """Bit positions for key, by double hashing one 128-bit digest
+    """
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        h2 = h2 | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for bit in self.positions(key):
+            offset = HEADER.size + (bit >> 3)
+            self.mm[offset] = self.mm[offset] | (1 << (bit & 7))
+        self.num_items = self.num_items + 1
+
+    def might_contain(self, key):
+        for bit in self.positions(key):
+            if not self.mm[HEADER.size + (bit >> 3)] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def expected_fp_rate(self):
+        if self.num_items == 0:
+            return 0.0
+        return (
+            1 - math.exp(-self.num_hashes * self.num_items / float(self.num_bits))
+        ) ** self.num_hashes
+
+    def close(self):
+        if self.writable:
+            HEADER.pack_into(
+                self.mm,
+                0,
+                MAGIC,
+                VERSION,
+                self.num_hashes,
+                self.num_bits,
+                self.num_items,
+                int(time.time()),
+            )
+            self.mm.flush()
+        self.mm.close()
+        self.fh.close()
+
+
+"""Key used for dbSNP membership
+
+Normalized the way MySQL compares the columns (case-insensitive strings,
+numeric POS), so the filter can only ever answer "maybe" for a variant
+the query would match. Raises ValueError if POS is not a number; callers
+must then fall back to querying.
+"""
+
+
+def dbsnp_key(chr, pos, ref):
+    chr = str(chr).strip()
+    if chr.startswith("chr"):
+        chr = chr.replace("chr", "")
+    return f"{chr.upper()}:{int(pos)}:{str(ref).strip().upper()}".encode()
+
+
+"""Build the dbSNP filter from the reference database
+
+Rows are streamed with an unbuffered cursor and the filter is written to
+a temporary file that replaces the old one only when complete, so jobs
+never open a half-built filter.
+"""
+
+
+def build_dbsnp_filter(path, fp_rate=0.01):
+    import pymysql
+    import utils as u
+
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    cursor.execute("select count(*) from dbSNP;")
+    capacity = int(cursor.fetchone()[0])
+    cursor.close()
+
+    tmp_path = path + ".tmp"
+    bloom = BloomFilter.create(tmp_path, capacity, fp_rate)
+    cursor = conn.cursor(pymysql.cursors.SSCursor)
+    cursor.execute("select CHR, POS, REF from dbSNP;")
+    for chr, pos, ref in cursor:
+        bloom.add(dbsnp_key(chr, pos, ref))
+    cursor.close()
+    conn.close()
+
+    bloom.close()
+    os.replace(tmp_path, path)
+    return capacity
+
+
+def main():
+    from configparser import ConfigParser, ExtendedInterpolation
+
+    config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+    config.read("annotator_config.ini")
+
+    parser = argparse.ArgumentParser(
+        description="Build or inspect the dbSNP Bloom filter"
+    )
+    parser.add_argument("command", choices=["build", "info"])
+    parser.add_argument("--path", default=config.get("dbsnp_filter", "Path"))
+    parser.add_argument(
+        "--fp-rate",
+        type=float,
+        default=config.getfloat("dbsnp_filter", "FalsePositiveRate"),
+    )
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.time()
+        rows = build_dbsnp_filter(args.path, args.fp_rate)
+        print(f"Added {rows} dbSNP rows to {args.path} in {time.time() - start:.1f}s")
+
+    bloom = BloomFilter.open(args.path)
+    print(
+        f"{args.path}: {bloom.num_items} keys, {bloom.num_bits // 8 // 1024} KB, "
+        f"{bloom.num_hashes} hashes, expected false-positive rate "
+        f"{bloom.expected_fp_rate() * 100:.3f}%, built "
+        f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(bloom.built_at))}"
+    )
+    bloom.close()
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
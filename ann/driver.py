@@ -12,168 +12,572 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
 import sys
 import os
-import file_utils as fu
+import functools
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+import utils as u
 import annotate as ann
+import planner
+import reference
+from lookups import LookupEngine
+from metrics import JobMetrics
+from targets import DROP, TargetFilter
+from records import (
+    CHUNK_SIZE,
+    DEDUP_MAX_LOCI,
+    LocusMemo,
+    declare_input_info,
+    mark_input,
+    read_chunks,
+    variants_in,
+    write_chunk,
+)
 
+"""Stage classes a pipeline can use, with the message printed when the
+stage is done and the run-time arguments it takes besides its
+parameters
+"""
 
-def run(infile, format):
+STAGE_TYPES = {
+    "DbSnpStage": ("dbSNP - done.", ["conn", "dbsnp_filter"]),
+    "BigRefGeneStage": ("BigRefGene - done.", []),
+    "GeneStage": ("BigRefGene - done.", ["conn"]),
+    "ExonsStage": ("Exons - done.", []),
+    "RefGeneOverlapStage": ("refGene - done.", ["conn"]),
+    "CytobandStage": ("Cytoband - done.", []),
+    "GadAllStage": ("gadAll - done.", ["conn"]),
+    "GwasCatalogStage": ("GwasCatalog - done.", ["conn"]),
+    "MiRNAStage": ("miRNA - done.", ["conn"]),
+    "HugoStage": ("HUGO Gene Nomenclature Committee - done.", ["conn"]),
+    "CnvStage": ("CNV - done.", []),
+    "GenomicSuperDupsStage": ("genomicSuperDups - done.", ["conn"]),
+    "TfbsStage": ("addOverlapWithTfbsConsSites - done.", []),
+}
 
-    print("Running . . .")
+# Parameters that always take a list, even of one value
+LIST_PARAMS = ["tables"]
 
-    ann.getSnpsFromDbSnp(vcf=infile, format="vcf", tmpextin="", tmpextout=".1")
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
 
-    ann.getBigRefGene(
-        vcf=infile,
-        format="vcf",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(
-        vcf=infile,
-        format="vcf",
-        table="refGene",
-        promoter_offset=500,
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(
-        vcf=infile,
-        format="vcf",
-        table="cytoBand",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(
-        vcf=infile,
-        format="vcf",
-        table="gadAll",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGwasCatalog(
-        vcf=infile,
-        format="vcf",
-        table="gwasCatalog",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithMiRNA(
-        vcf=infile,
-        format="vcf",
-        table="targetScanS",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWitHUGOGeneNomenclature(
-        vcf=infile,
-        format="vcf",
-        table="hugo",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="dgv_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="abParts_IG_T_CelReceptors",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="mcCarroll_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(
-        vcf=infile,
-        format="vcf",
-        table="conrad_Cnv",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
-    )
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(
-        vcf=infile,
-        format="vcf",
-        table="genomicSuperDups",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+"""INFO keys each stage class writes, "{param}" standing for one of its
+parameters (each table of a list); reannotate.py strips them to run a
+stage again on a stored result
+"""
+
+GENE_KEYS = [
+    # the empty entry appended when no transcript region matched
+    "",
+    "name",
+    "name2",
+    "transcriptStrand",
+    "positionType",
+    "exon",
+    "non_coding_exon",
+    "intron",
+    "putativePromoterRegion",
+]
+
+INFO_KEYS = {
+    "DbSnpStage": ["DB", "VC", "GMAF"],
+    # only the fields after the locus and alleles are written
+    "BigRefGeneStage": ann.REFSEQ_NAMES[5:],
+    "GeneStage": GENE_KEYS,
+    "ExonsStage": GENE_KEYS,
+    "RefGeneOverlapStage": ["name2", "name"],
+    "CytobandStage": ["{table}"],
+    "GadAllStage": ["{table}"],
+    "GwasCatalogStage": ["{table}"],
+    "MiRNAStage": ["miRNAsites"],
+    "HugoStage": ["HGNC_GeneAnnotation"],
+    "CnvStage": ["{tables}", "{tables}Overlap"],
+    "GenomicSuperDupsStage": [
+        "{table}",
+        "otherChrom",
+        "otherStart",
+        "otherEnd",
+        "{table}Overlap",
+    ],
+    "TfbsStage": ["tfbsRegion"],
+}
+
+# Stage classes writing with InfoBuilder.append, so always after a ';'
+# (the rest use add())
+APPENDS = [
+    "DbSnpStage",
+    "BigRefGeneStage",
+    "GeneStage",
+    "ExonsStage",
+    "GenomicSuperDupsStage",
+]
+
+# Stage classes writing to every variant's INFO, if only an empty entry
+# that the next stage's add() hides
+ALWAYS_WRITES = ["GeneStage", "ExonsStage"]
+
+
+"""Stage classes whose apply() reads INFO written by another stage
+
+Every stage adds to INFO, so stages are applied in pipeline order to
+keep the output unchanged; these are the stages that also read what an
+earlier one wrote: BigRefGene checks whether INFO is still "." as
+dbSNP leaves it, and GeneStage reads BigRefGene's positionType. When
+both are in a pipeline, a stage must come after the ones in AFTER; the
+ones in REQUIRES it cannot run without. Lookups only depend on the
+locus, so they may run in any order.
+"""
+
+AFTER = {
+    "BigRefGeneStage": ["DbSnpStage"],
+    "GeneStage": ["BigRefGeneStage"],
+}
+
+REQUIRES = {
+    "GeneStage": ["BigRefGeneStage"],
+}
+
+
+"""The standard pipeline, as (name, stage spec) in the order the stages
+run; pipelines in annotator_config.ini are declared the same way
+"""
+
+DEFAULT_PIPELINE = [
+    ("dbSNP", "DbSnpStage"),
+    ("BigRefGene", "BigRefGeneStage"),
+    ("refGene", "GeneStage table=refGene promoter_offset=500"),
+    ("cytoBand", "CytobandStage table=cytoBand"),
+    ("gadAll", "GadAllStage table=gadAll"),
+    ("gwasCatalog", "GwasCatalogStage table=gwasCatalog"),
+    ("targetScanS", "MiRNAStage table=targetScanS"),
+    ("hugo", "HugoStage table=hugo"),
+    # answered from coverage masks in a single pass
+    (
+        "CNV",
+        "CnvStage tables=dgv_Cnv,abParts_IG_T_CelReceptors,mcCarroll_Cnv,conrad_Cnv",
+    ),
+    ("genomicSuperDups", "GenomicSuperDupsStage table=genomicSuperDups"),
+    ("tfbsConsSites", "TfbsStage table=tfbsConsSites"),
+]
+
+
+"""Parses a stage spec, "<Stage class> <param>=<value> ...", into the
+class name and its parameters; values with commas (or of LIST_PARAMS)
+are lists, and digits are ints
+"""
+
+
+def parse_stage(spec):
+    words = spec.split()
+    if len(words) == 0:
+        raise ValueError("Empty stage spec")
+    params = {}
+    for word in words[1:]:
+        key, sep, value = word.partition("=")
+        if sep == "" or key == "":
+            raise ValueError(f"Bad stage parameter {word!r} in {spec!r}")
+        if "," in value or key in LIST_PARAMS:
+            params[key] = [v for v in value.split(",") if v != ""]
+        elif value.isdigit():
+            params[key] = int(value)
+        else:
+            params[key] = value
+    return words[0], params
+
+
+"""Checks a pipeline of (name, class name, params) and raises ValueError
+if it cannot run: unknown classes or parameters, repeated names, or a
+stage before (or without) the stages it depends on
+"""
+
+
+def check_pipeline(entries):
+    names = set()
+    kinds = set([kind for _, kind, _ in entries])
+    seen = set()
+    for name, kind, params in entries:
+        if name in names:
+            raise ValueError(f"Stage {name} appears twice in the pipeline")
+        names.add(name)
+        if kind not in STAGE_TYPES:
+            raise ValueError(f"Stage {name}: unknown stage class {kind}")
+        runtime = dict([(arg, None) for arg in STAGE_TYPES[kind][1]])
+        try:
+            inspect.signature(getattr(ann, kind)).bind(**params, **runtime)
+        except TypeError as e:
+            raise ValueError(f"Stage {name}: {e}")
+        for dependency in REQUIRES.get(kind, []):
+            if dependency not in kinds:
+                raise ValueError(f"Stage {name} needs a {dependency} stage")
+        for dependency in AFTER.get(kind, []):
+            if dependency in kinds and dependency not in seen:
+                raise ValueError(f"Stage {name} must run after its {dependency}")
+        seen.add(kind)
+
+
+"""The INFO keys a stage of class kind with params writes
+"""
+
+
+def info_keys(kind, params):
+    args = inspect.signature(getattr(ann, kind)).bind_partial(**params)
+    args.apply_defaults()
+    keys = []
+    for key in INFO_KEYS[kind]:
+        if "{tables}" in key:
+            keys.extend(
+                [key.format(tables=table) for table in args.arguments["tables"]]
+            )
+        else:
+            keys.append(key.format(**args.arguments))
+    return keys
+
+
+"""The stages of pipeline to run for a job that asked for tracks (all of
+them when tracks is None), keeping their order and adding the stages
+they require
+"""
+
+
+def select_tracks(entries, tracks):
+    if tracks is None:
+        return entries
+    available = [name for name, _, _ in entries]
+    unknown = [track for track in tracks if track not in available]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown tracks: {', '.join(unknown)}")
+
+    wanted = set(tracks)
+    kinds = [kind for name, kind, _ in entries if name in wanted]
+    while len(kinds) > 0:
+        for dependency in REQUIRES.get(kinds.pop(), []):
+            for name, kind, _ in entries:
+                if kind == dependency and name not in wanted:
+                    wanted.add(name)
+                    kinds.append(kind)
+                    break
+    return [entry for entry in entries if entry[0] in wanted]
+
+
+"""Names of the stages of a pipeline to run again when the tables behind
+tracks change, in pipeline order
+
+Besides tracks, these are the stages that read what one of them writes
+(AFTER) and the stages writing any of the same INFO keys, whose entries
+could not be told apart from theirs.
+"""
+
+
+def refresh_tracks(entries, tracks):
+    available = [name for name, _, _ in entries]
+    unknown = [track for track in tracks if track not in available]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown tracks: {', '.join(unknown)}")
+
+    keys = dict(
+        [(name, set(info_keys(kind, params))) for name, kind, params in entries]
     )
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithTfbsConsSites(
-        vcf=infile,
-        table="tfbsConsSites",
-        tmpextin="." + str(tmpextin),
-        tmpextout="." + str(tmpextout),
+    kinds = dict([(name, kind) for name, kind, _ in entries])
+    refresh = set(tracks)
+    changed = True
+    while changed:
+        changed = False
+        for name, kind, _ in entries:
+            if name in refresh:
+                continue
+            for other in refresh:
+                if keys[name] & keys[other] or kinds[other] in AFTER.get(kind, []):
+                    refresh.add(name)
+                    changed = True
+                    break
+    return [name for name in available if name in refresh]
+
+
+"""Parses and checks pipeline, a list of (name, stage spec)
+(DEFAULT_PIPELINE if None), into (name, class name, params)
+"""
+
+
+def parse_pipeline(pipeline=None):
+    entries = []
+    for name, spec in pipeline or DEFAULT_PIPELINE:
+        kind, params = parse_stage(spec)
+        entries.append((name, kind, params))
+    check_pipeline(entries)
+    return entries
+
+
+"""The pipeline named name (Default if None) in the [pipeline] section
+of config, as (name, stage spec) from [stages]
+"""
+
+
+def read_pipeline(config, name=None):
+    name = name or "Default"
+    # has_option also finds the [DEFAULT] and environment values
+    if not config.has_option("pipeline", name) or name.lower() in config.defaults():
+        raise ValueError(f"Unknown pipeline: {name}")
+    pipeline = []
+    for stage in config.get("pipeline", name).split(","):
+        stage = stage.strip()
+        if not config.has_option("stages", stage):
+            raise ValueError(f"Pipeline {name}: unknown stage {stage}")
+        pipeline.append((stage, config.get("stages", stage)))
+    return pipeline
+
+
+"""Reference version of each track a job runs, to tag its result with
+(see reference.retag)
+"""
+
+
+def job_versions(pipeline=None, tracks=None, config=None):
+    config = config or reference.read_config()
+    return dict(
+        [
+            (name, reference.track_version(name, config))
+            for name, _, _ in select_tracks(parse_pipeline(pipeline), tracks)
+        ]
     )
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
 
-    ## Cleanup
-    for i in range(1, tmpextin):
-        fu.delete(infile + "." + str(i))
 
-    os.rename(infile + "." + str(tmpextin), infile + ".annot")
+"""Annotation stages to run, as (metrics name, message, factory), from
+pipeline, a list of (name, stage spec) (DEFAULT_PIPELINE if None), cut
+down to tracks; stages that query MySQL share conn. Stages that are not
+selected are never created, so they cost nothing.
+"""
+
+
+def build_stages(conn, dbsnp_filter=None, pipeline=None, tracks=None):
+    entries = select_tracks(parse_pipeline(pipeline), tracks)
+
+    runtime = {"conn": conn, "dbsnp_filter": dbsnp_filter}
+    stages = []
+    for name, kind, params in entries:
+        message, args = STAGE_TYPES[kind]
+        kwargs = dict(params)
+        for arg in args:
+            kwargs[arg] = runtime[arg]
+        stages.append((name, message, functools.partial(getattr(ann, kind), **kwargs)))
+    return stages
+
+
+"""Looks variants up for stage on a worker thread, timed into the
+stage's metrics
+"""
+
+
+def timed_lookup(metrics, name, stage, variants, memo):
+    with metrics.timer(name):
+        return stage.lookup_chunk(variants, memo)
+
+
+"""Runs all annotation stages on infile
+
+The input is parsed once into Variant records, chunk_size variants at a
+time, and each chunk goes through every stage in memory before it is
+written out, so no intermediate files are produced and memory does not
+grow with the input. Stage timings (summed over chunks) are written to
+<infile>.metrics.json; with track_memory the peak RSS and top allocation
+sites of each stage are included too, as well as the memory held per
+in-flight variant. dbsnp_filter is the path of the dbSNP Bloom filter
+built by bloom.py.
+
+With dedup, records repeating a (CHROM, POS, end, REF, ALT) already seen in
+the job reuse its lookups from a LocusMemo of up to dedup_max_loci loci
+instead of querying every track again; the output is the same and the
+dedup ratio is added to .count.log.
+
+With plan, planner.py picks point, window or preload lookups for each
+track from the input's size and spread before the first chunk is read;
+its predictions and the actual cost of each track are printed and kept
+in the metrics.
+
+With lookup_connections, the queries of tracks that stay in the
+database run concurrently, up to lookup_in_flight at a time over that
+many extra connections (lookups.py); the queries per second achieved
+are printed and kept in the metrics.
+
+With spans, overlap tracks match each variant's whole span (POS to
+END, SVLEN or the end of REF) and report how much of it they cover;
+see annotate.Stage.
+
+pipeline is the list of (name, stage spec) to run, DEFAULT_PIPELINE if
+None, and tracks the names of the stages a job asked for (see
+build_stages).
+
+With targets (the path of a BED file), records outside the target
+regions are dropped, or with target_mode "pass" written out
+unannotated, before any stage runs; the counts are added to .count.log
+and the metrics.
+
+With track_versions, a dict of track name to reference version (see
+job_versions), the result gets a ##trackVersion header line for each,
+as reannotate.py tags the results it refreshes. Each annotated record
+ends its INFO with the length of its input INFO (records.mark_input),
+so reannotate.py can tell it from what the stages wrote.
+
+With track_workers, the lookups of all stages for a chunk run at the
+same time on that many threads, each stage on its own connection, and
+their results are applied in stage order as each stage's lookups
+finish (see AFTER). Threads rather than processes: lookups wait
+on MySQL or probe shared in-memory indexes, and the records they
+annotate stay in this process. A stage's lookup time is added to its
+metrics from the worker thread. Memory cannot be told apart between
+stages running at the same time, so with track_memory the stages run
+one after another.
+"""
+
+
+def run(
+    infile,
+    format,
+    track_memory=False,
+    top_sites=10,
+    dbsnp_filter=None,
+    chunk_size=CHUNK_SIZE,
+    dedup=False,
+    dedup_max_loci=DEDUP_MAX_LOCI,
+    plan=False,
+    lookup_connections=0,
+    lookup_in_flight=8,
+    track_workers=0,
+    spans=False,
+    pipeline=None,
+    tracks=None,
+    targets=None,
+    target_mode=DROP,
+    track_versions=None,
+):
+
+    print("Running . . .")
+    metrics = JobMetrics(track_memory=track_memory, top_sites=top_sites)
+
+    target_filter = None
+    if targets is not None:
+        with metrics.stage("targets"):
+            target_filter = TargetFilter.from_bed(
+                targets, mode=target_mode, spans=spans
+            )
+
+    # a pipeline or tracks the job cannot run fail before anything is opened
+    select_tracks(parse_pipeline(pipeline), tracks)
+    conn = u.db_connect()
+    # stages' memory cannot be told apart while they run at the same time
+    if track_memory:
+        track_workers = 0
+    # concurrent stages cannot share a connection
+    stage_conn = None if track_workers > 0 else conn
+    stages = []
+    for name, message, factory in build_stages(
+        stage_conn, dbsnp_filter=dbsnp_filter, pipeline=pipeline, tracks=tracks
+    ):
+        with metrics.stage(name):
+            stages.append((name, message, factory()))
+    for _, _, stage in stages:
+        stage.set_spans(spans)
+
+    memo = LocusMemo(max_loci=dedup_max_loci) if dedup else None
+    inds = ann.getFormatSpecificIndices(format=format)
+    engine = None
+    if lookup_connections > 0:
+        engine = LookupEngine(
+            connections=lookup_connections, in_flight=lookup_in_flight
+        )
+        for _, _, stage in stages:
+            stage.engine = engine
+
+    plans = []
+    if plan:
+        with metrics.stage("plan"):
+            profile = planner.profile_input(infile, inds, chunk_size)
+            plans = planner.plan_stages(
+                conn.cursor(), [(name, stage) for name, _, stage in stages], profile
+            )
+    workers = None
+    if track_workers > 0:
+        workers = ThreadPoolExecutor(max_workers=track_workers)
+    variant_count = 0
+    variant_bytes = 0
+    declared = False
+    with open(infile) as fh, open(infile + ".annot", "w") as fh_out:
+        chunks = read_chunks(fh, inds, chunk_size=chunk_size)
+        while True:
+            with metrics.stage("read"):
+                before = metrics.traced_bytes()
+                chunk = next(chunks, None)
+                chunk_bytes = metrics.traced_bytes() - before
+            if chunk is None:
+                break
+            # header lines are all in the first chunk
+            if not declared:
+                chunk = declare_input_info(chunk)
+                declared = True
+            if track_versions:
+                chunk = reference.retag(chunk, track_versions)
+                track_versions = None
+
+            if target_filter is None:
+                variants = variants_in(chunk)
+            else:
+                with metrics.stage("targets"):
+                    chunk, variants = target_filter.split(chunk)
+            variant_count = variant_count + len(variants)
+            variant_bytes = variant_bytes + chunk_bytes
+            inputs = [str(v.info) for v in variants]
+            if workers is None:
+                for name, _, stage in stages:
+                    with metrics.stage(name):
+                        stage.annotate(variants, memo=memo)
+            else:
+                lookups = [
+                    workers.submit(timed_lookup, metrics, name, stage, variants, memo)
+                    for name, _, stage in stages
+                ]
+                for (name, _, stage), results in zip(stages, lookups):
+                    results = results.result()
+                    with metrics.stage(name):
+                        stage.apply_chunk(variants, results)
+
+            with metrics.stage("write"):
+                for v, text in zip(variants, inputs):
+                    mark_input(v, text)
+                write_chunk(fh_out, chunk)
+
+    with open(infile + ".count.log", "w") as fh_log:
+        for _, message, stage in stages:
+            stage.finish(fh_log)
+            print(message)
+        if memo is not None:
+            fh_log.write(memo.summary(variant_count))
+        if target_filter is not None:
+            fh_log.write(target_filter.summary())
+    conn.close()
+    if workers is not None:
+        workers.shutdown()
+    if engine is not None:
+        print(
+            f"Lookups: {engine.queries} queries in {engine.seconds:.2f}s "
+            f"({engine.qps():.1f} queries/s) over {lookup_connections} connections"
+        )
+        engine.close()
+
     finalout = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
     os.rename(infile + ".annot", finalout)
 
+    metrics.value("variants", variant_count)
+    if memo is not None:
+        metrics.value("dedup_loci", memo.loci())
+        metrics.value("dedup_hits", memo.hits)
+    if len(plans) > 0:
+        metrics.value("plan", planner.report(plans))
+    if engine is not None:
+        metrics.value("lookups", engine.stats())
+    if workers is not None:
+        metrics.value("track_workers", track_workers)
+    if target_filter is not None:
+        metrics.value("targets", target_filter.stats(len(stages)))
+    if track_memory and variant_count > 0:
+        metrics.value("chunk_size", chunk_size)
+        metrics.value("bytes_per_variant", variant_bytes // variant_count)
+    metrics.write(infile + ".metrics.json")
+
 
 ### EOF
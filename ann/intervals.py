@@ -0,0 +1,313 @@
+# intervals.py
+#
+# In-memory interval indexes for reference tracks
+#
+# Each index keeps one set of flat, sorted integer arrays per chromosome
+# and answers lookups by bisection instead of a database query per
+# variant. Indexes are plain picklable objects so reference.py can cache
+# them per process and snapshot them to disk. When NumPy is installed,
+# batch lookups search the arrays for all positions of a chromosome at
+# once (the arrays are shared with NumPy, not copied).
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+from array import array
+from bisect import bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+"""Chromosome key, compared the way MySQL compares the chrom column
+(case-insensitive, trailing spaces ignored)
+"""
+
+
+def chrom_key(chrom):
+    return str(chrom).rstrip().lower()
+
+
+"""Closed intervals [start, end] answering "which rows contain pos"
+
+Intervals are sorted by start; max_ends[i] is the largest end among the
+first i + 1 intervals, so the backward scan from the bisection point
+stops as soon as no earlier interval can reach pos. For non-overlapping
+tracks such as cytoBand that is one bisection and one or two compares.
+Matches are returned in table order, as the equivalent SQL would.
+"""
+
+
+class IntervalIndex(object):
+    def __init__(self):
+        self.chroms = {}
+        self.size = 0
+
+    @classmethod
+    def build(cls, rows):
+        index = cls()
+        by_chrom = {}
+        for order, (chrom, start, end, value) in enumerate(rows):
+            by_chrom.setdefault(chrom_key(chrom), []).append(
+                (int(start), int(end), order, value)
+            )
+
+        for chrom, intervals in by_chrom.items():
+            intervals.sort(key=lambda x: (x[0], x[2]))
+            starts = array("q", [i[0] for i in intervals])
+            ends = array("q", [i[1] for i in intervals])
+            orders = array("q", [i[2] for i in intervals])
+            max_ends = array("q", ends)
+            for i in range(1, len(max_ends)):
+                if max_ends[i - 1] > max_ends[i]:
+                    max_ends[i] = max_ends[i - 1]
+            values = [i[3] for i in intervals]
+            index.chroms[chrom] = (starts, ends, max_ends, orders, values)
+            index.size = index.size + len(intervals)
+        return index
+
+    """Values of the rows containing pos, or overlapping [pos, end] when
+    end is given, in table order
+    """
+
+    def overlapping(self, chrom, pos, end=None):
+        entry = self.chroms.get(chrom_key(chrom))
+        if entry is None:
+            return []
+        starts, ends, max_ends, orders, values = entry
+
+        hits = []
+        i = bisect_right(starts, pos if end is None else end) - 1
+        while i >= 0 and max_ends[i] >= pos:
+            if ends[i] >= pos:
+                hits.append((orders[i], values[i]))
+            i = i - 1
+        hits.sort(key=lambda x: x[0])
+        return [value for _, value in hits]
+
+    """Batch form of overlapping for many (chrom, pos) queries
+    """
+
+    def overlapping_many(self, queries):
+        return self.overlapping_spans([(chrom, pos, pos) for chrom, pos in queries])
+
+    """Rows overlapping each of many (chrom, start, end) spans, closed
+
+    Queries are grouped by chromosome; each group is searched with NumPy
+    if it is installed and scanned with bisect otherwise. Results come
+    back in the order of the queries.
+    """
+
+    def overlapping_spans(self, queries):
+        results = [[] for _ in queries]
+        by_chrom = {}
+        for n, (chrom, start, end) in enumerate(queries):
+            by_chrom.setdefault(chrom, []).append((end, start, n))
+
+        for chrom, spans in by_chrom.items():
+            entry = self.chroms.get(chrom_key(chrom))
+            if entry is None:
+                continue
+            if np is None:
+                self.scan(entry, spans, results)
+            else:
+                self.search(entry, spans, results)
+        return results
+
+    """Answers (end, start, n) spans in order of their ends, so each
+    bisection only searches the part of the array past the previous one
+    """
+
+    def scan(self, entry, spans, results):
+        starts, ends, max_ends, orders, values = entry
+        spans.sort()
+        lo = 0
+        for end, start, n in spans:
+            lo = bisect_right(starts, end, lo)
+            hits = []
+            i = lo - 1
+            while i >= 0 and max_ends[i] >= start:
+                if ends[i] >= start:
+                    hits.append((orders[i], values[i]))
+                i = i - 1
+            hits.sort(key=lambda x: x[0])
+            results[n] = [value for _, value in hits]
+
+    """Vectorized form of scan: the candidate rows of all spans are
+    expanded into one array of (query, row) pairs, rows that end before
+    their span starts are masked out and the hits sorted by query and
+    table order, so Python only touches the rows that matched
+    """
+
+    def search(self, entry, spans, results):
+        starts, ends, max_ends, orders, values = entry
+        spans.sort()
+        lo_pos = np.fromiter([s for _, s, _ in spans], dtype=np.int64)
+        hi_pos = np.fromiter([e for e, _, _ in spans], dtype=np.int64)
+        slots = np.fromiter([n for _, _, n in spans], dtype=np.int64)
+        query, rows = candidates(starts, max_ends, lo_pos, hi_pos)
+        if len(rows) == 0:
+            return
+
+        hit = np.frombuffer(ends, dtype=np.int64)[rows] >= lo_pos[query]
+        query = query[hit]
+        rows = rows[hit]
+        ordered = np.lexsort((np.frombuffer(orders, dtype=np.int64)[rows], query))
+
+        for n, i in zip(slots[query[ordered]].tolist(), rows[ordered].tolist()):
+            results[n].append(values[i])
+
+
+"""Candidate rows of spans [lo_pos[k], hi_pos[k]] as (query, row) arrays
+
+Rows are sorted by start and reach is non-decreasing (the running max
+end, or the ends of disjoint runs), so the rows that start at or before
+hi_pos[k] and whose reach gets to lo_pos[k] form one range per span,
+found with two searchsorted calls; the ranges are expanded into flat
+arrays with one entry per candidate. Needs NumPy.
+"""
+
+
+def candidates(starts, reach, lo_pos, hi_pos):
+    hi = np.searchsorted(np.frombuffer(starts, dtype=np.int64), hi_pos, "right")
+    lo = np.searchsorted(np.frombuffer(reach, dtype=np.int64), lo_pos, "left")
+    counts = np.maximum(hi - lo, 0)
+    total = int(counts.sum())
+    query = np.repeat(np.arange(len(lo_pos)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    rows = np.repeat(lo, counts) + np.arange(total) - first
+    return query, rows
+
+
+"""Percent of each (start, end) span inside the matching (ref_start,
+ref_end) interval, rounded as utils.proportionOverlap does; computed
+for the whole batch at once when NumPy is installed
+"""
+
+
+def overlap_percents(pairs):
+    if len(pairs) == 0:
+        return []
+    if np is None:
+        return [
+            round((float(max(0, min(e, re) - max(s, rs) + 1)) / (e - s + 1)) * 100, 2)
+            for s, e, rs, re in pairs
+        ]
+    spans = np.array(pairs, dtype=np.int64)
+    start, end, ref_start, ref_end = spans.T
+    bases = np.maximum(np.minimum(end, ref_end) - np.maximum(start, ref_start) + 1, 0)
+    percents = bases / (end - start + 1).astype(np.float64) * 100
+    return [round(p, 2) for p in percents.tolist()]
+
+
+"""Positions covered by any interval of a track
+
+Only membership is kept: overlapping and adjacent closed intervals are
+merged into disjoint runs stored as two flat arrays per chromosome, so
+a lookup is one bisection and the mask is usually much smaller than the
+rows it was built from.
+"""
+
+
+class CoverageMask(object):
+    def __init__(self):
+        self.chroms = {}
+        self.size = 0
+        self.source_rows = 0
+
+    @classmethod
+    def build(cls, rows):
+        mask = cls()
+        by_chrom = {}
+        for chrom, start, end in rows:
+            by_chrom.setdefault(chrom_key(chrom), []).append((int(start), int(end)))
+            mask.source_rows = mask.source_rows + 1
+
+        for chrom, intervals in by_chrom.items():
+            intervals.sort()
+            starts = array("q")
+            ends = array("q")
+            for start, end in intervals:
+                if start > end:
+                    continue
+                if len(ends) > 0 and start <= ends[-1] + 1:
+                    if end > ends[-1]:
+                        ends[-1] = end
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            mask.chroms[chrom] = (starts, ends)
+            mask.size = mask.size + len(starts)
+        return mask
+
+    def covers(self, chrom, pos):
+        entry = self.chroms.get(chrom_key(chrom))
+        if entry is None:
+            return False
+        starts, ends = entry
+        i = bisect_right(starts, pos) - 1
+        return i >= 0 and ends[i] >= pos
+
+    """(bases, percent) of each (chrom, start, end) span covered by the
+    mask, the percent rounded as utils.proportionOverlap does; (0, 0.0)
+    when none of it is. Test bases for overlap: a long span covered by a
+    few bases rounds to 0.0 percent
+    """
+
+    def coverage_many(self, queries):
+        results = [(0, 0.0)] * len(queries)
+        by_chrom = {}
+        for n, (chrom, start, end) in enumerate(queries):
+            by_chrom.setdefault(chrom, []).append((start, end, n))
+
+        for chrom, spans in by_chrom.items():
+            entry = self.chroms.get(chrom_key(chrom))
+            if entry is None:
+                continue
+            if np is None:
+                covered = self.scan(entry, spans)
+            else:
+                covered = self.search(entry, spans)
+            for (start, end, n), bases in zip(spans, covered):
+                if bases > 0:
+                    percent = round((float(bases) / (end - start + 1)) * 100, 2)
+                    results[n] = (bases, percent)
+        return results
+
+    """Bases of each span covered, by bisection; runs are disjoint, so
+    the bases of the runs a span overlaps add up
+    """
+
+    def scan(self, entry, spans):
+        starts, ends = entry
+        covered = []
+        for start, end, n in spans:
+            bases = 0
+            i = bisect_right(starts, end) - 1
+            while i >= 0 and ends[i] >= start:
+                bases = bases + min(end, ends[i]) - max(start, starts[i]) + 1
+                i = i - 1
+            covered.append(bases)
+        return covered
+
+    def search(self, entry, spans):
+        starts, ends = entry
+        lo_pos = np.fromiter([s for s, _, _ in spans], dtype=np.int64)
+        hi_pos = np.fromiter([e for _, e, _ in spans], dtype=np.int64)
+        query, rows = candidates(starts, ends, lo_pos, hi_pos)
+        first = np.maximum(np.frombuffer(starts, dtype=np.int64)[rows], lo_pos[query])
+        last = np.minimum(np.frombuffer(ends, dtype=np.int64)[rows], hi_pos[query])
+        bases = np.bincount(query, weights=last - first + 1, minlength=len(spans))
+        return bases.astype(np.int64).tolist()
+
+    def nbytes(self):
+        return sum(
+            [s.itemsize * len(s) + e.itemsize * len(e) for s, e in self.chroms.values()]
+        )
+
+
+### EOF
@@ -0,0 +1,94 @@
+# lookups.py
+#
+# Concurrent reference lookups for tracks that stay in the database
+#
+# pymysql blocks for a full round trip on every query, so a stage that
+# looks up one variant at a time is capped at 1/RTT queries per second.
+# The engine runs a stage's queries as asyncio tasks over a small pool of
+# connections, each query on a worker thread, with at most in_flight of
+# them outstanding. Results come back in the order of the inputs, so the
+# stages apply them and records are written in sequence as before.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import utils as u
+
+"""Runs fn(cursor, item) for many items concurrently
+
+A MySQL connection carries one query at a time, so no more than
+connections queries actually run at once; in_flight bounds how many are
+started (and waiting for a connection) by one map() call. Several stages
+may call map() at the same time from their own threads: each call runs
+its own event loop and they share the connection pool.
+"""
+
+
+class LookupEngine(object):
+    def __init__(self, connections=4, in_flight=8):
+        self.connections = connections
+        self.in_flight = max(1, in_flight)
+        self.conns = [u.db_connect() for _ in range(connections)]
+        self.cursors = queue.Queue()
+        for conn in self.conns:
+            self.cursors.put(conn.cursor())
+        self.executor = ThreadPoolExecutor(max_workers=connections)
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.seconds = 0.0
+
+    def call(self, fn, item):
+        cursor = self.cursors.get()
+        try:
+            return fn(cursor, item)
+        finally:
+            self.cursors.put(cursor)
+
+    async def gather(self, fn, items):
+        loop = asyncio.get_running_loop()
+        limit = asyncio.Semaphore(self.in_flight)
+
+        async def run(item):
+            async with limit:
+                return await loop.run_in_executor(self.executor, self.call, fn, item)
+
+        # gather returns results in the order of items
+        return await asyncio.gather(*[run(item) for item in items])
+
+    def map(self, fn, items):
+        if len(items) == 0:
+            return []
+        started = time.perf_counter()
+        results = asyncio.run(self.gather(fn, items))
+        with self.lock:
+            self.seconds = self.seconds + time.perf_counter() - started
+            self.queries = self.queries + len(items)
+        return list(results)
+
+    def qps(self):
+        return self.queries / self.seconds if self.seconds > 0 else 0.0
+
+    def stats(self):
+        return {
+            "connections": self.connections,
+            "in_flight": self.in_flight,
+            "queries": self.queries,
+            "seconds": round(self.seconds, 4),
+            "qps": round(self.qps(), 1),
+        }
+
+    def close(self):
+        self.executor.shutdown()
+        for conn in self.conns:
+            conn.close()
+
+
+### EOF
@@ -0,0 +1,242 @@
+# metrics.py
+#
+# Collects per-stage job metrics for the AnnTools pipeline
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+"""Peak resident set size (in KB) for this process
+
+On Linux the high-water mark (VmHWM) can be reset between stages by
+writing "5" to /proc/self/clear_refs, which gives a true per-stage peak.
+Elsewhere we fall back to ru_maxrss, which is the peak for the process.
+"""
+
+
+def read_rss_kb(field="VmHWM"):
+    try:
+        with open("/proc/self/status", "r") as fh:
+            for line in fh:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    if resource is not None:
+        return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+    return 0
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as fh:
+            fh.write("5")
+        return True
+    except OSError:
+        return False
+
+
+"""Background sampler that follows traced memory during a stage
+
+Transient allocations (e.g. a large fetchall) are freed before the stage
+returns, so a snapshot taken at the end would not show them. The sampler
+takes a new snapshot each time traced memory climbs past the last one.
+For a stage that already ran, floor is the peak it reached then; only a
+higher peak is worth a (slow) snapshot.
+"""
+
+
+class MemorySampler(threading.Thread):
+    def __init__(self, interval=0.05, floor=0):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.floor = floor
+        self.peak_snapshot = None
+        self.peak_traced = 0
+        self.peak_rss_kb = 0
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.floor and (
+            current > self.peak_traced * 1.05 or self.peak_snapshot is None
+        ):
+            self.peak_traced = current
+            self.peak_snapshot = tracemalloc.take_snapshot()
+        self.peak_rss_kb = max(self.peak_rss_kb, read_rss_kb("VmRSS"))
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+
+"""Metrics for a single annotation job
+
+Stage wall times are always recorded. Memory tracking (peak RSS and the
+top allocation sites per stage) is optional because tracemalloc slows
+the pipeline down noticeably. A stage entered more than once (e.g. once
+per chunk of variants) is reported as one record: times add up, memory
+figures are the peak over all its runs. timer() only adds time to a
+stage's record and may be used from other threads while stage() runs.
+"""
+
+
+class JobMetrics(object):
+    def __init__(self, track_memory=False, top_sites=10, interval=0.05):
+        self.track_memory = track_memory
+        self.top_sites = top_sites
+        self.interval = interval
+        self.started_at = time.time()
+        self.stages = []
+        self.values = {}
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def record(self, name):
+        with self._lock:
+            record = self._records.get(name)
+            if record is None:
+                record = {"stage": name, "seconds": 0.0}
+                self._records[name] = record
+                self.stages.append(record)
+            return record
+
+    def add_seconds(self, record, seconds):
+        with self._lock:
+            record["seconds"] = round(record["seconds"] + seconds, 4)
+
+    @contextmanager
+    def stage(self, name):
+        record = self.record(name)
+        sampler = None
+
+        if self.track_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(1)
+            tracemalloc.reset_peak()
+            record["peak_rss_scope"] = "stage" if reset_peak_rss() else "process"
+            sampler = MemorySampler(
+                interval=self.interval,
+                floor=record.get("peak_traced_kb", 0) * 1024,
+            )
+            sampler.start()
+
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add_seconds(record, time.perf_counter() - start)
+            if sampler is not None:
+                sampler.stop()
+                record["peak_rss_kb"] = max(
+                    read_rss_kb(), sampler.peak_rss_kb, record.get("peak_rss_kb", 0)
+                )
+                record["peak_traced_kb"] = max(
+                    tracemalloc.get_traced_memory()[1] // 1024,
+                    record.get("peak_traced_kb", 0),
+                )
+                if sampler.peak_snapshot is not None or "top_allocations" not in record:
+                    record["top_allocations"] = self.top_allocations(
+                        sampler.peak_snapshot
+                    )
+
+    """Adds the wall time of the block to stage name, without memory
+    figures
+    """
+
+    @contextmanager
+    def timer(self, name):
+        record = self.record(name)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            self.add_seconds(record, time.perf_counter() - start)
+
+    """Bytes currently allocated as seen by tracemalloc (0 when memory is
+    not tracked)
+    """
+
+    def traced_bytes(self):
+        if not tracemalloc.is_tracing():
+            return 0
+        return tracemalloc.get_traced_memory()[0]
+
+    def value(self, name, value):
+        self.values[name] = value
+
+    """Largest allocation sites in snapshot, leaving out the profiler's own
+
+    Sites are grouped first and the excluded files dropped from the
+    result; filtering every trace beforehand costs seconds per call once
+    the reference indexes are loaded.
+    """
+
+    def top_allocations(self, snapshot):
+        if snapshot is None:
+            return []
+        excluded = set(
+            [
+                tracemalloc.__file__,
+                __file__,
+                threading.__file__,
+                "<frozen importlib._bootstrap>",
+            ]
+        )
+        sites = []
+        for stat in snapshot.statistics("lineno"):
+            frame = stat.traceback[0]
+            if frame.filename in excluded:
+                continue
+            sites.append(
+                {
+                    "site": f"{os.path.basename(frame.filename)}:{frame.lineno}",
+                    "size_kb": round(stat.size / 1024, 1),
+                    "count": stat.count,
+                }
+            )
+            if len(sites) >= self.top_sites:
+                break
+        return sites
+
+    def as_dict(self):
+        summary = {
+            "started_at": int(self.started_at),
+            "total_seconds": round(time.time() - self.started_at, 4),
+            "track_memory": self.track_memory,
+            "stages": self.stages,
+        }
+        summary.update(self.values)
+        if self.track_memory:
+            summary["peak_rss_kb"] = max(
+                [s.get("peak_rss_kb", 0) for s in self.stages] + [0]
+            )
+        return summary
+
+    def write(self, path):
+        with open(path, "w") as fh:
+            json.dump(self.as_dict(), fh, indent=2)
+        if self.track_memory:
+            tracemalloc.stop()
+
+
+### EOF
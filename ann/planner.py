@@ -0,0 +1,231 @@
+# planner.py
+#
+# Chooses how each interval track of a job is looked up
+#
+# A track answered from MySQL by interval overlap can be looked up with
+# one query per variant (point), one range query per window of nearby
+# variants (window) or by loading the whole table into memory once
+# (preload). Which is cheapest depends on the input (how many variants,
+# how spread out) and on the table (rows, interval length), so the
+# driver asks the planner before the first chunk is read. Costs are
+# estimated in seconds from a simple model whose constants are in
+# [planner] in annotator_config.ini; predicted and actual costs are
+# logged per job.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import reference
+from annotate import POINT, PRELOAD, WINDOW, WINDOW_SIZE, trackIndexName
+
+MODES = [POINT, WINDOW, PRELOAD]
+
+
+"""Cost model constants, in seconds unless noted
+"""
+
+
+def read_settings():
+    config = reference.read_config()
+    return {
+        # one query round trip to the database
+        "query": config.getfloat("planner", "QueryCost", fallback=0.0005),
+        # fetching and matching one row
+        "row": config.getfloat("planner", "RowCost", fallback=0.00001),
+        # loading and indexing one row of a table that is not cached yet
+        "load_row": config.getfloat("planner", "LoadRowCost", fallback=0.00002),
+        # one in-memory interval lookup
+        "probe": config.getfloat("planner", "ProbeCost", fallback=0.000005),
+        # bases the tracks are spread over
+        "genome_size": config.getint("planner", "GenomeSize", fallback=3100000000),
+        # largest span of one window query, in bases
+        "window_size": config.getint("planner", "WindowSize", fallback=WINDOW_SIZE),
+    }
+
+
+"""Variant count and per-chromosome spread of an input file, read with a
+quick scan of the CHROM and POS columns
+"""
+
+
+class InputProfile(object):
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.variants = 0
+        self.spans = {}
+
+    def add(self, chrom, pos):
+        self.variants = self.variants + 1
+        span = self.spans.get(chrom)
+        if span is None:
+            self.spans[chrom] = [pos, pos, 1]
+        else:
+            span[0] = min(span[0], pos)
+            span[1] = max(span[1], pos)
+            span[2] = span[2] + 1
+
+    """Estimated (window queries, bases covered by them) for windows of
+    up to size bases; windows never span chunks
+    """
+
+    def windows(self, size):
+        count = 0
+        covered = 0
+        for lo, hi, n in self.spans.values():
+            span = hi - lo + 1
+            count = count + min(n, span // (size + 1) + 1)
+            covered = covered + min(span, n * size)
+        chunks = -(-self.variants // self.chunk_size)
+        count = min(self.variants, count + max(0, chunks - 1))
+        return count, covered
+
+
+def profile_input(infile, inds, chunk_size):
+    profile = InputProfile(chunk_size)
+    split_at = max(inds[0], inds[1]) + 1
+    with open(infile) as fh:
+        for line in fh:
+            if line.startswith("#") or line.startswith("CHROM"):
+                continue
+            fields = line.split("\t", split_at)
+            try:
+                pos = int(fields[inds[1]])
+            except (IndexError, ValueError):
+                continue
+            profile.add(fields[inds[0]].strip(), pos)
+    return profile
+
+
+"""Row count and average interval length of a track's table, cached
+per reference version
+"""
+
+
+def tableStats(cursor, track):
+    def build():
+        cursor.execute(
+            "select count(*), avg("
+            + track.end
+            + " - "
+            + track.start
+            + " + 1) from "
+            + track.table
+            + ";"
+        )
+        rows, avg_length = cursor.fetchone()
+        return int(rows), float(avg_length or 0)
+
+    return reference.cached(f"stats.{track.table}.{track.start}.{track.end}", build)
+
+
+"""Predicted (seconds, queries) of each mode for track on profile
+"""
+
+
+def estimate(track, stats, profile, settings, cached=False):
+    rows, avg_length = stats
+    n = profile.variants
+    density = rows / float(settings["genome_size"])
+    reach = avg_length + 2 * track.pad
+
+    point_rows = n * density * reach
+    point = n * settings["query"] + point_rows * settings["row"]
+
+    windows, covered = profile.windows(settings["window_size"])
+    window_rows = min(rows, density * (covered + windows * reach))
+    window = (
+        windows * settings["query"]
+        + window_rows * settings["row"]
+        + n * settings["probe"]
+    )
+
+    if cached:
+        preload = rows * settings["row"] + n * settings["probe"]
+        preload_queries = 0
+    else:
+        preload = (
+            settings["query"] + rows * settings["load_row"] + n * settings["probe"]
+        )
+        preload_queries = 1
+
+    return {
+        POINT: (point, n),
+        WINDOW: (window, windows),
+        PRELOAD: (preload, preload_queries),
+    }
+
+
+"""The mode chosen for one stage and the estimates it was chosen from
+"""
+
+
+class TrackPlan(object):
+    def __init__(self, name, stage, mode, estimates):
+        self.name = name
+        self.stage = stage
+        self.mode = mode
+        self.estimates = estimates
+
+    def as_dict(self):
+        seconds, queries = self.estimates[self.mode]
+        return {
+            "track": self.name,
+            "table": self.stage.track.table,
+            "mode": self.mode,
+            "predicted_seconds": round(seconds, 6),
+            "predicted_queries": int(round(queries)),
+            "actual_seconds": round(self.stage.lookup_seconds, 6),
+            "actual_queries": self.stage.track.queries,
+            "estimates": dict(
+                [(mode, round(cost[0], 6)) for mode, cost in self.estimates.items()]
+            ),
+        }
+
+
+"""Sets plan on every stage with an IntervalTrack to the cheapest mode
+for profile; stages is a list of (name, stage)
+"""
+
+
+def plan_stages(cursor, stages, profile):
+    settings = read_settings()
+    plans = []
+    for name, stage in stages:
+        if stage.track is None:
+            continue
+        estimates = estimate(
+            stage.track,
+            tableStats(cursor, stage.track),
+            profile,
+            settings,
+            cached=reference.is_cached(trackIndexName(stage.track)),
+        )
+        mode = min(MODES, key=lambda m: estimates[m][0])
+        stage.plan = mode
+        stage.window_size = settings["window_size"]
+        plans.append(TrackPlan(name, stage, mode, estimates))
+    return plans
+
+
+"""Prints predicted versus actual cost of each plan once the job is done
+and returns them for the job's metrics
+"""
+
+
+def report(plans):
+    entries = []
+    for plan in plans:
+        entry = plan.as_dict()
+        print(
+            f"Plan {entry['track']}: {entry['mode']} (predicted "
+            f"{entry['predicted_seconds']:.3f}s in {entry['predicted_queries']} "
+            f"queries, actual {entry['actual_seconds']:.3f}s in "
+            f"{entry['actual_queries']} queries)"
+        )
+        entries.append(entry)
+    return entries
+
+
+### EOF
@@ -0,0 +1,406 @@
+# reannotate.py
+#
+# Incremental re-annotation of stored results after reference tables
+# are reloaded
+#
+# Reloading one table (say gwasCatalog) leaves every stored result stale
+# for that track only. Instead of running whole jobs again, the stored
+# .annot.vcf is fetched from the results bucket, the INFO keys owned by
+# the track are stripped and only its stage runs again, together with
+# any stage that reads or shares its output (driver.refresh_tracks).
+# The INFO each record came with is kept as it was: the driver records
+# its length in every annotated record (records.mark_input), so results
+# written before that cannot be refreshed and are reported as failed. The
+# refreshed result is tagged with a ##trackVersion header line for each
+# of those tracks, from [track_versions] in annotator_config.ini (new
+# results are tagged for every track they ran), and written back over
+# the stored one. Runs as a batch over all completed
+# jobs (or the ones given); jobs already tagged with the current
+# versions are left alone, so an interrupted batch can simply be run
+# again:
+#
+#   python reannotate.py gwasCatalog [--jobs <job id> ...] [--dry-run]
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import boto3
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import BotoCoreError, ClientError
+
+import annotate as ann
+import driver
+import planner
+import reference
+import utils as u
+from records import (
+    CHUNK_SIZE,
+    INPUT_INFO_HEADER,
+    mark_input,
+    read_chunks,
+    split_input,
+    variants_in,
+    write_chunk,
+)
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read("annotator_config.ini")
+
+
+"""Header lines of the result at path
+"""
+
+
+def read_header(path):
+    lines = []
+    with open(path) as fh:
+        for line in fh:
+            if not line.startswith("#"):
+                break
+            lines.append(line.strip())
+    return lines
+
+
+"""Runs again the stages of a job's pipeline that changed tracks affect
+
+Each annotated record's INFO starts with the input's INFO, whose length
+the driver recorded (records.mark_input); that is kept verbatim. The
+rest is split into the entries written by each stage, walking its ';'
+separated entries in pipeline order; an entry without a key of its own
+("p5;p6" is one cytoBand) goes with the entry before it. INFO up to the
+last entry written before the first refreshed stage is kept as it is.
+From there the stages are replayed in order: refreshed stages apply
+their new lookups and the others write back what they wrote before, the
+way they write it (driver.APPENDS and ALWAYS_WRITES). The record ends up
+as if it had been annotated from scratch, while the other tracks are
+never looked up. Records that were not annotated are left alone.
+
+entries are the job's parsed pipeline entries and stages the (name,
+message, stage) of the stages to run again, in pipeline order (see
+build_refresher).
+"""
+
+
+class Refresher(object):
+    def __init__(self, entries, stages, conn=None):
+        self.conn = conn
+        self.stages = stages
+        self.names = [name for name, _, _ in self.stages]
+
+        # (name, stage if refreshed, INFO keys, appends, always writes) in
+        # pipeline order
+        refreshed = dict([(name, stage) for name, _, stage in self.stages])
+        self.pipeline = [
+            (
+                name,
+                refreshed.get(name),
+                set(driver.info_keys(kind, params)),
+                kind in driver.APPENDS,
+                kind in driver.ALWAYS_WRITES,
+            )
+            for name, kind, params in entries
+        ]
+        self.known = set().union(*[entry[2] for entry in self.pipeline])
+        self.first = [entry[0] for entry in self.pipeline].index(self.names[0])
+        self.variants = 0
+
+    """Key of each INFO entry, see Refresher
+    """
+
+    def keys_of(self, info):
+        keys = []
+        for entry in info:
+            key = entry.partition("=")[0]
+            if "=" not in entry and key not in self.known and len(keys) > 0:
+                key = keys[-1]
+            keys.append(key)
+        return keys
+
+    """Entries of info (INFO after the input's) written by each stage
+
+    An entry whose key consecutive stages all write goes to the last of
+    them, as GeneStage, which always writes, comes after BigRefGene.
+    """
+
+    def segments(self, info):
+        segments = [[] for _ in range(len(self.pipeline))]
+        at = 0
+        for entry, key in zip(info, self.keys_of(info)):
+            for n in range(at, len(self.pipeline)):
+                if key in self.pipeline[n][2]:
+                    at = n
+                    while (
+                        at + 1 < len(self.pipeline) and key in self.pipeline[at + 1][2]
+                    ):
+                        at = at + 1
+                    break
+            segments[at].append(entry)
+        return segments
+
+    def refresh_chunk(self, variants):
+        inputs = [split_input(v.info) for v in variants]
+        variants = [v for v, (_, length) in zip(variants, inputs) if length is not None]
+        inputs = [(text, length) for text, length in inputs if length is not None]
+        results = dict(
+            [(name, stage.lookup_chunk(variants)) for name, _, stage in self.stages]
+        )
+        for n, (v, (text, length)) in enumerate(zip(variants, inputs)):
+            for _, _, stage in self.stages:
+                stage.clear(v)
+            # the stages' entries follow the input's, after a ';' unless
+            # the input ended with one
+            input_text = text[:length]
+            offset = length + 1 if text[length : length + 1] == ";" else length
+            info = text[offset:].split(";") if offset < len(text) else []
+            segments = self.segments(info)
+            start = 0
+            for m in range(self.first):
+                if len(segments[m]) > 0:
+                    start = m + 1
+            written = sum([len(segment) for segment in segments[:start]])
+            if written > 0:
+                kept = text[: offset + len(";".join(info[:written]))]
+            else:
+                kept = input_text
+            # INFO is never empty; "." if only refreshed stages wrote to it
+            # (a "." input a stage replaced)
+            v.info.reset(kept or ".")
+            for m in range(start, len(self.pipeline)):
+                name, stage, _, appends, always = self.pipeline[m]
+                if stage is not None:
+                    stage.apply(v, results[name][n])
+                elif len(segments[m]) == 0 and not always:
+                    continue
+                elif appends:
+                    v.info.append(";".join(segments[m]))
+                else:
+                    v.info.add(";".join(segments[m]))
+            mark_input(v, input_text or ".")
+        self.variants = self.variants + len(variants)
+
+    """Refreshes the result at path in place and tags it with versions
+    """
+
+    def refresh_file(self, path, versions, chunk_size=CHUNK_SIZE, plan=False):
+        if INPUT_INFO_HEADER not in read_header(path):
+            raise ValueError(
+                "annotated before input INFO was marked, run the job again"
+            )
+        inds = ann.getFormatSpecificIndices(format="vcf")
+        if plan:
+            planner.plan_stages(
+                self.conn.cursor(),
+                [(name, stage) for name, _, stage in self.stages],
+                planner.profile_input(path, inds, chunk_size),
+            )
+        with open(path) as fh, open(path + ".refresh", "w") as fh_out:
+            # header lines are all in the first chunk
+            tagged = False
+            for chunk in read_chunks(fh, inds, sep=None, chunk_size=chunk_size):
+                if not tagged:
+                    chunk = reference.retag(chunk, versions)
+                    tagged = True
+                self.refresh_chunk(variants_in(chunk))
+                write_chunk(fh_out, chunk)
+        os.replace(path + ".refresh", path)
+
+    def close(self):
+        for _, message, stage in self.stages:
+            stage.close()
+            print(message)
+
+
+"""Refresher for a job of pipeline and tracks whose changed tracks'
+tables were reloaded
+"""
+
+
+def build_refresher(pipeline, tracks, changed, conn, dbsnp_filter=None, spans=False):
+    entries = driver.select_tracks(driver.parse_pipeline(pipeline), tracks)
+    stages = []
+    for name, message, factory in driver.build_stages(
+        conn,
+        dbsnp_filter=dbsnp_filter,
+        pipeline=pipeline,
+        tracks=driver.refresh_tracks(entries, changed),
+    ):
+        stage = factory()
+        stage.set_spans(spans)
+        stages.append((name, message, stage))
+    return Refresher(entries, stages, conn=conn)
+
+
+def dbsnp_filter_path():
+    path = config.get("dbsnp_filter", "Path", fallback=None)
+    if config.getboolean("dbsnp_filter", "Enabled", fallback=False) and path:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+"""Completed jobs with a stored result, or the jobs in job_ids
+"""
+
+
+def stored_jobs(table, job_ids=None):
+    if job_ids:
+        for job_id in job_ids:
+            job = table.get_item(Key={"job_id": job_id}).get("Item")
+            if job is None:
+                print(f"{job_id}: no such job")
+            elif job.get("results_file_archive_id"):
+                print(f"{job_id}: result is archived")
+            elif job.get("s3_key_result_file"):
+                yield job
+        return
+
+    # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/scan.html
+    # archived results keep their key, but the object is gone from S3
+    scan = {
+        "FilterExpression": Attr("job_status").eq("COMPLETED")
+        & Attr("s3_key_result_file").exists()
+        & Attr("results_file_archive_id").not_exists()
+    }
+    while True:
+        response = table.scan(**scan)
+        for job in response["Items"]:
+            yield job
+        if "LastEvaluatedKey" not in response:
+            break
+        scan["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Re-annotate stored results for reloaded reference tables"
+    )
+    parser.add_argument(
+        "tracks", nargs="+", help="Tracks (pipeline stage names) whose tables changed"
+    )
+    parser.add_argument(
+        "--jobs", nargs="+", metavar="JOB_ID", help="Jobs to refresh (default: all)"
+    )
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only list the jobs to refresh"
+    )
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    unknown = [t for t in args.tracks if not config.has_option("stages", t)]
+    if len(unknown) > 0:
+        print(f"Unknown tracks: {', '.join(unknown)}")
+        sys.exit(2)
+
+    region = config.get("aws", "AwsRegionName")
+    s3 = boto3.client("s3", region_name=region)
+    dynamodb = boto3.resource("dynamodb", region_name=region)
+    table = dynamodb.Table(config.get("gas", "AnnotationsTable"))
+
+    conn = u.db_connect()
+    refreshers = {}
+    counts = {"refreshed": 0, "current": 0, "skipped": 0, "failed": 0}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for job in stored_jobs(table, args.jobs):
+            job_id = job["job_id"]
+            try:
+                pipeline = driver.read_pipeline(config, job.get("pipeline"))
+                entries = driver.select_tracks(
+                    driver.parse_pipeline(pipeline), job.get("tracks")
+                )
+            except ValueError as e:
+                print(f"{job_id}: {e}")
+                counts["failed"] = counts["failed"] + 1
+                continue
+            changed = [name for name, _, _ in entries if name in args.tracks]
+            if len(changed) == 0:
+                counts["skipped"] = counts["skipped"] + 1
+                continue
+            if args.dry_run:
+                print(f"{job_id}: {', '.join(changed)} in {job['s3_key_result_file']}")
+                continue
+
+            key = (job.get("pipeline"), str(job.get("tracks")), tuple(changed))
+            if key not in refreshers:
+                refreshers[key] = build_refresher(
+                    pipeline,
+                    job.get("tracks"),
+                    changed,
+                    conn,
+                    dbsnp_filter=dbsnp_filter_path(),
+                    spans=config.getboolean("ann", "Spans", fallback=False),
+                )
+            refresher = refreshers[key]
+            versions = dict(
+                [
+                    (name, reference.track_version(name, config))
+                    for name in refresher.names
+                ]
+            )
+
+            bucket = job["s3_results_bucket"]
+            s3_key = job["s3_key_result_file"]
+            path = os.path.join(work_dir, os.path.basename(s3_key))
+            try:
+                s3.download_file(bucket, s3_key, path)
+                tagged = reference.tagged_versions(read_header(path))
+                if all([tagged.get(n) == versions[n] for n in versions]):
+                    counts["current"] = counts["current"] + 1
+                    continue
+
+                started = time.time()
+                variants = refresher.variants
+                refresher.refresh_file(
+                    path,
+                    versions,
+                    plan=config.getboolean("planner", "Enabled", fallback=False),
+                )
+                s3.upload_file(path, bucket, s3_key)
+                # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table/update_item.html
+                table.update_item(
+                    Key={"job_id": job_id},
+                    UpdateExpression="SET track_versions = :versions",
+                    ExpressionAttributeValues={
+                        ":versions": dict(job.get("track_versions", {}), **versions)
+                    },
+                )
+                print(
+                    f"{job_id}: refreshed {', '.join(refresher.names)} for "
+                    f"{refresher.variants - variants} variants in "
+                    f"{time.time() - started:.2f}s"
+                )
+                counts["refreshed"] = counts["refreshed"] + 1
+            except (ClientError, BotoCoreError, OSError, ValueError) as e:
+                print(f"{job_id}: unable to refresh {s3_key}: {e}")
+                counts["failed"] = counts["failed"] + 1
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    for refresher in refreshers.values():
+        refresher.close()
+    conn.close()
+    print(
+        f"{counts['refreshed']} results refreshed, {counts['current']} already "
+        f"current, {counts['skipped']} skipped, {counts['failed']} failed"
+    )
+    if counts["failed"] > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,390 @@
+# records.py
+#
+# Per-variant record types shared by the annotation stages
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import threading
+from collections import OrderedDict
+
+# Variants parsed and annotated together; bounds the records in memory
+CHUNK_SIZE = 10000
+
+# Distinct loci whose stage lookups a LocusMemo keeps
+DEDUP_MAX_LOCI = 100000
+
+
+"""Ordered builder for a variant's INFO column
+
+Stages add their key/value fragments instead of concatenating strings,
+and the column is only joined when it is read or written. Separators
+follow the rules the stages have always used: append() always puts a
+';' before the fragment, add() only when INFO does not already end with
+one. A stage whose values later stages read passes the fragment's
+(key, value) fields along with it, and get() returns the first value
+added for a key from those fields; INFO is never split to find it.
+
+With strip (INFO is the last column of the line) trailing whitespace is
+dropped from each fragment, as re-reading and stripping the line
+between file-to-file stages used to do.
+"""
+
+
+class InfoBuilder(object):
+    __slots__ = ("_text", "_parts", "_tail", "_fields", "_strip")
+
+    def __init__(self, text, strip=False):
+        self._text = text
+        self._parts = []
+        self._tail = text[-1:]
+        self._fields = []
+        self._strip = strip
+
+    def append(self, fragment, fields=()):
+        if self._strip:
+            fragment = fragment.rstrip()
+        self._parts.append(";")
+        self._parts.append(fragment)
+        self._tail = fragment[-1:] if fragment else ";"
+        self._fields.extend(fields)
+
+    def add(self, fragment, fields=()):
+        if self._strip:
+            fragment = fragment.rstrip()
+        if self._tail == ";":
+            if not fragment:
+                return
+            self._parts.append(fragment)
+            self._tail = fragment[-1:]
+            self._fields.extend(fields)
+        else:
+            self.append(fragment, fields)
+
+    """Replaces INFO with text; the fields read so far are kept unless
+    fields is given
+    """
+
+    def reset(self, text, fields=None):
+        if self._strip:
+            text = text.rstrip()
+        self._text = text
+        self._parts = []
+        self._tail = text[-1:]
+        if fields is not None:
+            self._fields = list(fields)
+
+    def startswith(self, prefix):
+        if len(self._text) >= len(prefix) or not self._parts:
+            return self._text.startswith(prefix)
+        return str(self).startswith(prefix)
+
+    def get(self, key, default="."):
+        for name, value in self._fields:
+            if name == key:
+                return value
+        return default
+
+    def __str__(self):
+        if self._parts:
+            self._parts.insert(0, self._text)
+            self._text = "".join(self._parts)
+            self._parts = []
+        return self._text
+
+
+"""INFO entry closing every annotated record: the length of the INFO
+text that came from the input, which reannotate.py keeps verbatim
+whatever keys it holds. Results carrying it declare it with
+INPUT_INFO_HEADER; records without it (off-target records passed
+through) were not annotated.
+"""
+
+INPUT_INFO_KEY = "inputInfoLength"
+INPUT_INFO_HEADER = (
+    f"##INFO=<ID={INPUT_INFO_KEY},Number=1,Type=Integer,"
+    'Description="Length of the INFO text from the input">'
+)
+
+
+"""Length of the input INFO text still leading info; DbSnpStage replaces
+a "." input and BigRefGeneStage drops a leading ".;"
+"""
+
+
+def input_length(text, info):
+    info = str(info)
+    if info.startswith(text):
+        return len(text)
+    if text.startswith(".;") and info.startswith(text[2:]):
+        return len(text) - 2
+    return 0
+
+
+def mark_input(v, text):
+    v.info.append(f"{INPUT_INFO_KEY}={input_length(text, v.info)}")
+
+
+"""INFO of an annotated record without its INPUT_INFO_KEY entry, and the
+length of the input INFO text it starts with; None for a record that
+was not annotated
+"""
+
+
+def split_input(info):
+    text = str(info)
+    head, _, last = text.rpartition(";")
+    key, _, value = last.partition("=")
+    if key != INPUT_INFO_KEY or not value.isdigit():
+        return text, None
+    return head, int(value)
+
+
+"""Adds INPUT_INFO_HEADER after the ## lines at the start of chunk,
+unless they have it already
+"""
+
+
+def declare_input_info(chunk):
+    if INPUT_INFO_HEADER in chunk:
+        return chunk
+    at = 0
+    while at < len(chunk) and isinstance(chunk[at], str) and chunk[at].startswith("##"):
+        at = at + 1
+    return chunk[:at] + [INPUT_INFO_HEADER] + chunk[at:]
+
+
+"""Contig codes
+
+Each distinct CHROM value is normalized once into the two forms the
+stages compare against: with a "chr" prefix (chrom) and without (bare).
+Records only hold the integer code. The canonical chromosomes are
+registered first, so chr1-chr22, chrX, chrY and chrM are always 1-25.
+"""
+
+CONTIGS = [(None, None)]
+_contig_codes = {}
+_raw_codes = {}
+
+
+def contig_code(raw):
+    code = _raw_codes.get(raw)
+    if code is None:
+        chrom = raw if raw.startswith("chr") else "chr" + raw
+        code = _contig_codes.get(chrom)
+        if code is None:
+            code = len(CONTIGS)
+            CONTIGS.append((chrom, chrom.replace("chr", "")))
+            _contig_codes[chrom] = code
+        _raw_codes[raw] = code
+    return code
+
+
+for c in [str(i) for i in range(1, 23)] + ["X", "Y", "M"]:
+    contig_code("chr" + c)
+
+
+"""Last reference base a variant covers
+
+END from INFO when it is there; otherwise POS + |SVLEN| for symbolic
+alleles other than insertions, and the last base of REF for everything
+else (POS itself for SNVs).
+"""
+
+
+def span_end(pos, ref, alt, info):
+    end = pos + max(len(ref), 1) - 1
+    if "END=" not in info and "SVLEN=" not in info:
+        return end
+    svend = None
+    for field in info.split(";"):
+        key, _, value = field.partition("=")
+        try:
+            if key == "END":
+                return max(pos, int(value))
+            if key == "SVLEN" and alt.startswith("<") and not alt.startswith("<INS"):
+                svend = pos + abs(int(value.split(",")[0]))
+        except ValueError:
+            continue
+    return end if svend is None else max(end, svend)
+
+
+"""A parsed variant line
+
+Parsed once when the input is read and passed through every stage:
+CHROM as a contig code, POS as an int, the last base the variant covers
+(see span_end) as end, REF and ALT stripped, INFO as an InfoBuilder and
+the raw fields, which are joined again with sep when the record is
+written. fields[7] is stale until then.
+"""
+
+
+class Variant(object):
+    __slots__ = ("fields", "contig", "pos", "end", "ref", "alt", "info", "sep")
+
+    def __init__(self, fields, contig, pos, ref, alt, info, sep="\t", end=None):
+        self.fields = fields
+        self.contig = contig
+        self.pos = pos
+        self.end = pos if end is None else end
+        self.ref = ref
+        self.alt = alt
+        self.info = info
+        self.sep = sep
+
+    @property
+    def chrom(self):
+        return CONTIGS[self.contig][0]
+
+    @property
+    def bare_chrom(self):
+        return CONTIGS[self.contig][1]
+
+    def line(self):
+        self.fields[7] = str(self.info)
+        return self.sep.join(self.fields)
+
+
+"""Parses one input line into a Variant; header, comment and blank lines
+are returned as the stripped string
+
+With sep None the separator is found per line: results are written with
+"\t " between fields when GadAllStage matched the variant, "\t" otherwise.
+"""
+
+
+def parse_line(line, inds, sep="\t"):
+    line = line.strip()
+    if line == "" or line.startswith("#") or line.startswith("CHROM"):
+        return line
+    if sep is None:
+        sep = "\t " if "\t " in line else "\t"
+    fields = line.split(sep)
+    pos = int(fields[inds[1]].strip())
+    ref = fields[inds[2]].strip()
+    alt = fields[inds[3]].strip()
+    return Variant(
+        fields,
+        contig_code(fields[inds[0]].strip()),
+        pos,
+        ref,
+        alt,
+        InfoBuilder(fields[7], strip=len(fields) == 8),
+        sep=sep,
+        end=span_end(pos, ref, alt, fields[7]),
+    )
+
+
+"""Reads fh in chunks of up to chunk_size variants
+
+Each chunk is a list of Variants and pass-through lines in file order.
+"""
+
+
+def read_chunks(fh, inds, sep="\t", chunk_size=CHUNK_SIZE):
+    chunk = []
+    count = 0
+    for line in fh:
+        record = parse_line(line, inds, sep)
+        chunk.append(record)
+        if not isinstance(record, str):
+            count = count + 1
+            if count >= chunk_size:
+                yield chunk
+                chunk = []
+                count = 0
+    if len(chunk) > 0:
+        yield chunk
+
+
+def variants_in(chunk):
+    return [r for r in chunk if not isinstance(r, str)]
+
+
+def write_chunk(fh_out, chunk):
+    fh_out.write(
+        "".join([(r if isinstance(r, str) else r.line()) + "\n" for r in chunk])
+    )
+
+
+"""Bounded per-job memo of stage lookups by locus
+
+Entries are keyed by (contig, POS, end, REF, ALT) and hold each stage's
+lookup() result for the locus, so every record repeating a locus is
+annotated from the first lookup (stages still apply() the result to
+each record, keeping counts and INFO per record). Past max_loci the
+least recently used locus is evicted: a locus repeated far apart in a
+huge file may be looked up again, but memory stays capped. Stages may
+use the memo from several threads at once.
+"""
+
+
+class LocusMemo(object):
+    def __init__(self, max_loci=DEDUP_MAX_LOCI):
+        self.max_loci = max_loci
+        self.entries = OrderedDict()
+        self.computed = {}
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def lookup_many(self, stage, variants):
+        entries = self.entries
+        results = [None] * len(variants)
+        pending = {}
+        with self.lock:
+            for n, v in enumerate(variants):
+                key = (v.contig, v.pos, v.end, v.ref, v.alt)
+                entry = entries.get(key)
+                if entry is not None and stage in entry:
+                    entries.move_to_end(key)
+                    results[n] = entry[stage]
+                else:
+                    pending.setdefault(key, []).append(n)
+            self.lookups = self.lookups + len(variants)
+            self.hits = self.hits + len(variants) - len(pending)
+            self.computed[stage] = self.computed.get(stage, 0) + len(pending)
+
+        keys = list(pending)
+        computed = stage.lookup_many([variants[pending[key][0]] for key in keys])
+        with self.lock:
+            for key, result in zip(keys, computed):
+                for n in pending[key]:
+                    results[n] = result
+                entry = entries.get(key)
+                if entry is None:
+                    entry = {}
+                    entries[key] = entry
+                    if len(entries) > self.max_loci:
+                        entries.popitem(last=False)
+                        self.evictions = self.evictions + 1
+                else:
+                    entries.move_to_end(key)
+                entry[stage] = result
+        return results
+
+    """Loci looked up by the busiest stage: the distinct loci in the job
+    unless some were evicted and looked up again
+    """
+
+    def loci(self):
+        return max(self.computed.values()) if self.computed else 0
+
+    """.count.log line for a job of variant_count variants
+    """
+
+    def summary(self, variant_count):
+        loci = self.loci()
+        ratio = variant_count / float(loci) if loci else 0.0
+        return (
+            f"Locus dedup: {str(variant_count)} variants, {str(loci)} loci "
+            f"looked up (dedup ratio {ratio:.3f}), {str(self.hits)} of "
+            f"{str(self.lookups)} stage lookups reused, {str(self.evictions)} "
+            f"loci evicted (limit {str(self.max_loci)})\n"
+        )
+
+
+### EOF
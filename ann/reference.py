@@ -0,0 +1,218 @@
+# reference.py
+#
+# Process-wide cache of reference data derived from the annotation
+# database (interval indexes, lookup tables)
+#
+# Entries are built at most once per reference version and shared by
+# every job a warm worker runs. The version comes from [reference]
+# Version in annotator_config.ini, which is re-read whenever the file
+# changes, so bumping it after reloading the reference database
+# invalidates every cached entry without restarting workers. When
+# CacheDir is set, built entries are also pickled there, so a fresh
+# process (e.g. the run.py subprocess spawned per job) loads them from
+# local disk instead of rebuilding them from MySQL.
+#
+# Tracks whose table is reloaded on its own get a version of their own
+# in [track_versions]; results are tagged with the version of each track
+# they were annotated from, so reannotate.py can tell which are stale.
+# Bumping one invalidates cached entries the same way.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import pickle
+import re
+import threading
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+CONFIG_FILE = os.path.join(
+    os.path.abspath(os.path.dirname(__file__)), "annotator_config.ini"
+)
+
+_memo = {}
+_lock = threading.Lock()
+_version = (None, "")
+
+
+def read_config():
+    config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+    config.read(CONFIG_FILE)
+    return config
+
+
+"""Current reference version, [reference] Version followed by the track
+versions; the config is only parsed again when its modification time
+changes, since this is called for every lookup
+"""
+
+
+def reference_version():
+    global _version
+    try:
+        mtime = os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        mtime = None
+    if _version[0] != mtime or mtime is None:
+        config = read_config()
+        version = config.get("reference", "Version", fallback="")
+        tracks = track_versions(config)
+        if len(tracks) > 0:
+            version = (
+                version
+                + "+"
+                + ",".join([f"{track}.{tracks[track]}" for track in sorted(tracks)])
+            )
+        _version = (mtime, version)
+    return _version[1]
+
+
+"""Versions set in [track_versions], by track name as configparser
+stores it (lower case); the environment defaults are left out
+"""
+
+
+def track_versions(config):
+    if not config.has_section("track_versions"):
+        return {}
+    defaults = config.defaults()
+    return dict(
+        [
+            (track, config.get("track_versions", track))
+            for track in config.options("track_versions")
+            if track not in defaults
+        ]
+    )
+
+
+"""Reference version of one track: its own from [track_versions], or
+[reference] Version
+"""
+
+
+def track_version(track, config=None):
+    config = config or read_config()
+    return track_versions(config).get(
+        track.lower(), config.get("reference", "Version", fallback="")
+    )
+
+
+VERSION_TAG = "##trackVersion="
+
+
+"""Header line recording the reference version a track was annotated
+from
+"""
+
+
+def version_tag(track, version):
+    return f"{VERSION_TAG}<ID={track},Version={version}>"
+
+
+"""Track versions tagged in the header lines of a result
+"""
+
+
+def tagged_versions(lines):
+    versions = {}
+    for line in lines:
+        if line.startswith(VERSION_TAG + "<"):
+            fields = line[len(VERSION_TAG) + 1 :].rstrip(">").split(",")
+            tag = dict([field.partition("=")[::2] for field in fields])
+            versions[tag.get("ID")] = tag.get("Version")
+    return versions
+
+
+"""Replaces the version tags of the tracks in versions among the header
+lines at the start of chunk, adding them after the other ## lines
+"""
+
+
+def retag(chunk, versions):
+    old = tuple([f"{VERSION_TAG}<ID={track}," for track in versions])
+    records = [r for r in chunk if not (isinstance(r, str) and r.startswith(old))]
+    at = 0
+    while (
+        at < len(records)
+        and isinstance(records[at], str)
+        and records[at].startswith("##")
+    ):
+        at = at + 1
+    tags = [version_tag(track, version) for track, version in versions.items()]
+    return records[:at] + tags + records[at:]
+
+
+def snapshot_path(name, version):
+    cache_dir = read_config().get("reference", "CacheDir", fallback="")
+    if not cache_dir:
+        return None
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{name}-{version}")
+    return os.path.join(cache_dir, safe + ".pickle")
+
+
+def load_snapshot(path):
+    try:
+        with open(path, "rb") as fh:
+            return pickle.load(fh)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+
+def save_snapshot(path, value):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fh:
+            pickle.dump(value, fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Unable to save reference snapshot {path}: {e}")
+
+
+"""Return the cached value for name, calling build() to create it if the
+reference version changed since it was last built
+"""
+
+
+def cached(name, build):
+    version = reference_version()
+    with _lock:
+        entry = _memo.get(name)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+
+        path = snapshot_path(name, version)
+        value = load_snapshot(path) if path else None
+        if value is None:
+            value = build()
+            if path:
+                save_snapshot(path, value)
+        _memo[name] = (version, value)
+        return value
+
+
+"""Whether name is built for the current reference version, in this
+process or as a snapshot in CacheDir
+"""
+
+
+def is_cached(name):
+    version = reference_version()
+    with _lock:
+        entry = _memo.get(name)
+        if entry is not None and entry[0] == version:
+            return True
+    path = snapshot_path(name, version)
+    return path is not None and os.path.exists(path)
+
+
+def clear():
+    with _lock:
+        _memo.clear()
+
+
+### EOF
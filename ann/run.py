@@ -13,9 +13,11 @@ __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 import sys
 import time
 import driver
+import targets
 import os
 import boto3
 import json
+from botocore.exceptions import ClientError, NoCredentialsError
 
 # Add the parent directory to sys.path
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -24,6 +26,7 @@ sys.path.append(parent_dir)
 
 # Import helpers from util to get user profile (to check for Free users)
 from util import helpers
+from util import job_trace
 
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
@@ -76,7 +79,7 @@ def upload_to_s3(file_path, bucket_name, s3_directory, original_file_name):
     except Exception as e:
         print(f"Error uploading {file_path}: {e}")
 
-def update_dynamodb(job_id, s3_results_bucket, s3_key_result_file, s3_key_log_file):
+def update_dynamodb(job_id, s3_results_bucket, s3_key_result_file, s3_key_log_file, s3_key_metrics_file=None, trace_hops=None, track_versions=None):
     """
     Update the DynamoDB table with the results of the annotation job
     
@@ -84,25 +87,47 @@ def update_dynamodb(job_id, s3_results_bucket, s3_key_result_file, s3_key_log_fi
     :param s3_results_bucket : The S3 bucket where the results file is stored
     :param s3_key_result_file : The S3 key for the results file
     :param s3_key_log_file : The S3 key for the log file
+    :param s3_key_metrics_file : The S3 key for the job metrics file
+    :param trace_hops : Trace hop timestamps to record with the update
+    :param track_versions : Reference version of each track the result was annotated from
     """
     # Current time as epoch for complete_time
     # https://www.programiz.com/python-programming/datetime/current-time
     complete_time = int(time.time())
+
+    update_expression = 'SET s3_results_bucket = :resBucket, s3_key_result_file = :resKey, s3_key_log_file = :logKey, s3_key_metrics_file = :metricsKey, complete_time = :compTime, job_status = :status'
+    attribute_values = {
+        ':resBucket': s3_results_bucket,
+        ':resKey': s3_key_result_file,
+        ':logKey': s3_key_log_file,
+        ':metricsKey': s3_key_metrics_file,
+        ':compTime': complete_time,
+        ':status': 'COMPLETED'
+    }
+    extra_args = {}
+
+    # Lets reannotate.py tell which results are stale after a table reload
+    if track_versions:
+        update_expression = update_expression + ', track_versions = :versions'
+        attribute_values[':versions'] = track_versions
+
+    # Record the remaining annotator hops in the same update
+    if trace_hops:
+        trace_hops = dict(trace_hops, dynamodb_updated=job_trace.now_ms())
+        clauses, attribute_names, trace_values = job_trace.hop_updates(trace_hops)
+        update_expression = update_expression + ', ' + ', '.join(clauses)
+        attribute_values.update(trace_values)
+        extra_args['ExpressionAttributeNames'] = attribute_names
     
     try:
         # Updating the DynamoDB table with the results of the annotation job
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/dynamodb/table.html#DynamoDB.Table.update_item
         response = table.update_item(
             Key={'job_id': job_id},
-            UpdateExpression='SET s3_results_bucket = :resBucket, s3_key_result_file = :resKey, s3_key_log_file = :logKey, complete_time = :compTime, job_status = :status',
-            ExpressionAttributeValues={
-                ':resBucket': s3_results_bucket,
-                ':resKey': s3_key_result_file,
-                ':logKey': s3_key_log_file,
-                ':compTime': complete_time,
-                ':status': 'COMPLETED'
-            },
-            ReturnValues='UPDATED_NEW'
+            UpdateExpression=update_expression,
+            ExpressionAttributeValues=attribute_values,
+            ReturnValues='UPDATED_NEW',
+            **extra_args
         )
         
     except ClientError as e:
@@ -111,7 +136,29 @@ def update_dynamodb(job_id, s3_results_bucket, s3_key_result_file, s3_key_log_fi
         print(f"Unexpected error when updating DynamoDB: {str(e)}")
 
 
-def start_sfn(job_id, user_id, results_s3_key, s3_bucket_name):
+def fail_job(job_id, error):
+    """
+    Mark the annotation job FAILED in DynamoDB
+
+    :param job_id : The UUID of the job to update
+    :param error : Why the job could not run
+    """
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :status, job_error = :error',
+            ExpressionAttributeValues={
+                ':status': 'FAILED',
+                ':error': error
+            }
+        )
+    except ClientError as e:
+        print(f"Error updating DynamoDB: {e.response['Error']['Message']}")
+    except Exception as e:
+        print(f"Unexpected error when updating DynamoDB: {str(e)}")
+
+
+def start_sfn(job_id, user_id, results_s3_key, s3_bucket_name, trace_id=None):
 
     
     try:
@@ -129,6 +176,8 @@ def start_sfn(job_id, user_id, results_s3_key, s3_bucket_name):
         "s3_bucket_name" : s3_bucket_name,
         "results_s3_key" : results_s3_key
         }
+        if trace_id:
+            input_data["trace_id"] = trace_id
 
         try:
             response = sfn.start_execution(
@@ -168,44 +217,130 @@ def delete_local_file(file_path):
 
 
 
-def main():
-
-    # Get job parameters
-    input_file_name = sys.argv[1]
-    base_file_name = os.path.basename(input_file_name)  # Get the base file name
+def dbsnp_filter_path():
+    """
+    Path of the dbSNP Bloom filter, if enabled and built (see bloom.py)
+    """
+    path = config.get('dbsnp_filter', 'Path', fallback=None)
+    if config.getboolean('dbsnp_filter', 'Enabled', fallback=False) and path and os.path.exists(path):
+        return path
+    return None
 
-    job_id = sys.argv[2]
-    user_id = sys.argv[3]
+def target_options(options):
+    """
+    BED path and mode of the job's target regions, or (None, None)
+    
+    :param options: Job options; "targets" holds a stored "panel" name or
+        the local path of an attached "bed", and optionally a "mode"
+    """
+    job_targets = options.get('targets')
+    if not job_targets:
+        return None, None
+    mode = job_targets.get('mode', config.get('targets', 'Mode', fallback=targets.DROP))
+    if job_targets.get('bed'):
+        return job_targets['bed'], mode
+    return targets.panel_path(config.get('targets', 'PanelDir'), job_targets['panel']), mode
 
-    # Run the AnnTools pipeline
-    with Timer():
-        driver.run(input_file_name, "vcf")
+def run_job(input_file_name, job_id, user_id, trace_id=None, options=None):
 
-    s3_bucket_name = config.get('s3', 'ResultsBucketName')
-    s3_directory = f"{config.get('s3', 'KeyPrefix')}{user_id}"
+    base_file_name = os.path.basename(input_file_name)  # Get the base file name
+    options = options or {}
 
     # Defining the results path on instance
     results_file_path = input_file_name.replace('.vcf', '.annot.vcf')
     log_file_path = input_file_name.replace('.vcf', '.vcf.count.log')
+    metrics_file_path = input_file_name.replace('.vcf', '.vcf.metrics.json')
+
+    try:
+        target_bed, target_mode = target_options(options)
+        pipeline = driver.read_pipeline(config, options.get('pipeline'))
+        track_versions = driver.job_versions(pipeline, options.get('tracks'), config)
+
+        # Run the AnnTools pipeline
+        with Timer():
+            driver.run(
+                input_file_name,
+                "vcf",
+                track_memory=config.getboolean('ann', 'TrackMemory', fallback=False),
+                top_sites=config.getint('ann', 'TrackMemoryTopSites', fallback=10),
+                dbsnp_filter=dbsnp_filter_path(),
+                dedup=config.getboolean('ann', 'Dedup', fallback=False),
+                dedup_max_loci=config.getint('ann', 'DedupMaxLoci', fallback=100000),
+                spans=config.getboolean('ann', 'Spans', fallback=False),
+                pipeline=pipeline,
+                tracks=options.get('tracks'),
+                plan=config.getboolean('planner', 'Enabled', fallback=False),
+                lookup_connections=config.getint('lookups', 'Connections', fallback=0),
+                lookup_in_flight=config.getint('lookups', 'InFlight', fallback=8),
+                track_workers=config.getint('lookups', 'TrackWorkers', fallback=0),
+                targets=target_bed,
+                target_mode=target_mode,
+                track_versions=track_versions,
+            )
+    except ValueError as e:
+        # Job options the annotator cannot run (pipeline, tracks, target
+        # regions): fail the job rather than leave it RUNNING
+        print(f"Annotation job {job_id} failed: {e}")
+        fail_job(job_id, str(e))
+        bed_path = options.get('targets', {}).get('bed')
+        for path in (results_file_path, log_file_path, metrics_file_path, input_file_name, bed_path):
+            if path and os.path.exists(path):
+                delete_local_file(path)
+        return
+    annotation_done = job_trace.now_ms()
+
+    s3_bucket_name = config.get('s3', 'ResultsBucketName')
+    s3_directory = f"{config.get('s3', 'KeyPrefix')}{user_id}"
 
     # Defining the S3 paths for results and log files
     results_file = base_file_name.replace('.vcf', '.annot.vcf')
     log_file = base_file_name.replace('.vcf', '.vcf.count.log')
+    metrics_file = base_file_name.replace('.vcf', '.vcf.metrics.json')
 
-    # Upload the result and log files to S3
+    # Upload the result, log and metrics files to S3
     results_s3_key = upload_to_s3(results_file_path, s3_bucket_name, s3_directory, results_file)
     log_s3_key = upload_to_s3(log_file_path, s3_bucket_name, s3_directory, log_file) 
+    metrics_s3_key = upload_to_s3(metrics_file_path, s3_bucket_name, s3_directory, metrics_file)
+    upload_done = job_trace.now_ms()
 
     # Update annotations database
-    update_dynamodb(job_id, s3_bucket_name, results_s3_key, log_s3_key)
+    trace_hops = None
+    if trace_id:
+        trace_hops = {'annotation_done': annotation_done, 'upload_done': upload_done}
+    update_dynamodb(job_id, s3_bucket_name, results_s3_key, log_s3_key, metrics_s3_key, trace_hops, track_versions)
 
     # Start the step function for archival process if user is FREE
-    start_sfn(job_id, user_id, results_s3_key, s3_bucket_name)
+    start_sfn(job_id, user_id, results_s3_key, s3_bucket_name, trace_id)
 
     # Clean up local job files
     delete_local_file(results_file_path)
     delete_local_file(log_file_path)
+    delete_local_file(metrics_file_path)
     delete_local_file(input_file_name)
+    if options.get('targets', {}).get('bed'):
+        delete_local_file(options['targets']['bed'])
+
+
+def job_args(argv):
+    """
+    Arguments of run_job from the ones annotator.py passes to run.py
+
+    :param argv: Input file, job ID, user ID and optionally the trace ID
+        (may be empty) and the job options as JSON
+    """
+    input_file_name = argv[0]
+    job_id = argv[1]
+    user_id = argv[2]
+    trace_id = argv[3] if len(argv) > 3 and argv[3] else None
+    # Job options from the request message, as JSON
+    options = json.loads(argv[4]) if len(argv) > 4 else {}
+    return input_file_name, job_id, user_id, trace_id, options
+
+
+def main():
+
+    # Get job parameters
+    run_job(*job_args(sys.argv[1:]))
 
 
 if __name__ == "__main__":
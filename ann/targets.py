@@ -0,0 +1,138 @@
+# targets.py
+#
+# Target-region prefilter for panel and exome jobs
+#
+# A job can name a stored panel (a BED file in [targets] PanelDir) or
+# attach a BED of its own. Records outside the target regions are then
+# dropped from the output, or passed through unannotated, before any
+# annotation stage sees them. The regions are held in a CoverageMask and
+# each chunk is checked in one batch.
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import re
+
+from intervals import CoverageMask
+from records import CONTIGS, contig_code, variants_in
+
+DROP = "drop"
+PASS = "pass"
+MODES = [DROP, PASS]
+
+PANEL_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+
+"""Path of the stored panel name in panel_dir; names are plain file
+names without .bed, so a job cannot point outside panel_dir
+"""
+
+
+def panel_path(panel_dir, name):
+    if not PANEL_NAME.match(name):
+        raise ValueError(f"Invalid panel name: {name}")
+    path = os.path.join(panel_dir, name + ".bed")
+    if not os.path.exists(path):
+        raise ValueError(f"Unknown panel: {name}")
+    return path
+
+
+"""Reads a BED file into a CoverageMask over VCF positions
+
+BED intervals are 0-based and half-open, so [start, end) covers VCF
+positions start + 1 to end. Chromosomes are normalized the way input
+records are, so "1" and "chr1" match. A line that is not an interval
+raises ValueError naming the file and line.
+"""
+
+
+def read_bed(path):
+    rows = []
+    with open(path) as fh:
+        for n, line in enumerate(fh, 1):
+            if line.startswith(("#", "track", "browser")) or line.strip() == "":
+                continue
+            fields = line.split()
+            try:
+                start, end = int(fields[1]), int(fields[2])
+            except (IndexError, ValueError):
+                start, end = -1, -1
+            if start < 0 or end <= start:
+                raise ValueError(
+                    f"Target regions {os.path.basename(path)} line {n}: "
+                    f"expected chrom, start and end, got {line.strip()[:80]!r}"
+                )
+            chrom = CONTIGS[contig_code(fields[0])][0]
+            rows.append((chrom, start + 1, end))
+    return CoverageMask.build(rows)
+
+
+"""Splits chunks into the records to annotate and the rest
+
+A variant is on target when the regions cover its position, or with
+spans any base from its position to its end. In DROP mode off-target
+records are removed from the chunk; in PASS mode they stay in it and
+are written out as they were read.
+"""
+
+
+class TargetFilter(object):
+    def __init__(self, mask, name, mode=DROP, spans=False):
+        if mode not in MODES:
+            raise ValueError(f"Unknown target mode: {mode}")
+        self.mask = mask
+        self.name = name
+        self.mode = mode
+        self.spans = spans
+        self.variants = 0
+        self.skipped = 0
+
+    @classmethod
+    def from_bed(cls, path, mode=DROP, spans=False):
+        name = os.path.basename(path)
+        if name.endswith(".bed"):
+            name = name[: -len(".bed")]
+        return cls(read_bed(path), name, mode=mode, spans=spans)
+
+    def split(self, chunk):
+        variants = variants_in(chunk)
+        covered = self.mask.coverage_many(
+            [(v.chrom, v.pos, v.end if self.spans else v.pos) for v in variants]
+        )
+        on_target = [v for v, (bases, _) in zip(variants, covered) if bases > 0]
+        self.variants = self.variants + len(variants)
+        self.skipped = self.skipped + len(variants) - len(on_target)
+
+        if self.mode == DROP and len(on_target) < len(variants):
+            keep = set([id(v) for v in on_target])
+            chunk = [r for r in chunk if isinstance(r, str) or id(r) in keep]
+        return chunk, on_target
+
+    """.count.log line for the job
+    """
+
+    def summary(self):
+        skipped = "dropped" if self.mode == DROP else "passed through"
+        return (
+            f"Targets {self.name}: {str(self.variants - self.skipped)} of "
+            f"{str(self.variants)} variants on target, {str(self.skipped)} "
+            f"{skipped} ({str(self.mask.size)} regions)\n"
+        )
+
+    def stats(self, stage_count):
+        return {
+            "name": self.name,
+            "mode": self.mode,
+            "regions": self.mask.size,
+            "variants": self.variants,
+            "on_target": self.variants - self.skipped,
+            "skipped": self.skipped,
+            # stage lookups and applies not run for off-target records
+            "skipped_stage_calls": self.skipped * stage_count,
+        }
+
+
+### EOF
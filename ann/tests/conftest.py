@@ -0,0 +1,13 @@
+# conftest.py
+#
+# Puts ann/ on sys.path so tests import its modules the way run.py and
+# driver.py do
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+### EOF
@@ -0,0 +1,81 @@
+# test_reannotate.py
+#
+# Refreshing stored results keeps the input's INFO (reannotate.py)
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import driver
+from reannotate import Refresher
+from records import INPUT_INFO_KEY, parse_line
+
+INDS = [0, 1, 3, 4]
+
+PIPELINE = [("dbSNP", "DbSnpStage"), ("cytoBand", "CytobandStage table=cytoBand")]
+
+
+class FakeStage(object):
+    """Writes results like the stage it stands in for, without a database"""
+
+    def __init__(self, results, write):
+        self.results = results
+        self.write = write
+
+    def lookup_chunk(self, variants, memo=None):
+        return self.results[: len(variants)]
+
+    def clear(self, v):
+        pass
+
+    def apply(self, v, result):
+        if result:
+            self.write(v, result)
+
+
+def dbsnp(results):
+    return FakeStage(results, lambda v, r: v.info.append("DB;VC=" + r))
+
+
+def cytoband(results):
+    return FakeStage(results, lambda v, r: v.info.add("cytoBand=" + r))
+
+
+def refresh(info, name, stage):
+    v = parse_line("\t".join(["1", "100", ".", "A", "G", "50", "PASS", info]), INDS)
+    refresher = Refresher(driver.parse_pipeline(PIPELINE), [(name, "", stage)])
+    refresher.refresh_chunk([v])
+    return str(v.info)
+
+
+# input INFO "DB;cytoBand=q9;DP=3" holds keys both stages write
+ANNOTATED = f"DB;cytoBand=q9;DP=3;DB;VC=SNV;cytoBand=p3;{INPUT_INFO_KEY}=19"
+
+
+def test_refreshed_dbsnp_keeps_input_db_flag():
+    assert refresh(ANNOTATED, "dbSNP", dbsnp([None])) == (
+        f"DB;cytoBand=q9;DP=3;cytoBand=p3;{INPUT_INFO_KEY}=19"
+    )
+
+
+def test_refreshed_cytoband_keeps_input_cytoband():
+    assert refresh(ANNOTATED, "cytoBand", cytoband(["p4"])) == (
+        f"DB;cytoBand=q9;DP=3;DB;VC=SNV;cytoBand=p4;{INPUT_INFO_KEY}=19"
+    )
+
+
+def test_input_ending_with_separator():
+    # append() puts another ';' after it, add() does not
+    annotated = f"DP=3;;DB;VC=SNV;{INPUT_INFO_KEY}=5"
+    assert refresh(annotated, "dbSNP", dbsnp(["INDEL"])) == (
+        f"DP=3;;DB;VC=INDEL;{INPUT_INFO_KEY}=5"
+    )
+    annotated = f"DP=3;cytoBand=p3;{INPUT_INFO_KEY}=5"
+    assert refresh(annotated, "cytoBand", cytoband(["p4"])) == (
+        f"DP=3;cytoBand=p4;{INPUT_INFO_KEY}=5"
+    )
+
+
+def test_unannotated_record_is_left_alone():
+    assert refresh("DB;cytoBand=q9", "cytoBand", cytoband(["p4"])) == "DB;cytoBand=q9"
+
+
+### EOF
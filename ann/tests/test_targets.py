@@ -0,0 +1,62 @@
+# test_targets.py
+#
+# Target-region prefilter (targets.py)
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+from records import parse_line
+from targets import DROP, PASS, TargetFilter, read_bed
+
+INDS = [0, 1, 3, 4]
+
+
+def record(chrom, pos, ref="A", alt="G", info="."):
+    return parse_line(
+        "\t".join([chrom, str(pos), ".", ref, alt, "50", "PASS", info]), INDS
+    )
+
+
+def write_bed(tmp_path, text):
+    path = tmp_path / "panel.bed"
+    path.write_text(text)
+    return str(path)
+
+
+def test_large_span_overlapping_a_few_target_bases_is_on_target(tmp_path):
+    # chr1:2000001-2000010 in VCF positions
+    mask = read_bed(write_bed(tmp_path, "chr1\t2000000\t2000010\n"))
+    # a 1 Mb deletion whose last 3 bases are in the target: 0.0 percent
+    sv = record("1", 1000004, info="SVTYPE=DEL;END=2000003")
+    outside = record("1", 5000)
+    filter = TargetFilter(mask, "panel", mode=DROP, spans=True)
+
+    chunk, on_target = filter.split(["#CHROM", sv, outside])
+
+    assert on_target == [sv]
+    assert chunk == ["#CHROM", sv]
+    assert filter.skipped == 1
+
+
+def test_point_mode_checks_pos_only(tmp_path):
+    mask = read_bed(write_bed(tmp_path, "1\t1000\t1010\n"))
+    sv = record("chr1", 900, info="SVTYPE=DEL;END=1005")
+    inside = record("chr1", 1001)
+    filter = TargetFilter(mask, "panel", mode=PASS, spans=False)
+
+    chunk, on_target = filter.split([sv, inside])
+
+    assert on_target == [inside]
+    assert chunk == [sv, inside]
+
+
+def test_bad_bed_line_names_file_and_line(tmp_path):
+    path = write_bed(tmp_path, "track name=panel\nchr1\t1000\t1010\nchr1\tx\t5\n")
+    try:
+        read_bed(path)
+    except ValueError as e:
+        assert "panel.bed line 3" in str(e)
+    else:
+        raise AssertionError("read_bed accepted a bad line")
+
+
+### EOF
@@ -50,6 +50,40 @@ def db_connect():
     )
 
 
+"""UCSC hierarchical binning scheme (standard bins, coordinates < 512 Mb)
+
+Bins at the finest level span 128 kb, and each coarser level is 8 times
+larger; a feature's bin is the smallest one containing all of it.
+"""
+
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+BIN_MAX_END = 1 << 29
+
+
+"""All bins that can hold a feature overlapping the half-open range
+[start, end); None if the range is past what standard bins cover
+"""
+
+
+def binsOverlappingRange(start, end):
+    start = max(0, start)
+    if end > BIN_MAX_END:
+        return None
+    if end <= start:
+        end = start + 1
+
+    bins = []
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    return bins
+
+
 """Column inices for pileup and VCF
 """
 
@@ -5,44 +5,377 @@
 #
 # Exercises the annotator's auto scaling
 #
+# Submits annotation jobs the same way the web app does (S3 upload,
+# DynamoDB item, SNS job request), following an arrival-rate profile,
+# then tracks every job to completion and reports throughput and
+# submit-to-complete latency. Point --endpoint-url at a local AWS
+# stand-in (e.g. LocalStack or moto_server) to run it offline.
+#
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import argparse
 import boto3
 import json
+import math
+import os
+import random
 import sys
+import threading
 import time
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 
+# Add the parent directory to sys.path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from util import job_trace
+
 # Define constants here; no config file is used for this scipt
 USER_ID = "<UUID_for_your_Globus_Auth_identity>"
 EMAIL = "<CNetID>@uchicago.edu"
 
-"""Fires off annotation jobs with hardcoded data for testing
+AWS_REGION_NAME = "us-east-1"
+ANNOTATIONS_TABLE = "<CNetID>_annotations"
+INPUTS_BUCKET = "gas-inputs"
+KEY_PREFIX = "<CNetID>/"
+JOB_REQUEST_TOPIC = "arn:aws:sns:us-east-1:127134666975:<CNetID>_job_requests"
+
+"""Arrival-rate profiles
+
+Each profile returns the target arrival rate (jobs/second) at time t
+seconds after the start of the run. Inter-arrival gaps are exponential,
+so arrivals form a (non-homogeneous) Poisson process.
+"""
+
+
+def constant_profile(rate):
+    return lambda t: rate
+
+
+def ramp_profile(start_rate, end_rate, duration):
+    def rate(t):
+        frac = min(1.0, t / float(duration)) if duration > 0 else 1.0
+        return start_rate + (end_rate - start_rate) * frac
+
+    return rate
+
+
+def burst_profile(base_rate, burst_rate, period, burst_length):
+    def rate(t):
+        return burst_rate if (t % period) < burst_length else base_rate
+
+    return rate
+
+
+def make_profile(args):
+    if args.profile == "constant":
+        return constant_profile(args.rate)
+    elif args.profile == "ramp":
+        return ramp_profile(args.rate, args.peak_rate, args.duration)
+    elif args.profile == "burst":
+        return burst_profile(args.rate, args.peak_rate, args.period, args.burst_length)
+    raise ValueError(f"Unknown arrival profile: {args.profile}")
+
+
+"""Corpus of sample input files
+
+Jobs draw their input uniformly from the corpus, so the size distribution
+of submitted jobs follows the sizes of the sample VCFs provided.
 """
 
 
-def load_requests_queue():
+def load_corpus(corpus_dir):
+    if not os.path.isdir(corpus_dir):
+        raise ValueError(f"Corpus directory {corpus_dir} does not exist")
+    corpus = []
+    for name in sorted(os.listdir(corpus_dir)):
+        path = os.path.join(corpus_dir, name)
+        if name.endswith(".vcf") and os.path.isfile(path):
+            corpus.append((path, os.path.getsize(path)))
+    if not corpus:
+        raise ValueError(f"No .vcf files found in corpus directory {corpus_dir}")
+    return corpus
+
+
+"""Nearest-rank percentile of a list of numbers
+"""
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(p / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def make_clients(region_name=AWS_REGION_NAME, endpoint_url=None):
+    kwargs = {"region_name": region_name}
+    if endpoint_url:
+        kwargs["endpoint_url"] = endpoint_url
+    dynamodb = boto3.resource("dynamodb", **kwargs)
+    return {
+        "s3": boto3.client("s3", **kwargs),
+        "sns": boto3.client("sns", **kwargs),
+        "table": dynamodb.Table(ANNOTATIONS_TABLE),
+    }
+
+
+"""Fires off one annotation job
+
+Uploads the input as the browser would via the presigned POST, then
+persists the job item and publishes the request exactly as
+views.create_annotation_job_request does.
+"""
+
+
+def load_requests_queue(clients, input_path, user_id=USER_ID):
 
     # Define job data
+    job_id = str(uuid.uuid4())
+    file_name = os.path.basename(input_path)
+    s3_key = f"{KEY_PREFIX}{user_id}/{job_id}~{file_name}"
+    clients["s3"].upload_file(input_path, INPUTS_BUCKET, s3_key)
+
+    submit_time = int(time.time())
+    data = {
+        "job_id": job_id,
+        "user_id": user_id,
+        "input_file_name": file_name,
+        "s3_inputs_bucket": INPUTS_BUCKET,
+        "s3_key_input_file": s3_key,
+        "submit_time": submit_time,
+        "job_status": "PENDING",
+        "trace": job_trace.new_trace(),
+    }
 
     # Persist job data to database
+    clients["table"].put_item(Item=data)
 
     # Send message to request topic
+    clients["sns"].publish(
+        TopicArn=JOB_REQUEST_TOPIC, Message=json.dumps(data), Subject="Job Submission"
+    )
 
-    pass
+    return job_id
 
 
-def main():
-    while True:
+"""Keeps track of submitted jobs until they complete
+"""
+
+
+class JobTracker(object):
+    def __init__(self, table, poll_interval=2.0):
+        self.table = table
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.submitted = {}
+        self.completed = {}
+        self.sizes = {}
+        self.errors = 0
+
+    def add(self, job_id, submitted_at, size):
+        with self.lock:
+            self.pending[job_id] = submitted_at
+            self.submitted[job_id] = submitted_at
+            self.sizes[job_id] = size
+
+    def error(self):
+        with self.lock:
+            self.errors = self.errors + 1
+
+    def poll(self):
+        with self.lock:
+            job_ids = list(self.pending)
+
+        for job_id in job_ids:
+            try:
+                item = self.table.get_item(Key={"job_id": job_id}).get("Item")
+            except ClientError as e:
+                print(f"Error polling job {job_id}: {e}")
+                continue
+            if item and item.get("job_status") == "COMPLETED":
+                now = time.time()
+                with self.lock:
+                    submitted_at = self.pending.pop(job_id)
+                    self.completed[job_id] = now - submitted_at
+
+    def wait(self, stop_event, timeout):
+        deadline = None
+        while True:
+            self.poll()
+            with self.lock:
+                outstanding = len(self.pending)
+            if stop_event.is_set():
+                if outstanding == 0:
+                    return
+                if deadline is None:
+                    deadline = time.time() + timeout
+                elif time.time() > deadline:
+                    print(f"Timed out waiting for {outstanding} job(s)")
+                    return
+            time.sleep(self.poll_interval)
+
+    def report(self, elapsed):
+        latencies = list(self.completed.values())
+        completed = len(latencies)
+        total_bytes = sum([self.sizes[j] for j in self.completed])
+        print(
+            f"Submitted: {len(self.submitted)}  Completed: {completed}  "
+            f"Outstanding: {len(self.pending)}  Errors: {self.errors}"
+        )
+        print(
+            f"Elapsed: {elapsed:.1f}s  Throughput: {completed / elapsed:.3f} jobs/s  "
+            f"({total_bytes / elapsed / 1024:.1f} KB/s of input)"
+        )
+        if latencies:
+            print(
+                "Submit-to-complete latency (s): "
+                + "  ".join(
+                    [f"p{p}={percentile(latencies, p):.2f}" for p in (50, 90, 95, 99)]
+                )
+                + f"  max={max(latencies):.2f}"
+            )
+        return {
+            "submitted": len(self.submitted),
+            "completed": completed,
+            "outstanding": len(self.pending),
+            "errors": self.errors,
+            "elapsed": elapsed,
+            "throughput": completed / elapsed,
+            "latency": {f"p{p}": percentile(latencies, p) for p in (50, 90, 95, 99)},
+        }
+
+
+"""Generates arrivals according to the profile for the given duration
+and hands each one to a pool of concurrent submitters
+"""
+
+
+def run_load(
+    clients,
+    corpus,
+    profile,
+    duration,
+    submitters=4,
+    poll_interval=2.0,
+    drain_timeout=600,
+    user_id=USER_ID,
+    seed=None,
+):
+
+    rng = random.Random(seed)
+    tracker = JobTracker(clients["table"], poll_interval=poll_interval)
+    stop_event = threading.Event()
+
+    def submit(path, size):
         try:
-            load_requests_queue()
-            time.sleep(3)
+            submitted_at = time.time()
+            job_id = load_requests_queue(clients, path, user_id=user_id)
+            tracker.add(job_id, submitted_at, size)
         except ClientError as e:
-            print("Irrecoverable error. Exiting.")
-            sys.exit()
+            print(f"Error submitting job: {e}")
+            tracker.error()
+        except Exception as e:
+            print(f"Unexpected error submitting job: {e}")
+            tracker.error()
+
+    waiter = threading.Thread(
+        target=tracker.wait, args=(stop_event, drain_timeout), daemon=True
+    )
+    waiter.start()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=submitters) as pool:
+        t = 0.0
+        while True:
+            rate = profile(t)
+            t = t + (rng.expovariate(rate) if rate > 0 else poll_interval)
+            if t >= duration:
+                break
+            delay = start + t - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            if rate > 0:
+                path, size = rng.choice(corpus)
+                pool.submit(submit, path, size)
+
+    stop_event.set()
+    waiter.join()
+    return tracker.report(time.time() - start)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GAS annotator load generator")
+    parser.add_argument("--corpus", required=True, help="Directory of sample VCFs")
+    parser.add_argument(
+        "--profile", choices=["constant", "ramp", "burst"], default="constant"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.33,
+        help="Base arrival rate (jobs/s); ramp start rate",
+    )
+    parser.add_argument(
+        "--peak-rate",
+        type=float,
+        default=2.0,
+        help="Ramp end rate or burst rate (jobs/s)",
+    )
+    parser.add_argument("--period", type=float, default=60.0, help="Burst period (s)")
+    parser.add_argument(
+        "--burst-length",
+        type=float,
+        default=10.0,
+        help="Burst length within each period (s)",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=300.0, help="How long to keep submitting (s)"
+    )
+    parser.add_argument(
+        "--submitters", type=int, default=4, help="Number of concurrent submitters"
+    )
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=600.0,
+        help="How long to wait for outstanding jobs (s)",
+    )
+    parser.add_argument(
+        "--endpoint-url", default=None, help="Endpoint of a local AWS stand-in"
+    )
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    try:
+        corpus = load_corpus(args.corpus)
+    except ValueError as e:
+        sys.exit(f"Unable to load corpus: {e}")
+
+    clients = make_clients(endpoint_url=args.endpoint_url)
+    try:
+        run_load(
+            clients,
+            corpus,
+            make_profile(args),
+            args.duration,
+            submitters=args.submitters,
+            poll_interval=args.poll_interval,
+            drain_timeout=args.drain_timeout,
+            seed=args.seed,
+        )
+    except ClientError as e:
+        print("Irrecoverable error. Exiting.")
+        sys.exit()
 
 
 if __name__ == "__main__":
@@ -17,6 +17,7 @@ from botocore.exceptions import ClientError, BotoCoreError
 # Import utility helpers
 sys.path.insert(1, os.path.realpath(os.path.pardir))
 import helpers
+import job_trace
 
 # Get configuration
 from configparser import ConfigParser, ExtendedInterpolation
@@ -118,15 +119,25 @@ def handle_archive_queue(sqs=None):
                     print(f"Unexpected error when uploading to glacier: {str(e)}")
 
                 if archive_id:
+                    update_expression = "set results_file_archive_id = :r"
+                    attribute_values = {':r': archive_id}
+                    extra_args = {}
+
+                    # Record the archived hop for traced jobs
+                    if 'trace_id' in job_details:
+                        clauses, attribute_names, trace_values = job_trace.hop_updates({'archived': job_trace.now_ms()})
+                        update_expression = update_expression + ", " + ", ".join(clauses)
+                        attribute_values.update(trace_values)
+                        extra_args['ExpressionAttributeNames'] = attribute_names
+
                     try:
                         # Update the DynamoDB item with the Glacier archive ID
                         update_response = table.update_item(
                             Key={'job_id': job_id},
-                            UpdateExpression="set results_file_archive_id = :r",
-                            ExpressionAttributeValues={
-                                ':r': archive_id
-                            },
-                            ReturnValues="UPDATED_NEW"
+                            UpdateExpression=update_expression,
+                            ExpressionAttributeValues=attribute_values,
+                            ReturnValues="UPDATED_NEW",
+                            **extra_args
                         )
                         print(f"DynamoDB item for job {job_id} updated with Glacier archive ID.")
                     except ClientError as e:
@@ -0,0 +1,391 @@
+# harness.py
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+#
+# Offline full-stack performance harness
+#
+# Runs the whole job lifecycle (submission, annotator, run.py, archive
+# state machine, archive_script.py, thaw_script.py and the restore
+# Lambda) in one process against the stand-ins in local_aws.py, drives
+# it with the ann_load.py load generator and reports throughput,
+# submit-to-result latency and per-component latency from the job traces.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import local_aws
+
+HARNESS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(HARNESS_DIR))
+sys.path.append(ROOT_DIR)
+
+# Get configuration
+from configparser import ConfigParser, ExtendedInterpolation
+
+config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+config.read(os.path.join(HARNESS_DIR, "harness_config.ini"))
+
+ARCHIVE_TOPIC = "arn:aws:sns:local:000000000000:harness_archive"
+
+"""Import a GAS component the way its run script would
+
+Components read their config files relative to the working directory
+and create their AWS clients at import time, so they are imported from
+inside their own directory after the stand-ins have been installed.
+"""
+
+
+def import_component(subdir, name):
+    directory = os.path.join(ROOT_DIR, subdir)
+    cwd = os.getcwd()
+    sys.path.insert(0, directory)
+    try:
+        os.chdir(directory)
+        return importlib.import_module(name)
+    finally:
+        os.chdir(cwd)
+
+
+"""Synthetic stand-in for driver.run
+
+Used when no reference database is available: copies the input through
+with a marker in INFO and sleeps for a fixed cost per variant, so the
+pipeline sees realistic file sizes and compute times.
+"""
+
+
+def synthetic_driver(ms_per_variant):
+    def run(infile, format, **kwargs):
+        outfile = (infile + ".annot").replace(".vcf.annot", ".annot.vcf")
+        variants = 0
+        with open(infile) as fh, open(outfile, "w") as fh_out:
+            for line in fh:
+                if not line.startswith("#"):
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) > 7:
+                        fields[7] = fields[7] + ";harness=True"
+                    line = "\t".join(fields) + "\n"
+                    variants = variants + 1
+                fh_out.write(line)
+        time.sleep(variants * ms_per_variant / 1000.0)
+        with open(infile + ".count.log", "w") as fh_log:
+            fh_log.write(f"Total: {variants}\n")
+        with open(infile + ".metrics.json", "w") as fh_metrics:
+            json.dump({"stages": [], "variants": variants}, fh_metrics)
+
+    return run
+
+
+class Harness(object):
+    def __init__(self, args):
+        self.args = args
+        self.aws = local_aws.LocalAWS(
+            latency_ms=config.getfloat("harness", "AwsLatencyMs"),
+            visibility_timeout=config.getint("harness", "VisibilityTimeout"),
+            retrieval_seconds=config.getfloat("harness", "GlacierRetrievalSeconds"),
+        )
+        self.workdir = tempfile.mkdtemp(prefix="gas_harness_")
+        self.stop_event = threading.Event()
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.workers = ThreadPoolExecutor(
+            max_workers=config.getint("harness", "AnnotatorWorkers")
+        )
+
+    def get_user_profile(self, id=None, db_name=None):
+        with self.lock:
+            return {"identity_id": id, "role": self.profiles.get(id, "free_user")}
+
+    """Import every component and point them all at the same resources
+    """
+
+    def setup(self):
+        self.aws.install()
+        self.aws.secretsmanager.put(
+            "rds/anntools_database",
+            {
+                "host": config.get("reference_db", "Host"),
+                "port": config.getint("reference_db", "Port"),
+                "username": config.get("reference_db", "Username"),
+                "password": config.get("reference_db", "Password"),
+            },
+        )
+
+        self.annotator = import_component("ann", "annotator")
+        self.run = import_component("ann", "run")
+        self.archive = import_component("util/archive", "archive_script")
+        self.thaw = import_component("util/thaw", "thaw_script")
+        self.restore = import_component("util/restore", "restore")
+        from util import ann_load
+
+        self.ann_load = ann_load
+
+        ann_config = self.annotator.config
+        self.table_name = ann_config.get("gas", "AnnotationsTable")
+        self.request_queue = ann_config.get("sqs", "SqsUrl")
+        self.archive_queue = self.archive.config.get("sqs", "SqsUrl")
+        self.thaw_queue = self.thaw.config.get("sqs", "SqsUrl")
+        self.thaw_topic = self.thaw.config.get("sns", "TopicArn")
+        vault = config.get("glacier", "VaultName")
+        table = self.aws.dynamodb.Table(self.table_name)
+
+        # Job submission mirrors views.create_annotation_job_request
+        ann_load.ANNOTATIONS_TABLE = self.table_name
+        ann_load.INPUTS_BUCKET = ann_config.get("s3", "InputsBucketName")
+        ann_load.KEY_PREFIX = ann_config.get("s3", "KeyPrefix")
+        self.aws.sns.subscribe_queue(ann_load.JOB_REQUEST_TOPIC, self.request_queue)
+
+        # Annotator runs each job in a worker thread instead of a process
+        data_dir = os.path.join(self.workdir, "data")
+        ann_config.set("ann", "data_dir", data_dir)
+        ann_config.set("sqs", "WaitTime", "1")
+        self.annotator.Popen = lambda args: self.workers.submit(self.run_job, args[2:])
+        if self.args.annotator == "synthetic":
+            self.run.driver.run = synthetic_driver(
+                config.getfloat("harness", "SyntheticMsPerVariant")
+            )
+        self.run.helpers.get_user_profile = self.get_user_profile
+        self.run.table = table
+
+        # Archive state machine: wait, then publish to the archive topic
+        self.aws.sns.subscribe_queue(ARCHIVE_TOPIC, self.archive_queue)
+        self.aws.stepfunctions.register(
+            ann_config.get("sfn", "SfnArn"),
+            lambda data: self.aws.sns.publish(
+                TopicArn=ARCHIVE_TOPIC, Message=json.dumps(data), Subject="Archive"
+            ),
+            wait_seconds=config.getfloat("harness", "ArchiveWaitSeconds"),
+        )
+        self.archive.helpers.get_user_profile = self.get_user_profile
+        self.archive.config.set("sqs", "WaitTime", "1")
+        self.archive.config.set("glacier", "VaultName", vault)
+        self.archive.table = table
+
+        # Thaw script and the restore Lambda
+        self.aws.sns.subscribe_queue(self.thaw_topic, self.thaw_queue)
+        self.thaw.config.set("sqs", "WaitTime", "1")
+        self.thaw.config.set("glacier", "VaultName", vault)
+        self.thaw.table = table
+        self.restore.GLACIER_VAULT_NAME = vault
+        self.restore.table = table
+        self.aws.lambda_.register(
+            self.thaw.config.get("lambda", "FunctionName"), self.restore.lambda_handler
+        )
+        self.table = table
+
+    # args are run.py's command line arguments, options as JSON
+    def run_job(self, args):
+        try:
+            self.run.run_job(*self.run.job_args(args))
+        except Exception as e:
+            print(f"Annotation job failed: {e}")
+
+    def poll(self, handler):
+        sqs = self.aws.client("sqs")
+        while not self.stop_event.is_set():
+            try:
+                handler(sqs)
+            except Exception as e:
+                print(f"{handler.__name__} failed: {e}")
+
+    def start(self):
+        for handler in (
+            self.annotator.handle_requests_queue,
+            self.archive.handle_archive_queue,
+            self.thaw.handle_thaw_queue,
+        ):
+            threading.Thread(target=self.poll, args=(handler,), daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.workers.shutdown(wait=True)
+        self.aws.uninstall()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # Read directly so the harness's own polling is not counted
+    def items(self):
+        return self.table.items()
+
+    """Wait until every completed job has been archived
+    """
+
+    def wait_for_archive(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            pending = [
+                i
+                for i in self.items()
+                if i.get("job_status") == "COMPLETED"
+                and "results_file_archive_id" not in i
+                and self.profiles.get(i["user_id"], "free_user") == "free_user"
+            ]
+            if not pending:
+                return True
+            time.sleep(0.2)
+        print("Timed out waiting for jobs to be archived")
+        return False
+
+    """Upgrade the user and request thaws exactly as views.subscribe does,
+    then time each job until its results are restored to S3
+    """
+
+    def thaw_all(self, user_id, timeout):
+        with self.lock:
+            self.profiles[user_id] = "premium_user"
+
+        started = {}
+        for job in self.items():
+            if job["user_id"] == user_id and "results_file_archive_id" in job:
+                message = {
+                    "job_id": job["job_id"],
+                    "user_id": user_id,
+                    "results_file_archive_id": job["results_file_archive_id"],
+                    "s3_results_bucket": job["s3_results_bucket"],
+                    "s3_key_result_file": job["s3_key_result_file"],
+                    "thaw_status": "STARTED",
+                }
+                started[job["job_id"]] = time.time()
+                self.aws.sns.publish(
+                    TopicArn=self.thaw_topic,
+                    Message=json.dumps(message),
+                    Subject="Thaw Request Submission",
+                )
+
+        latencies = {}
+        deadline = time.time() + timeout
+        while len(latencies) < len(started) and time.time() < deadline:
+            for item in self.items():
+                job_id = item["job_id"]
+                if (
+                    job_id in started
+                    and job_id not in latencies
+                    and "results_file_archive_id" not in item
+                    and item.get("job_status") == "COMPLETED"
+                ):
+                    latencies[job_id] = time.time() - started[job_id]
+            time.sleep(0.2)
+        return latencies
+
+    def report(self, thaw_latencies):
+        from util import job_trace
+
+        print("\nPer-component latency (from job traces):")
+        for name, stats in job_trace.summarize(self.items()).items():
+            print(
+                f"  {name:<12} n={stats['jobs']:<5} mean={stats['mean']:.3f}s "
+                f"p50={stats['p50']:.3f}s p95={stats['p95']:.3f}s max={stats['max']:.3f}s"
+            )
+
+        if thaw_latencies:
+            values = list(thaw_latencies.values())
+            print(
+                f"  {'thaw':<12} n={len(values):<5} mean={sum(values) / len(values):.3f}s "
+                f"p50={job_trace.percentile(values, 50):.3f}s "
+                f"p95={job_trace.percentile(values, 95):.3f}s max={max(values):.3f}s"
+            )
+
+        print("\nAWS calls:")
+        for (service, operation), (count, secs) in sorted(self.aws.stats().items()):
+            print(
+                f"  {service + '.' + operation:<32} {count:>7}  {secs * 1000 / count:8.3f} ms/call"
+            )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="GAS offline full-stack harness")
+    parser.add_argument(
+        "--corpus",
+        default=os.path.join(HARNESS_DIR, config.get("harness", "CorpusDir")),
+    )
+    parser.add_argument(
+        "--profile",
+        choices=["constant", "ramp", "burst"],
+        default=config.get("harness", "Profile"),
+    )
+    parser.add_argument(
+        "--rate", type=float, default=config.getfloat("harness", "Rate")
+    )
+    parser.add_argument(
+        "--peak-rate", type=float, default=config.getfloat("harness", "PeakRate")
+    )
+    parser.add_argument(
+        "--period", type=float, default=config.getfloat("harness", "Period")
+    )
+    parser.add_argument(
+        "--burst-length", type=float, default=config.getfloat("harness", "BurstLength")
+    )
+    parser.add_argument(
+        "--duration", type=float, default=config.getfloat("harness", "Duration")
+    )
+    parser.add_argument(
+        "--submitters", type=int, default=config.getint("harness", "Submitters")
+    )
+    parser.add_argument(
+        "--annotator",
+        choices=["synthetic", "driver"],
+        default=config.get("harness", "Annotator"),
+    )
+    parser.add_argument("--no-thaw", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    from util import ann_load
+
+    try:
+        corpus = ann_load.load_corpus(args.corpus)
+    except ValueError as e:
+        sys.exit(f"Unable to load corpus: {e}")
+
+    harness = Harness(args)
+    harness.setup()
+    harness.start()
+
+    try:
+        user_id = harness.ann_load.USER_ID
+        clients = {
+            "s3": harness.aws.s3,
+            "sns": harness.aws.sns,
+            "table": harness.table,
+        }
+        harness.ann_load.run_load(
+            clients,
+            corpus,
+            harness.ann_load.make_profile(args),
+            args.duration,
+            submitters=args.submitters,
+            poll_interval=0.2,
+            drain_timeout=config.getfloat("harness", "DrainTimeout"),
+            user_id=user_id,
+            seed=args.seed,
+        )
+
+        timeout = config.getfloat("harness", "DrainTimeout")
+        harness.wait_for_archive(timeout)
+        thaw_latencies = {}
+        if not args.no_thaw:
+            thaw_latencies = harness.thaw_all(user_id, timeout)
+        harness.report(thaw_latencies)
+    finally:
+        harness.stop()
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
@@ -0,0 +1,568 @@
+# local_aws.py
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+#
+# In-process stand-ins for the AWS services used by GAS
+#
+# Implements just enough of S3, SQS, SNS, DynamoDB, Glacier, Step
+# Functions, Lambda and Secrets Manager for the GAS components to run
+# their full job lifecycle on one machine. install() patches
+# boto3.client/boto3.resource so modules that create their clients at
+# import time pick up the stand-ins. Every call is counted and timed,
+# and an optional per-call latency can be injected to mimic network RTT.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import copy
+import functools
+import io
+import json
+import re
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+def client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+"""Decorator for emulated API calls; adds the injected latency and
+records the call count and time per service and operation
+"""
+
+
+def aws_call(method):
+    @functools.wraps(method)
+    def timed(self, *args, **kwargs):
+        if self.aws.latency:
+            time.sleep(self.aws.latency)
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.aws.record(
+                self.service_name, method.__name__, time.perf_counter() - start
+            )
+
+    return timed
+
+
+class LocalService(object):
+    service_name = None
+
+    def __init__(self, aws):
+        self.aws = aws
+
+
+"""S3: buckets are dicts of key -> bytes
+"""
+
+
+class NoSuchKey(ClientError):
+    pass
+
+
+class LocalS3(LocalService):
+    service_name = "s3"
+
+    class exceptions(object):
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, aws):
+        LocalService.__init__(self, aws)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _get(self, bucket, key, operation):
+        with self._lock:
+            data = self._buckets.get(bucket, {}).get(key)
+        if data is None:
+            raise NoSuchKey(
+                {"Error": {"Code": "NoSuchKey", "Message": f"{bucket}/{key}"}},
+                operation,
+            )
+        return data
+
+    def _put(self, bucket, key, body):
+        if hasattr(body, "read"):
+            body = body.read()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        with self._lock:
+            self._buckets.setdefault(bucket, {})[key] = bytes(body)
+        return {"ETag": uuid.uuid4().hex}
+
+    @aws_call
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        return self._put(Bucket, Key, Body)
+
+    @aws_call
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, "rb") as fh:
+            self._put(Bucket, Key, fh.read())
+
+    @aws_call
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        data = self._get(Bucket, Key, "GetObject")
+        with open(Filename, "wb") as fh:
+            fh.write(data)
+
+    @aws_call
+    def get_object(self, Bucket, Key, **kwargs):
+        data = self._get(Bucket, Key, "GetObject")
+        return {"Body": io.BytesIO(data), "ContentLength": len(data)}
+
+    @aws_call
+    def delete_object(self, Bucket, Key, **kwargs):
+        with self._lock:
+            self._buckets.get(Bucket, {}).pop(Key, None)
+        return {}
+
+    @aws_call
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600):
+        return f"http://local-s3/{Params['Bucket']}/{Params['Key']}"
+
+    def keys(self, bucket):
+        with self._lock:
+            return list(self._buckets.get(bucket, {}))
+
+
+"""SQS: long polling and visibility timeouts are honoured
+"""
+
+
+class LocalSQS(LocalService):
+    service_name = "sqs"
+
+    def __init__(self, aws, visibility_timeout=30):
+        LocalService.__init__(self, aws)
+        self.visibility_timeout = visibility_timeout
+        self._queues = {}
+        self._cond = threading.Condition()
+
+    @aws_call
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        message_id = str(uuid.uuid4())
+        with self._cond:
+            self._queues.setdefault(QueueUrl, []).append(
+                {"MessageId": message_id, "Body": MessageBody, "visible_at": 0}
+            )
+            self._cond.notify_all()
+        return {"MessageId": message_id}
+
+    @aws_call
+    def receive_message(
+        self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs
+    ):
+        deadline = time.time() + WaitTimeSeconds
+        with self._cond:
+            while True:
+                now = time.time()
+                ready = [
+                    m for m in self._queues.get(QueueUrl, []) if m["visible_at"] <= now
+                ][:MaxNumberOfMessages]
+                if ready or now >= deadline:
+                    break
+                hidden = [m["visible_at"] for m in self._queues.get(QueueUrl, [])]
+                wake = min([deadline] + [t for t in hidden if t > now])
+                self._cond.wait(max(0.001, wake - now))
+
+            messages = []
+            for m in ready:
+                m["visible_at"] = now + self.visibility_timeout
+                m["ReceiptHandle"] = str(uuid.uuid4())
+                messages.append(
+                    {
+                        "MessageId": m["MessageId"],
+                        "ReceiptHandle": m["ReceiptHandle"],
+                        "Body": m["Body"],
+                    }
+                )
+        return {"Messages": messages} if messages else {}
+
+    @aws_call
+    def delete_message(self, QueueUrl, ReceiptHandle, **kwargs):
+        with self._cond:
+            queue = self._queues.get(QueueUrl, [])
+            self._queues[QueueUrl] = [
+                m for m in queue if m.get("ReceiptHandle") != ReceiptHandle
+            ]
+        return {}
+
+    def depth(self, queue_url):
+        with self._cond:
+            return len(self._queues.get(queue_url, []))
+
+
+"""SNS: topics fan out to subscribed SQS queues in the SNS envelope
+"""
+
+
+class LocalSNS(LocalService):
+    service_name = "sns"
+
+    def __init__(self, aws):
+        LocalService.__init__(self, aws)
+        self._subscriptions = {}
+
+    def subscribe_queue(self, topic_arn, queue_url):
+        self._subscriptions.setdefault(topic_arn, []).append(queue_url)
+
+    @aws_call
+    def publish(self, TopicArn, Message, Subject=None, **kwargs):
+        message_id = str(uuid.uuid4())
+        envelope = json.dumps(
+            {
+                "Type": "Notification",
+                "MessageId": message_id,
+                "TopicArn": TopicArn,
+                "Subject": Subject,
+                "Message": Message,
+            }
+        )
+        for queue_url in self._subscriptions.get(TopicArn, []):
+            self.aws.sqs.send_message(QueueUrl=queue_url, MessageBody=envelope)
+        return {"MessageId": message_id}
+
+
+"""DynamoDB: items are dicts; numbers come back as Decimal like boto3
+"""
+
+
+def to_dynamo(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, float):
+        raise TypeError("Float types are not supported. Use Decimal types instead.")
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_dynamo(v) for v in value]
+    return value
+
+
+class LocalTable(object):
+    service_name = "dynamodb"
+
+    def __init__(self, aws, name):
+        self.aws = aws
+        self.name = name
+        self._items = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _path(expression, names):
+        return [names.get(p, p) for p in expression.strip().split(".")]
+
+    @staticmethod
+    def _lookup(item, path):
+        for p in path:
+            if not isinstance(item, dict) or p not in item:
+                return None, False
+            item = item[p]
+        return item, True
+
+    def _condition(self, item, expression, names, values):
+        for clause in re.split(r"\s+AND\s+", expression, flags=re.I):
+            clause = clause.strip()
+            m = re.match(
+                r"(attribute_exists|attribute_not_exists)\((.+)\)$", clause, re.I
+            )
+            if m:
+                _, exists = self._lookup(item, self._path(m.group(2), names))
+                if exists != (m.group(1).lower() == "attribute_exists"):
+                    return False
+                continue
+            left, right = [x.strip() for x in clause.split("=")]
+            value, exists = self._lookup(item, self._path(left, names))
+            if not exists or value != values[right]:
+                return False
+        return True
+
+    @aws_call
+    def put_item(self, Item, **kwargs):
+        with self._lock:
+            self._items[Item["job_id"]] = to_dynamo(copy.deepcopy(Item))
+        return {}
+
+    @aws_call
+    def get_item(self, Key, **kwargs):
+        with self._lock:
+            item = copy.deepcopy(self._items.get(Key["job_id"]))
+        return {"Item": item} if item else {}
+
+    @aws_call
+    def update_item(
+        self,
+        Key,
+        UpdateExpression,
+        ExpressionAttributeValues=None,
+        ExpressionAttributeNames=None,
+        ConditionExpression=None,
+        **kwargs,
+    ):
+        names = ExpressionAttributeNames or {}
+        values = to_dynamo(ExpressionAttributeValues or {})
+        with self._lock:
+            item = copy.deepcopy(self._items.get(Key["job_id"], dict(Key)))
+            if ConditionExpression and not self._condition(
+                item, ConditionExpression, names, values
+            ):
+                raise client_error(
+                    "ConditionalCheckFailedException",
+                    "The conditional request failed",
+                    "UpdateItem",
+                )
+            for action, body in re.findall(
+                r"(SET|REMOVE)\s+(.*?)(?=\s+(?:SET|REMOVE)\s|$)", UpdateExpression, re.I
+            ):
+                for part in body.split(","):
+                    if action.upper() == "SET":
+                        left, right = [x.strip() for x in part.split("=")]
+                        path = self._path(left, names)
+                        parent, exists = self._lookup(item, path[:-1])
+                        if not exists or not isinstance(parent, dict):
+                            raise client_error(
+                                "ValidationException",
+                                "The document path provided in the update "
+                                "expression is invalid for update",
+                                "UpdateItem",
+                            )
+                        parent[path[-1]] = values[right]
+                    else:
+                        path = self._path(part, names)
+                        parent, exists = self._lookup(item, path[:-1])
+                        if exists and isinstance(parent, dict):
+                            parent.pop(path[-1], None)
+            self._items[Key["job_id"]] = item
+        return {"Attributes": {}}
+
+    @aws_call
+    def scan(self, **kwargs):
+        with self._lock:
+            items = copy.deepcopy(list(self._items.values()))
+        names = kwargs.get("ExpressionAttributeNames", {})
+        if "FilterExpression" in kwargs:
+            items = [
+                i
+                for i in items
+                if self._condition(i, kwargs["FilterExpression"], names, {})
+            ]
+        return {"Items": items}
+
+    def items(self):
+        with self._lock:
+            return copy.deepcopy(list(self._items.values()))
+
+
+class LocalDynamoDB(object):
+    def __init__(self, aws):
+        self.aws = aws
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def Table(self, name):
+        with self._lock:
+            if name not in self._tables:
+                self._tables[name] = LocalTable(self.aws, name)
+            return self._tables[name]
+
+
+"""Glacier: archives are kept in memory; retrieval jobs complete after
+a configurable delay (Expedited retrievals take 1-5 minutes on AWS)
+"""
+
+
+class LocalGlacier(LocalService):
+    service_name = "glacier"
+
+    def __init__(self, aws, retrieval_seconds=0):
+        LocalService.__init__(self, aws)
+        self.retrieval_seconds = retrieval_seconds
+        self._archives = {}
+        self._jobs = {}
+
+    @aws_call
+    def upload_archive(self, vaultName, body, **kwargs):
+        if hasattr(body, "read"):
+            body = body.read()
+        archive_id = uuid.uuid4().hex
+        self._archives[(vaultName, archive_id)] = bytes(body)
+        return {"archiveId": archive_id}
+
+    @aws_call
+    def initiate_job(self, vaultName, jobParameters, **kwargs):
+        archive_id = jobParameters["ArchiveId"]
+        if (vaultName, archive_id) not in self._archives:
+            raise client_error("ResourceNotFoundException", archive_id, "InitiateJob")
+        job_id = uuid.uuid4().hex
+        # Retrieved output stays available after the archive is deleted
+        self._jobs[(vaultName, job_id)] = (
+            archive_id,
+            time.time() + self.retrieval_seconds,
+            self._archives[(vaultName, archive_id)],
+        )
+        return {"jobId": job_id}
+
+    @aws_call
+    def describe_job(self, vaultName, jobId, **kwargs):
+        archive_id, ready_at, _ = self._jobs[(vaultName, jobId)]
+        return {
+            "JobId": jobId,
+            "ArchiveId": archive_id,
+            "Completed": time.time() >= ready_at,
+        }
+
+    @aws_call
+    def get_job_output(self, vaultName, jobId, **kwargs):
+        _, ready_at, output = self._jobs[(vaultName, jobId)]
+        if time.time() < ready_at:
+            raise client_error(
+                "InvalidParameterValueException", "Job not completed", "GetJobOutput"
+            )
+        return {"body": io.BytesIO(output)}
+
+    @aws_call
+    def delete_archive(self, vaultName, archiveId, **kwargs):
+        self._archives.pop((vaultName, archiveId), None)
+        return {}
+
+
+"""Step Functions: a state machine is a Python callable run after an
+optional wait, standing in for the Wait -> SNS publish archive machine
+"""
+
+
+class LocalStepFunctions(LocalService):
+    service_name = "stepfunctions"
+
+    def __init__(self, aws):
+        LocalService.__init__(self, aws)
+        self._machines = {}
+
+    def register(self, arn, handler, wait_seconds=0):
+        self._machines[arn] = (handler, wait_seconds)
+
+    @aws_call
+    def start_execution(self, stateMachineArn, input="{}", **kwargs):
+        if stateMachineArn not in self._machines:
+            raise client_error(
+                "StateMachineDoesNotExist", stateMachineArn, "StartExecution"
+            )
+        handler, wait_seconds = self._machines[stateMachineArn]
+        timer = threading.Timer(wait_seconds, handler, args=(json.loads(input),))
+        timer.daemon = True
+        timer.start()
+        return {"executionArn": f"{stateMachineArn}:{uuid.uuid4()}"}
+
+
+"""Lambda: functions are Python handlers invoked synchronously
+"""
+
+
+class LocalLambda(LocalService):
+    service_name = "lambda"
+
+    def __init__(self, aws):
+        LocalService.__init__(self, aws)
+        self._functions = {}
+
+    def register(self, name, handler):
+        self._functions[name] = handler
+
+    @aws_call
+    def invoke(self, FunctionName, Payload=b"{}", **kwargs):
+        if FunctionName not in self._functions:
+            raise client_error("ResourceNotFoundException", FunctionName, "Invoke")
+        result = self._functions[FunctionName](json.loads(Payload), None)
+        return {
+            "StatusCode": 200,
+            "Payload": io.BytesIO(json.dumps(result).encode("utf-8")),
+        }
+
+
+class LocalSecretsManager(LocalService):
+    service_name = "secretsmanager"
+
+    def __init__(self, aws):
+        LocalService.__init__(self, aws)
+        self._secrets = {}
+
+    def put(self, secret_id, value):
+        self._secrets[secret_id] = json.dumps(value)
+
+    @aws_call
+    def get_secret_value(self, SecretId, **kwargs):
+        if SecretId not in self._secrets:
+            raise client_error("ResourceNotFoundException", SecretId, "GetSecretValue")
+        return {"SecretString": self._secrets[SecretId]}
+
+
+"""Container for all stand-ins plus per-call statistics
+"""
+
+
+class LocalAWS(object):
+    def __init__(self, latency_ms=0, visibility_timeout=30, retrieval_seconds=0):
+        self.latency = latency_ms / 1000.0
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self.s3 = LocalS3(self)
+        self.sqs = LocalSQS(self, visibility_timeout=visibility_timeout)
+        self.sns = LocalSNS(self)
+        self.dynamodb = LocalDynamoDB(self)
+        self.glacier = LocalGlacier(self, retrieval_seconds=retrieval_seconds)
+        self.stepfunctions = LocalStepFunctions(self)
+        self.lambda_ = LocalLambda(self)
+        self.secretsmanager = LocalSecretsManager(self)
+        self._patched = None
+
+    def record(self, service, operation, seconds):
+        with self._stats_lock:
+            count, total = self._stats.get((service, operation), (0, 0.0))
+            self._stats[(service, operation)] = (count + 1, total + seconds)
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def client(self, service_name, *args, **kwargs):
+        clients = {
+            "s3": self.s3,
+            "sqs": self.sqs,
+            "sns": self.sns,
+            "glacier": self.glacier,
+            "stepfunctions": self.stepfunctions,
+            "lambda": self.lambda_,
+            "secretsmanager": self.secretsmanager,
+        }
+        if service_name not in clients:
+            raise ValueError(f"No local stand-in for AWS service '{service_name}'")
+        return clients[service_name]
+
+    def resource(self, service_name, *args, **kwargs):
+        if service_name != "dynamodb":
+            raise ValueError(f"No local stand-in for AWS resource '{service_name}'")
+        return self.dynamodb
+
+    def install(self):
+        self._patched = (boto3.client, boto3.resource)
+        boto3.client = self.client
+        boto3.resource = self.resource
+
+    def uninstall(self):
+        if self._patched:
+            boto3.client, boto3.resource = self._patched
+            self._patched = None
+
+
+### EOF
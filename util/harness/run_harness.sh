@@ -0,0 +1,16 @@
+#!/bin/bash
+
+# run_harness.sh
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+#
+# Runs the offline full-stack harness
+#
+##
+
+cd /home/ubuntu/gas/util/harness
+source /home/ubuntu/.virtualenvs/mpcs/bin/activate
+/home/ubuntu/.virtualenvs/mpcs/bin/python /home/ubuntu/gas/util/harness/harness.py "$@"
+
+### EOF
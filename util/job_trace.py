@@ -0,0 +1,163 @@
+# job_trace.py
+#
+# Copyright (C) 2015-2024 Vas Vasiliadis
+# University of Chicago
+#
+# End-to-end latency tracing for annotation jobs
+#
+# The web app creates a trace context when a job is submitted and stores
+# it on the job item as a map attribute named "trace". Each component the
+# job passes through adds the epoch time (in milliseconds) at which it
+# finished its hop, so queueing delay and compute time can be separated
+# per job and in aggregate. Run this module directly to summarize all
+# traced jobs in the annotations table.
+#
+##
+__author__ = "Vas Vasiliadis <vas@uchicago.edu>"
+
+import math
+import os
+import time
+import uuid
+
+# Hops in the order a job passes through them
+HOPS = [
+    "submitted",
+    "dequeued",
+    "download_done",
+    "annotation_done",
+    "upload_done",
+    "dynamodb_updated",
+    "archived",
+]
+
+# Named segments between consecutive hops
+SEGMENTS = [
+    ("queueing", "submitted", "dequeued"),
+    ("download", "dequeued", "download_done"),
+    ("annotation", "download_done", "annotation_done"),
+    ("upload", "annotation_done", "upload_done"),
+    ("db_update", "upload_done", "dynamodb_updated"),
+    ("archive", "dynamodb_updated", "archived"),
+    ("total", "submitted", "dynamodb_updated"),
+]
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+"""Create a new trace context for a job being submitted
+"""
+
+
+def new_trace():
+    return {"trace_id": str(uuid.uuid4()), "submitted": now_ms()}
+
+
+"""Build the pieces of an UpdateExpression that set trace hops
+
+Returns (set_clauses, attribute_names, attribute_values) so callers can
+fold the trace timestamps into an update they are already making.
+"""
+
+
+def hop_updates(hops):
+    clauses = []
+    values = {}
+    for hop, timestamp in hops.items():
+        if hop not in HOPS:
+            raise ValueError(f"Unknown trace hop: {hop}")
+        clauses.append(f"#trace.{hop} = :trace_{hop}")
+        values[f":trace_{hop}"] = int(timestamp)
+    return clauses, {"#trace": "trace"}, values
+
+
+"""Per-job segment durations (in seconds) for the hops present
+"""
+
+
+def durations(trace):
+    result = {}
+    for name, start, end in SEGMENTS:
+        if start in trace and end in trace:
+            result[name] = (int(trace[end]) - int(trace[start])) / 1000.0
+    return result
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(p / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+"""Aggregate segment durations over many jobs
+"""
+
+
+def summarize(items):
+    segments = {}
+    for item in items:
+        if "trace" not in item:
+            continue
+        for name, secs in durations(item["trace"]).items():
+            segments.setdefault(name, []).append(secs)
+
+    summary = {}
+    for name, _, _ in SEGMENTS:
+        values = segments.get(name)
+        if values:
+            summary[name] = {
+                "jobs": len(values),
+                "mean": sum(values) / len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "max": max(values),
+            }
+    return summary
+
+
+def main():
+    import boto3
+    from configparser import ConfigParser, ExtendedInterpolation
+
+    config = ConfigParser(os.environ, interpolation=ExtendedInterpolation())
+    config.read(
+        os.path.join(os.path.abspath(os.path.dirname(__file__)), "util_config.ini")
+    )
+
+    dynamodb = boto3.resource("dynamodb", region_name=config["aws"]["AwsRegionName"])
+    table = dynamodb.Table(config["gas"]["AnnotationsTable"])
+
+    items = []
+    kwargs = {
+        "FilterExpression": "attribute_exists(#trace)",
+        "ExpressionAttributeNames": {"#trace": "trace"},
+    }
+    while True:
+        response = table.scan(**kwargs)
+        items.extend(response.get("Items", []))
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    for item in items:
+        segs = durations(item["trace"])
+        print(
+            item["job_id"]
+            + "  "
+            + "  ".join([f"{k}={v:.2f}s" for k, v in segs.items()])
+        )
+
+    print(f"\n{len(items)} traced job(s)")
+    for name, stats in summarize(items).items():
+        print(
+            f"{name:<12} n={stats['jobs']:<6} mean={stats['mean']:.2f}s "
+            f"p50={stats['p50']:.2f}s p95={stats['p95']:.2f}s max={stats['max']:.2f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
+
+### EOF
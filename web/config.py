@@ -171,6 +171,13 @@ class Config(object):
     # Time before free user results are archived (in seconds)
     FREE_USER_DATA_RETENTION = 300
 
+    # The annotator's config, which ships with the web app; the pipelines
+    # (and their tracks) jobs may name are read from its [pipeline], and
+    # the stored gene panels are the BED files in its [targets] PanelDir
+    ANNOTATOR_CONFIG_FILE = os.path.join(
+        base_dir, os.pardir, "ann", "annotator_config.ini"
+    )
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
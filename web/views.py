@@ -8,6 +8,7 @@
 ##
 __author__ = "Vas Vasiliadis <vas@uchicago.edu>"
 
+import os
 import uuid
 import time
 import json
@@ -17,16 +18,73 @@ import boto3
 from botocore.client import Config
 from boto3.dynamodb.conditions import Key, Attr
 from botocore.exceptions import ClientError
+from configparser import ConfigParser, ExtendedInterpolation
 
 from flask import abort, flash, redirect, render_template, request, session, url_for
 
 from app import app, db
 from decorators import authenticated, is_premium
 
+"""The annotator's config (ANNOTATOR_CONFIG_FILE), which ships with the
+web app in ../ann
+"""
+
+
+def annotator_config():
+    config = ConfigParser(interpolation=ExtendedInterpolation())
+    config.optionxform = str  # keep pipeline names as written
+    config.read(app.config["ANNOTATOR_CONFIG_FILE"])
+    return config
+
+
+"""Pipelines jobs may name, each with its tracks in order, from the
+annotator's [pipeline] (driver.read_pipeline reads the same section)
+"""
+
+
+def annotation_pipelines():
+    config = annotator_config()
+    pipelines = {}
+    for name in config.options("pipeline"):
+        if name not in config.defaults():
+            spec = config.get("pipeline", name, raw=True)
+            pipelines[name] = [t.strip() for t in spec.split(",") if t.strip()]
+    return pipelines
+
+
+"""Names of the stored gene panels jobs may name: the BED files in the
+annotator's [targets] PanelDir, without .bed
+"""
+
+
+def target_panels():
+    panel_dir = annotator_config().get("targets", "PanelDir", fallback="")
+    if not os.path.isdir(panel_dir):
+        return []
+    return sorted(
+        [name[: -len(".bed")] for name in os.listdir(panel_dir) if name.endswith(".bed")]
+    )
+
+
+"""A job option set on the upload form, which S3 keeps as object metadata
+(x-amz-meta-<name with dashes>), or for API clients in the query string
+of the redirect
+"""
+
+
+def job_option(metadata, name):
+    return request.args.get(name) or metadata.get(name.replace("_", "-")) or None
+
+
 """Start annotation request
 Create the required AWS S3 policy document and render a form for
 uploading an annotation input file using the policy document
 
+Job options chosen on the form are uploaded with the file as object
+metadata, so the policy lets them through. A BED file of target regions
+is uploaded first by a second form, whose redirect (/annotate/targets)
+comes back here with its key in target_bed.
+
 Note: You are welcome to use this code instead of your own
 but you can replace the code below with your own if you prefer.
 """
@@ -44,6 +102,11 @@ def annotate():
 
     bucket_name = app.config["AWS_S3_INPUTS_BUCKET"]
     user_id = session["primary_identity"]
+    user_prefix = app.config["AWS_S3_KEY_PREFIX"] + user_id + "/"
+
+    target_bed = request.args.get("target_bed", "")
+    if target_bed and not target_bed.startswith(user_prefix):
+        abort(400, description="Target regions must be one of your uploads")
 
     # Generate unique ID to be used as S3 key (name)
     key_name = (
@@ -53,9 +116,11 @@ def annotate():
         + str(uuid.uuid4())
         + "~${filename}"
     )
+    bed_key_name = user_prefix + str(uuid.uuid4()) + "~${filename}"
 
-    # Create the redirect URL
-    redirect_url = str(request.url) + "/job"
+    # Create the redirect URLs (without the target_bed query)
+    redirect_url = str(request.base_url) + "/job"
+    bed_redirect_url = str(request.base_url) + "/targets"
 
     # Define policy conditions
     encryption = app.config["AWS_S3_ENCRYPTION"]
@@ -72,8 +137,24 @@ def annotate():
         {"acl": acl},
         ["starts-with", "$csrf_token", ""],
     ]
+    bed_fields = dict(fields, success_action_redirect=bed_redirect_url)
+    bed_conditions = [
+        ["starts-with", "$success_action_redirect", bed_redirect_url]
+    ] + conditions[1:]
+
+    # Job options uploaded with the input file as object metadata
+    fields["x-amz-meta-target-bed"] = target_bed
+    conditions.extend(
+        [
+            {"x-amz-meta-target-bed": target_bed},
+            ["starts-with", "$x-amz-meta-target-panel", ""],
+            ["starts-with", "$x-amz-meta-target-mode", ""],
+            ["starts-with", "$x-amz-meta-pipeline", ""],
+            ["starts-with", "$x-amz-meta-tracks", ""],
+        ]
+    )
 
-    # Generate the presigned POST call
+    # Generate the presigned POST calls
     try:
         presigned_post = s3.generate_presigned_post(
             Bucket=bucket_name,
@@ -82,16 +163,44 @@ def annotate():
             Conditions=conditions,
             ExpiresIn=app.config["AWS_SIGNED_REQUEST_EXPIRATION"],
         )
+        bed_post = s3.generate_presigned_post(
+            Bucket=bucket_name,
+            Key=bed_key_name,
+            Fields=bed_fields,
+            Conditions=bed_conditions,
+            ExpiresIn=app.config["AWS_SIGNED_REQUEST_EXPIRATION"],
+        )
     except ClientError as e:
         app.logger.error(f"Unable to generate presigned URL for upload: {e}")
         return abort(500)
 
     # Render the upload form which will parse/submit the presigned POST
     return render_template(
-        "annotate.html", s3_post=presigned_post, role=session["role"]
+        "annotate.html",
+        s3_post=presigned_post,
+        bed_post=bed_post,
+        target_bed_name=target_bed.split("~")[-1],
+        panels=target_panels(),
+        pipelines=annotation_pipelines(),
+        role=session["role"],
     )
 
 
+"""Accepts the S3 redirect for an uploaded BED file of target regions
+and returns to the annotate form with it selected
+"""
+
+
+@app.route("/annotate/targets", methods=["GET"])
+@authenticated
+def annotate_targets():
+    s3_key = request.args.get("key")
+    user_prefix = app.config["AWS_S3_KEY_PREFIX"] + session["primary_identity"] + "/"
+    if not s3_key or not s3_key.startswith(user_prefix):
+        abort(400, description="Missing or foreign target regions key")
+    return redirect(url_for("annotate", target_bed=s3_key))
+
+
 """Fires off an annotation job
 Accepts the S3 redirect GET request, parses it to extract 
 required info, saves a job item to the database, and then
@@ -135,9 +244,60 @@ def create_annotation_job_request():
         "s3_inputs_bucket": bucket_name,
         "s3_key_input_file": s3_key,
         "submit_time": submit_time,
-        'job_status': 'PENDING'
+        'job_status': 'PENDING',
+        # Trace context carried with the job; each hop adds its epoch time (ms).
+        # Same shape as util/job_trace.new_trace(); the web app runs from
+        # web/ on its own and does not import from util/
+        'trace': {
+            'trace_id': str(uuid.uuid4()),
+            'submitted': int(time.time() * 1000)
+        }
     }
 
+    # Job options set on the upload form come back as object metadata
+    s3 = boto3.client('s3', region_name=region, config=Config(signature_version='s3v4'))
+    try:
+        metadata = s3.head_object(Bucket=bucket_name, Key=s3_key)['Metadata']
+    except ClientError as e:
+        app.logger.error(f"Unable to read input file metadata: {e}")
+        abort(500, description=f"S3 client error: {e.response['Error']['Code']}")
+
+    # Optional target regions: a stored gene panel or the S3 key of an
+    # uploaded BED file, plus whether off-target records are dropped or
+    # passed through unannotated
+    target_panel = job_option(metadata, "target_panel")
+    target_bed = job_option(metadata, "target_bed")
+    user_prefix = app.config["AWS_S3_KEY_PREFIX"] + user_id + "/"
+    target_mode = job_option(metadata, "target_mode")
+    if target_panel and target_bed:
+        abort(400, description="Choose a target panel or a BED file, not both")
+    if target_panel and target_panel not in target_panels():
+        abort(400, description=f"Unknown target panel: {target_panel}")
+    if target_bed and not target_bed.startswith(user_prefix):
+        abort(400, description="Target regions must be one of your uploads")
+    if target_mode and target_mode not in ("drop", "pass"):
+        abort(400, description=f"Unknown target mode: {target_mode}")
+    if target_panel or target_bed:
+        data['targets'] = {'panel': target_panel} if target_panel else {'s3_key_bed': target_bed}
+        if target_mode:
+            data['targets']['mode'] = target_mode
+
+    # Optional pipeline (one of the annotator's) and comma-separated
+    # tracks of it to run; checked here, as the annotator only sees them
+    # once the job is running
+    pipeline = job_option(metadata, "pipeline")
+    tracks = [t.strip() for t in (job_option(metadata, "tracks") or "").split(",") if t.strip()]
+    pipelines = annotation_pipelines()
+    if pipeline and pipeline not in pipelines:
+        abort(400, description=f"Unknown pipeline: {pipeline}")
+    unknown = [t for t in tracks if t not in pipelines[pipeline or "Default"]]
+    if unknown:
+        abort(400, description=f"Unknown tracks: {', '.join(unknown)}")
+    if pipeline:
+        data['pipeline'] = pipeline
+    if tracks:
+        data['tracks'] = tracks
+
 
     # Persist job to database
     dynamodb = boto3.resource('dynamodb', region_name=app.config["AWS_REGION_NAME"])